@@ -0,0 +1,88 @@
+from carla_backend import carla
+from typing import Dict
+
+# Per-tick read-through cache of actor state. Transforms and velocities for every actor come from one
+# world snapshot fetched at the start of the tick, anything else is requested from the simulator at most
+# once per actor per tick. Values handed out are shared for the whole tick so must not be mutated.
+class ActorSnapshotCache:
+    def __init__(self):
+        self.tick = 0
+        self.world_snapshot = None
+        self._snapshots: Dict[int,"ActorSnapshot"] = {}
+
+    # Invalidates every cached value, call once at the start of each tick
+    def new_tick(self,world: carla.World):
+        self.tick += 1
+        self.world_snapshot = world.get_snapshot()
+
+    def track(self,actor):
+        if isinstance(actor,ActorSnapshot):
+            return actor
+        snapshot = self._snapshots.get(actor.id)
+        if snapshot == None:
+            snapshot = ActorSnapshot(actor,self)
+            self._snapshots[actor.id] = snapshot
+        return snapshot
+
+    def forget(self,actor_id: int):
+        self._snapshots.pop(actor_id,None)
+
+    def find(self,actor_id: int):
+        if self.world_snapshot == None:
+            return None
+        return self.world_snapshot.find(actor_id)
+
+# Stands in for a carla.Actor in the oracles, anything not cached is forwarded to the wrapped actor
+class ActorSnapshot:
+    def __init__(self,actor: carla.Actor,cache: ActorSnapshotCache):
+        self.actor = actor
+        self.id = actor.id
+        self.type_id = actor.type_id
+        self.attributes = actor.attributes
+        self.bounding_box = actor.bounding_box
+        self._cache = cache
+        self._tick = -1
+        self._values = {}
+
+    def __getattr__(self,name):
+        return getattr(self.actor,name)
+
+    def _get(self,name,fetch):
+        if self._tick != self._cache.tick:
+            self._tick = self._cache.tick
+            self._values = {}
+        if not (name in self._values):
+            self._values[name] = fetch()
+        return self._values[name]
+
+    def _fetch_transform(self):
+        state = self._cache.find(self.id)
+        if state == None:
+            return self.actor.get_transform()
+        return state.get_transform()
+
+    def _fetch_velocity(self):
+        state = self._cache.find(self.id)
+        if state == None:
+            return self.actor.get_velocity()
+        return state.get_velocity()
+
+    def get_transform(self):
+        return self._get("transform",self._fetch_transform)
+
+    # Returns a copy as callers commonly edit the location in place
+    def get_location(self):
+        location = self.get_transform().location
+        return carla.Location(location.x,location.y,location.z)
+
+    def get_velocity(self):
+        return self._get("velocity",self._fetch_velocity)
+
+    def get_control(self):
+        return self._get("control",self.actor.get_control)
+
+    def get_light_state(self):
+        return self._get("light_state",self.actor.get_light_state)
+
+    def get_speed_limit(self):
+        return self._get("speed_limit",self.actor.get_speed_limit)
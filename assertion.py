@@ -21,6 +21,8 @@ class Assertion:
 
         # Tag constraints
         self.validityRequirements = validityRequirements
+        # Position of the assertion's micro-bin in the catalogue coverage was built from
+        self.bin_index = None
     
     def IsActive(self,coverage_state: List[Tuple[CoverageVariable,Enum]]):
         if self.validityRequirements == None:
@@ -0,0 +1,331 @@
+import argparse
+import csv
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+# Synthetic worlds are simulated in-process, see fake_carla
+os.environ["CARLA_BACKEND"] = "fake"
+from carla_backend import carla
+from typing import Callable, Dict, List
+from coverage import Coverage, BUG, COVERED, UNCOVERED, INVALID
+from persistence import AsyncWriter, FsyncPolicy
+from world_state import WorldState, EmergencyVehicleRegistry, WalkerRegistry
+from validity_requirements import CompiledValidityMatcher
+from checker_utils import vehicle_or_pedestrian, currentJunction, getJunctionStatus, american_traffic_light_status, JunctionStates
+from actor_snapshot import ActorSnapshotCache
+from junction_cache import JunctionTopologyCache
+from map_cache import load_lane_grid
+from sensor_events import SensorEventBus
+from rules import ScenarioContext, build_assertions, get_bin_bits, assertionCheckTick
+from replay import TraceReplay
+from scenario_trace import TraceReader
+import test_setup
+import main as scenario_runner
+from npc_control import NpcController, PATH_FOLLOWERS
+
+# Stages of the tick loop in run_scenario_ticks, in the order they run. "tick" is the whole loop body.
+STAGES = ["npc_control","world_tick","snapshot","junction","coverage_state","assertions","global_coverage","session_coverage","tick"]
+PERCENTILES = [50,90,99]
+DEFAULT_ACTOR_COUNTS = [0,10,50,100,500,1000]
+DEFAULT_DB_SIZES = [100,10000,1000000]
+
+# Times and, when tracing allocations, measures the peak memory allocated by each stage of a tick
+class StageTimer:
+    def __init__(self,trace_allocations: bool = False):
+        self.trace_allocations = trace_allocations
+        self.times: Dict[str,List[float]] = {s: [] for s in STAGES}
+        self.allocations: Dict[str,List[int]] = {s: [] for s in STAGES}
+
+    @contextlib.contextmanager
+    def stage(self,name: str):
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        self.times[name].append(time.perf_counter() - start)
+        if self.trace_allocations:
+            self.allocations[name].append(tracemalloc.get_traced_memory()[1] - start_memory)
+
+# Ego at the centre of a grid town with actor_count NPCs on the lanes nearest it, each with a path to another
+# lane point nearby like the ones setup_random_scenario makes
+def make_synthetic_world(actor_count: int,seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    size = max(4,int(math.ceil(math.sqrt(actor_count / 25))) + 2)
+    world = carla.World(carla.Map("Benchmark_"+str(size)+"x"+str(size),columns=size,rows=size))
+    map = world.get_map()
+    centre = carla.Location((size - 1) * carla.FAKE_BLOCK_LENGTH / 2,(size - 1) * carla.FAKE_BLOCK_LENGTH / 2,0)
+    points = [w.transform for w in map.generate_waypoints(8.0) if not w.is_junction]
+    points.sort(key=lambda t: (t.location - centre).length())
+    ego_spawn = carla.Transform(points[0].location + carla.Vector3D(0,0,0.5),points[0].rotation)
+    test_setup.spawn_ego(world,ego_spawn)
+
+    vehicle_paths = []
+    for t in points[1:]:
+        if len(vehicle_paths) >= actor_count:
+            break
+        spawn = carla.Transform(t.location + carla.Vector3D(0,0,0.5),t.rotation)
+        actor = world.try_spawn_actor(world.get_blueprint_library().filter(random.choice(test_setup.ACTOR_BLUEPRINT_IDS))[0],spawn)
+        if actor != None:
+            target = random.choice(points[:max(2 * actor_count,10)]).location
+            vehicle_paths.append((actor,[carla.Location(target.x,target.y,0)]))
+    if len(vehicle_paths) < actor_count:
+        print("Only spawned",len(vehicle_paths),"of",actor_count,"actors")
+    return world, vehicle_paths
+
+# Coverage in a scratch file holding db_size random macro-bins, with states spread over all four levels
+def make_coverage(path: str,catalogue,coverage_space,db_size: int,writer: AsyncWriter,seed: int):
+    coverage = Coverage(path,catalogue,coverage_space,writer=writer)
+    rng = np.random.default_rng(seed)
+    keys = rng.choice(coverage_space.key_count,size=min(db_size,coverage_space.key_count),replace=False)
+    states = rng.choice(np.array([BUG,COVERED,UNCOVERED,INVALID],dtype=np.uint8),size=(len(keys),len(catalogue)),p=[0.02,0.18,0.3,0.5])
+    coverage.load_cases({int(k): s for k, s in zip(keys,states)})
+    return coverage
+
+# assertion_count assertions over ctx, repeating the catalogue when asking for more than it holds. Repeats keep
+# the micro-bin of the assertion they copy.
+def make_assertions(ctx: ScenarioContext,assertion_count: int):
+    assertions = []
+    while len(assertions) < assertion_count:
+        assertions.extend(build_assertions(ctx))
+    return assertions[:assertion_count]
+
+# Runs warmup + ticks ticks of the live tick loop against a synthetic world, timing each stage. The last
+# allocation_ticks of them also trace allocations, which slows them so they are not timed.
+def run_synthetic(config: dict,args,directory: str,writer: AsyncWriter):
+    world, vehicle_paths = make_synthetic_world(config["actors"],args.seed)
+    client = carla.Client("benchmark",0)
+    client.set_world(world)
+    scenario_runner.enable_synchronous_mode(world,args.delta)
+    world.tick()
+
+    snapshots = ActorSnapshotCache()
+    junction_cache = JunctionTopologyCache()
+    emergency_registry = EmergencyVehicleRegistry(world,snapshots)
+    walker_registry = WalkerRegistry(world)
+    world_state = WorldState(world,snapshots,junction_cache,emergency_registry)
+    map = load_lane_grid(world.get_map())
+    actors = world.get_actors()
+    ego_vehicle = [a for a in actors if a.attributes.get("role_name") == "hero"][0]
+    others = [a for a in actors if a.id != ego_vehicle.id and vehicle_or_pedestrian(a)]
+    vehicles = [a for a in actors.filter("*vehicle*") if a.id != ego_vehicle.id]
+
+    event_bus = SensorEventBus()
+    for sensor_id, callback in [("sensor.other.lane_invasion",event_bus.lane_callback),("sensor.other.collision",event_bus.collision_callback)]:
+        world.spawn_actor(world.get_blueprint_library().find(sensor_id),carla.Transform(),attach_to=ego_vehicle).listen(callback)
+
+    ctx = ScenarioContext(world,map,snapshots.track(ego_vehicle),[snapshots.track(x) for x in others],[snapshots.track(x) for x in vehicles],emergency_registry,walker_registry)
+    assertions = make_assertions(ctx,config["assertions"])
+    matcher = CompiledValidityMatcher([a.validityRequirements for a in assertions],world_state.coverage_space)
+    catalogue = build_assertions(ScenarioContext())
+    global_coverage = make_coverage(os.path.join(directory,"global.csv"),catalogue,world_state.coverage_space,config["db_size"],writer,args.seed)
+    session_coverage = Coverage(os.path.join(directory,"session.csv"),catalogue,world_state.coverage_space,writer=writer)
+
+    npc_controller = NpcController(client,world,map,vehicle_paths,args.npc_follower)
+    has_junction = False
+    def run_tick(timer: StageTimer):
+        nonlocal has_junction
+        with timer.stage("tick"):
+            with timer.stage("npc_control"):
+                npc_controller.apply(snapshots.world_snapshot,[carla.command.ApplyVehicleControl(ctx.ego_vehicle.id,scenario_runner.random_ego_control())])
+            with timer.stage("world_tick"):
+                world.tick()
+            with timer.stage("snapshot"):
+                snapshots.new_tick(world)
+                ctx.events = event_bus.take(snapshots.world_snapshot.frame)
+                emergency_registry.refresh(snapshots.world_snapshot)
+                walker_registry.refresh(snapshots.world_snapshot)
+                ctx.update_geometry()
+            with timer.stage("junction"):
+                ctx.traffic_light_status = american_traffic_light_status(ctx.ego_vehicle,map,world)
+                current_junction = currentJunction(ctx.ego_vehicle,map)
+                if current_junction == None and has_junction:
+                    has_junction = False
+                    ctx.junction_status = JunctionStates.NONE
+                    ctx.quads = None
+                if not has_junction and current_junction != None:
+                    has_junction = True
+                    ctx.junction_status, ctx.quads = getJunctionStatus(ctx.ego_vehicle,current_junction,junction_cache)
+            with timer.stage("coverage_state"):
+                qual_vars = world_state.get_coverage_state(ctx.ego_vehicle,ctx.non_ego_vehicles,map,ctx.vehicle_index,ctx.pedestrian_index)
+            with timer.stage("assertions"):
+                _, triggered, covered, valid, _ = assertionCheckTick(assertions,qual_vars,matcher)
+            bits = (get_bin_bits(valid),get_bin_bits(covered),get_bin_bits(triggered))
+            key = world_state.coverage_space.encode_key(qual_vars)
+            with timer.stage("global_coverage"):
+                global_coverage.try_cover_bits(key,*bits)
+            with timer.stage("session_coverage"):
+                session_coverage.try_cover_bits(key,*bits)
+
+    return run_timed(run_tick,args), len(vehicle_paths)
+
+# Runs the ticks of a recorded trace through the replay stand-ins. The actor count is the trace's, and stages
+# the trace answers from its records (npc_control, world_tick, junction, coverage_state) are not timed.
+def run_trace(config: dict,args,directory: str,writer: AsyncWriter):
+    replay = TraceReplay(TraceReader(args.trace))
+    assertions = make_assertions(replay.ctx,config["assertions"])
+    matcher = CompiledValidityMatcher([a.validityRequirements for a in assertions],replay.coverage_space)
+    variables = [v[0] for v in replay.coverage_space.variables]
+    catalogue = build_assertions(ScenarioContext())
+    global_coverage = make_coverage(os.path.join(directory,"global.csv"),catalogue,replay.coverage_space,config["db_size"],writer,args.seed)
+    session_coverage = Coverage(os.path.join(directory,"session.csv"),catalogue,replay.coverage_space,writer=writer)
+    tick = 0
+
+    def run_tick(timer: StageTimer):
+        nonlocal tick
+        with timer.stage("tick"):
+            with timer.stage("snapshot"):
+                key = replay.load_tick(tick % len(replay.trace))
+            qual_vars = list(zip(variables,replay.coverage_space.decode_key(key)))
+            with timer.stage("assertions"):
+                _, triggered, covered, valid, _ = assertionCheckTick(assertions,qual_vars,matcher)
+            bits = (get_bin_bits(valid),get_bin_bits(covered),get_bin_bits(triggered))
+            with timer.stage("global_coverage"):
+                global_coverage.try_cover_bits(key,*bits)
+            with timer.stage("session_coverage"):
+                session_coverage.try_cover_bits(key,*bits)
+        tick += 1
+
+    return run_timed(run_tick,args), len(replay.actors) - 1
+
+def run_timed(run_tick: Callable[[StageTimer],None],args):
+    # Coverage prints a summary whenever a macro-bin changes, which would drown the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(args.warmup):
+            run_tick(StageTimer())
+        timer = StageTimer()
+        for _ in range(args.ticks):
+            run_tick(timer)
+        allocation_timer = StageTimer(trace_allocations=True)
+        if args.allocation_ticks > 0:
+            tracemalloc.start()
+            try:
+                for _ in range(args.allocation_ticks):
+                    run_tick(allocation_timer)
+            finally:
+                tracemalloc.stop()
+    return timer, allocation_timer
+
+# Latency percentiles in milliseconds and mean peak allocation in KiB of each stage that ran
+def summarise(timer: StageTimer,allocation_timer: StageTimer):
+    stages = {}
+    for stage in STAGES:
+        times = np.array(timer.times[stage]) * 1000
+        if len(times) == 0:
+            continue
+        summary = {"p"+str(p): float(np.percentile(times,p)) for p in PERCENTILES}
+        summary["max"] = float(times.max())
+        summary["mean"] = float(times.mean())
+        allocations = allocation_timer.allocations[stage]
+        summary["alloc_kib"] = float(np.mean(allocations)) / 1024 if len(allocations) > 0 else None
+        stages[stage] = summary
+    return stages
+
+# One sweep per axis, each varying that axis with the others at their base value, or every combination with grid
+def build_configs(args,catalogue_size: int):
+    actor_counts = [int(x) for x in args.actors.split(",")]
+    db_sizes = [int(float(x)) for x in args.db_sizes.split(",")]
+    if args.assertions == None:
+        assertion_counts = sorted(set([max(1,catalogue_size // 4),catalogue_size // 2,catalogue_size,catalogue_size * 2,catalogue_size * 4]))
+    else:
+        assertion_counts = [int(x) for x in args.assertions.split(",")]
+    if args.trace != None:
+        actor_counts = [None]
+    if args.grid:
+        return [{"actors": a,"db_size": d,"assertions": n} for a in actor_counts for d in db_sizes for n in assertion_counts]
+    base = {"actors": actor_counts[len(actor_counts) // 2],"db_size": db_sizes[len(db_sizes) // 2],"assertions": catalogue_size if catalogue_size in assertion_counts else assertion_counts[0]}
+    configs = []
+    for axis, values in [("actors",actor_counts),("db_size",db_sizes),("assertions",assertion_counts)]:
+        for v in values:
+            config = dict(base)
+            config[axis] = v
+            if not (config in configs):
+                configs.append(config)
+    return configs
+
+def write_results(results: List[dict],args,output_prefix: str):
+    directory = os.path.dirname(output_prefix)
+    if directory != "":
+        os.makedirs(directory,exist_ok=True)
+    document = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S",time.localtime()),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "source": "trace" if args.trace != None else "synthetic",
+        "trace": args.trace,
+        "npc_follower": args.npc_follower,
+        "ticks": args.ticks,
+        "budget_ms": args.budget_ms,
+        "results": results
+    }
+    with open(output_prefix+".json",'w') as jsonfile:
+        json.dump(document,jsonfile,indent=1)
+    with open(output_prefix+".csv",'w',newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        fields = ["p"+str(p) for p in PERCENTILES] + ["max","mean","alloc_kib"]
+        writer.writerow(["actors","db_size","assertions","stage"] + [f+("" if f == "alloc_kib" else "_ms") for f in fields])
+        for r in results:
+            for stage, summary in r["stages"].items():
+                writer.writerow([r["actors"],r["db_size"],r["assertions"],stage] + ["" if summary[f] == None else round(summary[f],4) for f in fields])
+
+def main():
+    parser = argparse.ArgumentParser(description="Times each stage of the tick loop while sweeping actor count, coverage database size and assertion count")
+    parser.add_argument("--actors",default=",".join(str(x) for x in DEFAULT_ACTOR_COUNTS),help="Comma separated NPC counts")
+    parser.add_argument("--db-sizes",default=",".join(str(x) for x in DEFAULT_DB_SIZES),help="Comma separated numbers of macro-bins already in global coverage")
+    parser.add_argument("--assertions",default=None,help="Comma separated assertion counts, defaults to multiples of the catalogue")
+    parser.add_argument("--grid",action='store_true',help="Run every combination instead of sweeping one axis at a time")
+    parser.add_argument("--trace",default=None,help="Replay a trace recorded with main.py --record instead of simulating a synthetic world")
+    parser.add_argument("--ticks",type=int,default=200,help="Timed ticks per configuration")
+    parser.add_argument("--warmup",type=int,default=20,help="Untimed ticks run first")
+    parser.add_argument("--allocation-ticks",type=int,default=20,help="Ticks run with allocation tracing after the timed ones")
+    parser.add_argument("--delta",type=float,default=0.1,help="Simulated seconds per tick")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--npc-follower",choices=list(PATH_FOLLOWERS),default="pure_pursuit",help="How NPCs are driven along their paths")
+    parser.add_argument("--budget-ms",type=float,default=100,help="Exit with status 1 if any configuration's p99 tick exceeds this")
+    parser.add_argument("-o","--output",default=None,help="Path prefix of the .json and .csv results, defaults to out/benchmark_<time>")
+    args = parser.parse_args()
+    output_prefix = args.output
+    if output_prefix == None:
+        output_prefix = os.path.join("out","benchmark_"+time.strftime("%d-%m-%Y_%H-%M-%S",time.localtime()))
+
+    configs = build_configs(args,len(build_assertions(ScenarioContext())))
+    results = []
+    over_budget = []
+    for config in configs:
+        with tempfile.TemporaryDirectory() as directory:
+            writer = AsyncWriter(FsyncPolicy.NEVER)
+            try:
+                if args.trace != None:
+                    (timer, allocation_timer), actors = run_trace(config,args,directory,writer)
+                else:
+                    (timer, allocation_timer), actors = run_synthetic(config,args,directory,writer)
+            finally:
+                writer.close()
+        result = dict(config)
+        result["actors"] = actors
+        result["stages"] = summarise(timer,allocation_timer)
+        results.append(result)
+        tick = result["stages"]["tick"]
+        print("actors",actors,"db_size",config["db_size"],"assertions",config["assertions"],
+              "tick p50 %.2f p99 %.2f max %.2f ms" % (tick["p50"],tick["p99"],tick["max"]))
+        if tick["p99"] > args.budget_ms:
+            over_budget.append(result)
+
+    write_results(results,args,output_prefix)
+    print("Results written to",output_prefix+".json","and",output_prefix+".csv")
+    if len(over_budget) > 0:
+        print(len(over_budget),"configurations over the",args.budget_ms,"ms tick budget at p99")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
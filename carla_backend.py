@@ -0,0 +1,18 @@
+import importlib
+import os
+
+# Chooses the module the rest of the repository uses as the carla API. CARLA_BACKEND=fake runs everything
+# against fake_carla, an in-process simulation, "auto" uses it only when the carla package isn't installed.
+def load_backend(name: str):
+    if name == "fake":
+        return importlib.import_module("fake_carla")
+    if name == "carla":
+        return importlib.import_module("carla")
+    if name == "auto":
+        try:
+            return importlib.import_module("carla")
+        except ImportError:
+            return importlib.import_module("fake_carla")
+    raise Exception("Unknown CARLA_BACKEND "+name+", expected carla, fake or auto")
+
+carla = load_backend(os.environ.get("CARLA_BACKEND","carla"))
@@ -1,9 +1,12 @@
 from enum import Enum
 from fnmatch import fnmatch
-import carla
+from carla_backend import carla
 import numpy as np
-from world_state import get_emergency_vehicle_status, dot2d
+from world_state import get_emergency_vehicle_status, dot2d, get_junction_road_graph, EmergencyVehicleRegistry
+from junction_cache import JunctionTopologyCache, JunctionTopology, JunctionEntry
 from typing import List
+from spatial_index import SpatialGrid
+from map_cache import carla_waypoint
 
 class PartitionedJunction:
     def __init__(self,cross_point: carla.Vector3D,right_lane_alignment_vector: carla.Vector3D,past_turning_alignment_vector: carla.Vector3D):
@@ -38,6 +41,11 @@ class PartitionedJunction:
         quad = self.get_quadrant(location)
         return quad == JunctionQuadrants.INNER_AFTER_TURNING or quad == JunctionQuadrants.OUTER_AFTER_TURNING
 
+    # x and y of the cross point, lane separation and turning separation vectors, the arguments it can be rebuilt from
+    def get_vectors(self):
+        return (self.cross_point.x,self.cross_point.y,self._lane_separation_vector.x,self._lane_separation_vector.y,
+                self._turning_separation_vector.x,self._turning_separation_vector.y)
+
 class JunctionQuadrants(Enum):
     OUTER_BEFORE_TURNING = 0
     OUTER_AFTER_TURNING = 1
@@ -51,17 +59,6 @@ class JunctionStates(Enum):
     NONE = 3
     ROUNDABOUT = 4
 
-# Returns true if faster than other vehicle, within sensible range and pther vehicle is to the left
-def vehicle_in_overtake_range(ego_vehicle,other_vehicle,world):
-    ego_trans = ego_vehicle.get_transform()
-    overtake_distance = 10
-    extents = ego_vehicle.bounding_box.extent
-    box = carla.BoundingBox(carla.Vector3D(0,0,0),carla.Vector3D(overtake_distance,2.5 * extents.y,extents.z))
-    return (ego_vehicle.get_velocity().length() > other_vehicle.get_velocity().length() and 
-            (box.contains(other_vehicle.get_location(),carla.Transform(ego_vehicle.get_location() - ego_trans.get_right_vector() * extents.y * 3.5,ego_trans.rotation))
-            or within_box_in_front_of_vehicle(ego_vehicle,other_vehicle,overtake_distance/2 - extents.x,world))
-    )
-
 def lane_markings_present(ego_vehicle: carla.Vehicle,map: carla.Map,marking_types: List[carla.LaneMarkingType],colors: carla.LaneMarkingColor = None):
     wp = map.get_waypoint(ego_vehicle.get_location())
     if wp.left_lane_marking.type in marking_types or wp.right_lane_marking.type in marking_types:
@@ -83,8 +80,11 @@ def parked_left(ego_vehicle,map):
     else:
         return False
     
-def active_emergency_vehicle_within_distance(ego_vehicle,world,distance):
-    _, active_evs = get_emergency_vehicle_status(world)
+def active_emergency_vehicle_within_distance(ego_vehicle,world,distance,emergency_registry: EmergencyVehicleRegistry = None):
+    if emergency_registry != None:
+        _, active_evs = emergency_registry.get_status()
+    else:
+        _, active_evs = get_emergency_vehicle_status(world)
     return any([(e.get_location() - ego_vehicle.get_location()).length() < distance for e in active_evs])
 
 def vehicleInJunction(vehicle: carla.Actor,junction: carla.Junction,extentMargins: carla.Vector3D = carla.Vector3D(0,0,5)):
@@ -101,32 +101,102 @@ def american_traffic_light_status(ego_vehicle,map,world):
     ego_loc = ego_vehicle.get_location()
     ego_wp = map.get_waypoint(ego_loc)
     right_lane_wp = map.get_waypoint(ego_loc + ego_vehicle.get_transform().get_right_vector() * ego_wp.lane_width)
-    lights = world.get_traffic_lights_from_waypoint(right_lane_wp,10)
+    lights = world.get_traffic_lights_from_waypoint(carla_waypoint(right_lane_wp),10)
     if len(lights) > 0:
         return (True, lights[0].get_state() == carla.TrafficLightState.Green)
     else:
         return (False, False)
     
-def within_box_in_front_of_vehicle(from_vehicle: carla.Actor,other_vehicle: carla.Actor,box_length: float,world):
-    
+# Columns of the per-tick actor geometry array used by the batched oracles
+GEOMETRY_X = 0
+GEOMETRY_Y = 1
+GEOMETRY_Z = 2
+GEOMETRY_YAW = 3
+GEOMETRY_EXTENT_X = 4
+GEOMETRY_EXTENT_Y = 5
+GEOMETRY_SPEED = 6
+GEOMETRY_PITCH = 7
+GEOMETRY_ROLL = 8
+
+# Returns an (N,9) array of x, y, z, yaw (degrees), bounding box extent x and y, speed, pitch and roll (degrees)
+# for each actor
+def actor_geometry_array(actors: List[carla.Actor]):
+    geometry = np.zeros((len(actors),9))
+    for i, actor in enumerate(actors):
+        transform = actor.get_transform()
+        extent = actor.bounding_box.extent
+        geometry[i] = (transform.location.x,transform.location.y,transform.location.z,transform.rotation.yaw,
+                       extent.x,extent.y,actor.get_velocity().length(),transform.rotation.pitch,transform.rotation.roll)
+    return geometry
+
+# Forward, right and up unit vectors, each (...,3), of rotations given in degrees, as carla.Rotation computes them
+def _axis_vectors(pitch,yaw,roll):
+    cp, sp = np.cos(np.radians(pitch)), np.sin(np.radians(pitch))
+    cy, sy = np.cos(np.radians(yaw)), np.sin(np.radians(yaw))
+    cr, sr = np.cos(np.radians(roll)), np.sin(np.radians(roll))
+    forward = np.stack(np.broadcast_arrays(cp * cy,cp * sy,sp),axis=-1)
+    right = np.stack(np.broadcast_arrays(cy * sp * sr - sy * cr,sy * sp * sr + cy * cr,-cp * sr),axis=-1)
+    up = np.stack(np.broadcast_arrays(-cy * sp * cr - sy * sr,-sy * sp * cr + cy * sr,cp * cr),axis=-1)
+    return forward, right, up
+
+# Returns the (N,4,3) corners of each actor's bounding box footprint, in the plane through its location
+def _geometry_corners(geometry: np.ndarray):
+    forward, right, _ = _axis_vectors(geometry[:,GEOMETRY_PITCH],geometry[:,GEOMETRY_YAW],geometry[:,GEOMETRY_ROLL])
+    forward_signs = np.array([1,-1,-1,1])
+    right_signs = np.array([1,1,-1,-1])
+    forward_offsets = forward_signs * geometry[:,GEOMETRY_EXTENT_X,None]
+    right_offsets = right_signs * geometry[:,GEOMETRY_EXTENT_Y,None]
+    return (geometry[:,None,GEOMETRY_X:GEOMETRY_Z + 1] + forward_offsets[:,:,None] * forward[:,None,:]
+            + right_offsets[:,:,None] * right[:,None,:])
+
+# Vectorised BoundingBox.contains for a box centred on centre and rotated by rotation
+def _points_in_box(points: np.ndarray,centre: carla.Location,rotation: carla.Rotation,extent: carla.Vector3D):
+    forward, right, up = _axis_vectors(rotation.pitch,rotation.yaw,rotation.roll)
+    relative = points - np.array([centre.x,centre.y,centre.z])
+    return ((np.abs(relative @ forward) <= extent.x) & (np.abs(relative @ right) <= extent.y)
+            & (np.abs(relative @ up) <= extent.z))
+
+# Rows of geometry that could reach within reach of centre on the x-y plane, or all rows without an index
+def _nearby_rows(geometry: np.ndarray,index: SpatialGrid,centre: carla.Location,reach: float):
+    if index == None or len(geometry) == 0:
+        return None
+    half_diagonal = np.hypot(geometry[:,GEOMETRY_EXTENT_X],geometry[:,GEOMETRY_EXTENT_Y]).max()
+    return index.query_radius(np.array([centre.x,centre.y]),reach + half_diagonal)
+
+def _scatter_mask(rows: np.ndarray,row_mask: np.ndarray,size: int):
+    mask = np.zeros(size,dtype=bool)
+    mask[rows] = row_mask
+    return mask
+
+# Mask over the rows of an actor_geometry_array of actors with a bounding box corner in the box_length long box
+# in front of from_vehicle. index should be a SpatialGrid over the same rows to skip actors too far away to matter.
+def within_box_in_front_mask(from_vehicle: carla.Actor,geometry: np.ndarray,box_length: float,world,index: SpatialGrid = None):
     extents = from_vehicle.bounding_box.extent
     transform = from_vehicle.get_transform()
-    centre = transform.location
-    direction_vector = transform.get_forward_vector()
-
-    other_loc = other_vehicle.get_location()
-    other_bb = other_vehicle.bounding_box.extent
-    other_forward = other_vehicle.get_transform().get_forward_vector()
-    other_right = other_vehicle.get_transform().get_right_vector()
-    points_to_check = [other_loc + other_bb.x * other_forward + other_bb.y * other_right,
-                       other_loc + -other_bb.x * other_forward + other_bb.y * other_right,
-                       other_loc + -other_bb.x * other_forward + -other_bb.y * other_right,
-                       other_loc + other_bb.x * other_forward + -other_bb.y * other_right]
-
-    box = carla.BoundingBox(carla.Vector3D(0,0,0),
-                            carla.Vector3D((box_length/2),extents.y,2 * extents.z))
-    world.debug.draw_box(carla.BoundingBox(centre + direction_vector * (extents.x + box_length/2),carla.Vector3D((box_length/2),extents.y,2 * extents.z)),transform.rotation,life_time=0.1)
-    return any(box.contains(p,carla.Transform(centre + direction_vector * (extents.x + box_length/2),transform.rotation)) for p in points_to_check)
+    box_centre = transform.location + transform.get_forward_vector() * (extents.x + box_length/2)
+    box_extent = carla.Vector3D((box_length/2),extents.y,2 * extents.z)
+    world.debug.draw_box(carla.BoundingBox(box_centre,box_extent),transform.rotation,life_time=0.1)
+    rows = _nearby_rows(geometry,index,transform.location,np.linalg.norm([extents.x + box_length,extents.y,2 * extents.z]))
+    if rows is not None:
+        in_box = _points_in_box(_geometry_corners(geometry[rows]),box_centre,transform.rotation,box_extent).any(axis=1)
+        return _scatter_mask(rows,in_box,len(geometry))
+    return _points_in_box(_geometry_corners(geometry),box_centre,transform.rotation,box_extent).any(axis=1)
+
+# Mask over the rows of an actor_geometry_array of actors the ego is faster than that are within overtaking
+# range: beside it to the left, or in the box in front of it
+def vehicle_in_overtake_range_mask(ego_vehicle,geometry: np.ndarray,world,index: SpatialGrid = None):
+    ego_trans = ego_vehicle.get_transform()
+    overtake_distance = 10
+    extents = ego_vehicle.bounding_box.extent
+    rows = _nearby_rows(geometry,index,ego_trans.location,max(3.5 * extents.y + np.linalg.norm([overtake_distance,2.5 * extents.y,extents.z]),
+                                                              np.linalg.norm([overtake_distance/2,extents.y,2 * extents.z])))
+    if rows is not None:
+        return _scatter_mask(rows,vehicle_in_overtake_range_mask(ego_vehicle,geometry[rows],world),len(geometry))
+    side_centre = ego_vehicle.get_location() - ego_trans.get_right_vector() * extents.y * 3.5
+    in_side_box = _points_in_box(geometry[:,GEOMETRY_X:GEOMETRY_Z + 1],side_centre,ego_trans.rotation,
+                                 carla.Vector3D(overtake_distance,2.5 * extents.y,extents.z))
+    faster = ego_vehicle.get_velocity().length() > geometry[:,GEOMETRY_SPEED]
+    return faster & (in_side_box | within_box_in_front_mask(ego_vehicle,geometry,overtake_distance/2 - extents.x,world))
 
 def stoppingDistance(speed):
     # Stopping distance = thinking distance + braking distance
@@ -140,31 +210,52 @@ def currentJunction(ego,map):
     ego_waypoint = map.get_waypoint(ego.get_location())
     return ego_waypoint.get_junction()
 
-def getJunctionStatus(ego,junction):
-    
-    waypoints = junction.get_waypoints(carla.LaneType.Driving)
-    entrypoints = [t[0] for t in waypoints]
-    dist_sorted = sorted(entrypoints,key = lambda x: [(ego.get_transform().location - x.transform.location).length()])
-    entrypoint = dist_sorted[0]
+def getJunctionStatus(ego,junction,topology_cache: JunctionTopologyCache = None):
+    if topology_cache == None:
+        topology = JunctionTopology(junction)
+    else:
+        topology = topology_cache.get(junction)
+    entry = topology.get_entry(topology.nearest_entrypoint_index(ego.get_transform().location))
+    if entry.status == None:
+        entry.status, entry.partitioned_junction = get_entry_junction_status(topology,entry)
+    return entry.status, entry.partitioned_junction
+
+# Raised when the map doesn't give a junction entry enough lanes around it to work out its status
+class JunctionStatusError(Exception):
+    pass
+
+def get_entry_junction_status(topology: JunctionTopology,entry: JunctionEntry):
+    entrypoints = topology.entrypoints
+    entrypoint = entry.entrypoint
 
     straight_path = False
     other_path = False
     location = entrypoint.transform.location
-    destinations_from_entrypoint = [w[1] for w in waypoints if (w[0].transform.location - location).length() < 0.01]
-    direction_vector = location - entrypoint.previous(10)[0].transform.location
+    destinations_from_entrypoint = entry.destinations
+    previous_waypoints = entrypoint.previous(10)
+    if len(previous_waypoints) == 0:
+        raise JunctionStatusError("No lane leads into junction "+str(topology.id)+" at "+str(location))
+    direction_vector = location - previous_waypoints[0].transform.location
+    # The junction is partitioned in the ground plane, which needs the entry lane to point somewhere in it
+    if np.hypot(direction_vector.x,direction_vector.y) < 1e-6:
+        raise JunctionStatusError("Entry lane of junction "+str(topology.id)+" at "+str(location)+" has no horizontal direction")
     direction_vector = direction_vector / direction_vector.length()
     right_direction_vector = direction_vector.cross(carla.Vector3D(0,0,1))
     
     roundabout = True
     for d in destinations_from_entrypoint:
-        possible_next_junction = d.next(10)[0].get_junction()
-        if possible_next_junction == None or possible_next_junction.id == junction.id:
+        next_waypoints = d.next(10)
+        if len(next_waypoints) == 0:
+            raise JunctionStatusError("No lane leads out of junction "+str(topology.id)+" at "+str(d.transform.location))
+        possible_next_junction = next_waypoints[0].get_junction()
+        if possible_next_junction == None or possible_next_junction.id == topology.id:
             roundabout = False
 
         if (d.transform.location - (location + direction_vector * (d.transform.location - location).length())).length() < 1:
             straight_path = True
         else:
             other_path = True
+    entry.roundabout = roundabout
 
     sorted_other_entrances = sorted(
         [e for e in entrypoints if (e.transform.location - entrypoint.transform.location).length() > 0.1],
@@ -173,8 +264,9 @@ def getJunctionStatus(ego,junction):
 
     if roundabout:
         return JunctionStates.ROUNDABOUT, None
+    if other_path and len(sorted_other_entrances) == 0:
+        raise JunctionStatusError("Junction "+str(topology.id)+" has a turn but no other entrance")
     if straight_path and other_path:
-        assert len(sorted_other_entrances) > 0
         closest_other_entrance = sorted_other_entrances[0]
         cross_point = get_vector_intersection(entrypoint.transform.location - right_direction_vector * (entrypoint.lane_width),
                                 direction_vector,
@@ -182,7 +274,6 @@ def getJunctionStatus(ego,junction):
                                 right_direction_vector)
         return JunctionStates.T_ON_MAJOR, PartitionedJunction(cross_point,-1 * right_direction_vector,direction_vector)
     elif other_path:
-        assert len(sorted_other_entrances) > 0
         closest_other_entrance = sorted_other_entrances[0]
         cross_point = get_vector_intersection(entrypoint.transform.location + right_direction_vector * (entrypoint.lane_width),
                                 direction_vector,
@@ -191,6 +282,26 @@ def getJunctionStatus(ego,junction):
         return JunctionStates.T_ON_MINOR, PartitionedJunction(cross_point,-1 * direction_vector,-1 * right_direction_vector)
     else:
         return JunctionStates.UNKNOWN, None
+
+# Fills the junction topology cache for every junction on the map so none are computed mid-run. Entries whose
+# status can't be worked out are left unresolved, to be computed if an actor ever reaches them.
+def precompute_junction_topologies(map: carla.Map,topology_cache: JunctionTopologyCache):
+    for segment in map.get_topology():
+        for waypoint in segment:
+            if not waypoint.is_junction:
+                continue
+            junction = waypoint.get_junction()
+            if junction == None or junction.id in topology_cache:
+                continue
+            topology = topology_cache.get(junction)
+            topology.road_graph = get_junction_road_graph(topology.bounding_box,topology.waypoints)
+            for e in topology.entrypoints:
+                entry = topology.get_entry(topology.nearest_entrypoint_index(e.transform.location))
+                if entry.status == None:
+                    try:
+                        entry.status, entry.partitioned_junction = get_entry_junction_status(topology,entry)
+                    except JunctionStatusError:
+                        entry.status, entry.partitioned_junction = None, None
     
 def get_vector_intersection(b1,v1,b2,v2):
     return (np.matrix([[v1.x,-v2.x],[v1.y,-v2.y]]).I @ np.matrix([[b2.x-b1.x],[b2.y-b1.x]])).getA()[0][0] * v2 + b2
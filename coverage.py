@@ -1,11 +1,13 @@
-import numpy
+import numpy as np
 import assertion
 from enum import Enum
-from typing import List, Tuple, Callable
+from typing import Dict, List, Tuple, Callable
 import os
+import io
 import csv
 from coverage_variables import *
 from validity_requirements import ValidityRequirement
+from persistence import AsyncWriter
 
 class CoverageStates(Enum):
     BUG = 0
@@ -17,44 +19,107 @@ class CoverageVariableSet:
     # enumerations should be of type List[(CoverageVariable,Enum)] specifying the variable key and type of enum expected
     def __init__(self,variables: List[Tuple[CoverageVariable,Enum]]):
         self.variables = variables
+        self._variable_indices = {}
+        for i, v in enumerate(variables):
+            self._variable_indices.setdefault(v[0],i)
+        self._members = [list(v[1]) for v in variables]
+        self._ordinals = [{m: j for j, m in enumerate(members)} for members in self._members]
+
+        # Macro-bin keys are mixed-radix integers of the enum ordinals, the first variable is the least significant digit
+        self.radices = [len(members) for members in self._members]
+        self.strides = []
+        stride = 1
+        for radix in self.radices:
+            self.strides.append(stride)
+            stride *= radix
+        self.key_count = stride
 
     # Returns concrete enum for coverage variable (first instance)
     def get_enum_of_variable(self,variable: CoverageVariable):
-        return next(x[1] for x in self.variables if x[0] == variable)
+        return self.variables[self._variable_indices[variable]][1]
+
+    def get_variable_index(self,variable: CoverageVariable):
+        return self._variable_indices[variable]
+
+    def get_ordinal(self,variable_index: int,value: Enum):
+        return self._ordinals[variable_index][value]
 
-    def get_coverage_entry_key(self,parameterised_enumerations: List[Tuple[CoverageVariable,Enum]]):
-        entry = [None for _ in range(len(self.variables))]
+    # Integer key of a macro-bin from its (variable, value) pairs, in any order
+    def encode_key(self,parameterised_enumerations: List[Tuple[CoverageVariable,Enum]]):
         assert(len(parameterised_enumerations) == len(self.variables))
+        key = 0
         for e in parameterised_enumerations:
-            var_name_index = [v[0] for v in self.variables].index(e[0])
-            if type(e[1]) is self.variables[var_name_index][1]:
-                entry[var_name_index] = e[1]
-            else:
+            var_name_index = self._variable_indices[e[0]]
+            ordinal = self._ordinals[var_name_index].get(e[1])
+            if ordinal == None or not (type(e[1]) is self.variables[var_name_index][1]):
                 raise Exception("Incorrect type")
-        return tuple(entry)
+            key += ordinal * self.strides[var_name_index]
+        return key
+
+    # Encodes a key tuple in variable order, as returned by decode_key
+    def encode_key_tuple(self,entry: Tuple[Enum]):
+        key = 0
+        for i, value in enumerate(entry):
+            if not isinstance(value,Enum):
+                value = self.variables[i][1](value)
+            key += self._ordinals[i][value] * self.strides[i]
+        return key
+
+    def get_key_ordinals(self,key: int):
+        return [(key // stride) % radix for stride, radix in zip(self.strides,self.radices)]
+
+    def decode_key(self,key: int):
+        return tuple(self._members[i][ordinal] for i, ordinal in enumerate(self.get_key_ordinals(key)))
 
 
+# Coverage is persisted as a CSV snapshot plus an append-only journal of (macro-bin key, micro-bin, state) records
+# next to it. Changes are only appended to the journal, which is folded back into the snapshot once it grows
+# past compaction_threshold records or the number of macro-bins, whichever is larger. Files are written
+# through writer on a background thread when one is given.
 class Coverage:
-    def __init__(self,coverage_file_path: str,assertions: List[assertion.Assertion],coverage_variable_set: CoverageVariableSet):
+    def __init__(self,coverage_file_path: str,assertions: List[assertion.Assertion],coverage_variable_set: CoverageVariableSet,
+                 compaction_threshold: int = 1000,writer: AsyncWriter = None):
         self.coverage_variable_set = coverage_variable_set
         self.micro_bin_ids = [get_micro_bin_id(a) for a in assertions]
         self.micro_bin_count = len(assertions)
+        self._micro_bin_indices = {b: i for i, b in enumerate(self.micro_bin_ids)}
         self.total_size = self.get_total_size(assertions,self.coverage_variable_set)
         self.coverage_file_path = coverage_file_path
+        self.journal_file_path = get_journal_path(coverage_file_path)
+        self.compaction_threshold = compaction_threshold
+        self.writer = writer
+        self._journal_length = 0
+        self._change_listeners: List[Callable[[int,np.ndarray],None]] = []
 
+        # Macro-bin key (see CoverageVariableSet.encode_key) to a uint8 array of CoverageStates values per micro-bin
         if os.path.isfile(coverage_file_path):
             self._covered_cases = self.parse_coverage_file()
         else:
             self._covered_cases = {}
+        if os.path.isfile(self.journal_file_path):
+            self.replay_journal()
             self.write_coverage()
+        elif not os.path.isfile(coverage_file_path):
+            self.write_coverage()
+        self._count_cases()
 
-    def get_num_cases(self):
-        violated = 0
-        covered = 0
+    def _count_cases(self):
+        self._violated_count = 0
+        self._covered_count = 0
         for macro_case in self._covered_cases.values():
-            violated += len([micro_case for micro_case in macro_case if micro_case == CoverageStates.BUG])
-            covered += len([micro_case for micro_case in macro_case if (micro_case == CoverageStates.COVERED or micro_case == CoverageStates.BUG)])
-        return self.total_size, violated, covered
+            self._violated_count += int(np.count_nonzero(macro_case == BUG))
+            self._covered_count += int(np.count_nonzero(macro_case <= COVERED))
+
+    def get_num_cases(self):
+        return self.total_size, self._violated_count, self._covered_count
+
+    # Number of covered micro-bins (BUG or COVERED) in macro-bins with each value of each variable, as one
+    # array per variable indexed by enum ordinal
+    def get_level_counts(self):
+        keys = np.fromiter(self._covered_cases.keys(),dtype=np.int64,count=len(self._covered_cases))
+        covered = np.fromiter((np.count_nonzero(s <= COVERED) for s in self._covered_cases.values()),dtype=np.int64,count=len(self._covered_cases))
+        variable_set = self.coverage_variable_set
+        return [np.bincount((keys // stride) % radix,weights=covered,minlength=radix).astype(np.int64) for stride, radix in zip(variable_set.strides,variable_set.radices)]
     
     def get_total_size(self,assertions: List[assertion.Assertion],coverage_set: CoverageVariableSet):
         size = 0
@@ -76,66 +141,184 @@ class Coverage:
     
     # enumerations should be of type List[(CoverageVariable,Enum)] (should be concrete Enum e.g RainTags)
     def try_cover(self,enumerated_vars: List[Tuple[CoverageVariable,Enum]],violated_assertions: List[assertion.Assertion],covered_assertions: List[assertion.Assertion],valid_assertions: List[assertion.Assertion]):
-        key = self.coverage_variable_set.get_coverage_entry_key(enumerated_vars)
-        
+        key = self.coverage_variable_set.encode_key(enumerated_vars)
+        new_covered_cases, _ = self.try_cover_bits(key,self.get_bin_bits(valid_assertions),self.get_bin_bits(covered_assertions),self.get_bin_bits(violated_assertions))
+        return new_covered_cases
+
+    # Bitset with bit i set for micro-bin i of each assertion
+    def get_bin_bits(self,assertions: List[assertion.Assertion]):
+        bits = 0
+        for a in assertions:
+            bits |= 1 << self._micro_bin_indices[get_micro_bin_id(a)]
+        return bits
+
+    # Updates the macro-bin with the given key from the tick's results as bitsets over micro-bin indices (see
+    # get_bin_bits or Assertion.bin_index). Only the set bits are visited. Returns the number of newly covered
+    # micro-bins and the indices of the micro-bins whose state changed.
+    def try_cover_bits(self,key: int,valid_bits: int,covered_bits: int,violated_bits: int):
         new_case = False
-        new_uncovered = False
         new_covered_cases = 0
-        
+        changed_bins = []
+
         if not (key in self._covered_cases):
-            self._covered_cases[key] = [CoverageStates.INVALID for _ in range(len(self.micro_bin_ids))]
+            self._covered_cases[key] = np.full(self.micro_bin_count,INVALID,dtype=np.uint8)
             new_case = True
-        
-        for i, bin_id in enumerate(self.micro_bin_ids):
-            state = self._covered_cases[key][i]
-            if bin_id in [get_micro_bin_id(x) for x in valid_assertions] and state == CoverageStates.INVALID:
-                self._covered_cases[key][i] = CoverageStates.UNCOVERED
-                new_uncovered = True
-            
-            if bin_id in [get_micro_bin_id(x) for x in violated_assertions] and (state == CoverageStates.COVERED or state == CoverageStates.UNCOVERED):
-                if state == CoverageStates.UNCOVERED:
+            changed_bins = list(range(self.micro_bin_count))
+        states = self._covered_cases[key]
+
+        bits = valid_bits | covered_bits | violated_bits
+        while bits:
+            bit = bits & -bits
+            bits ^= bit
+            i = bit.bit_length() - 1
+            state = states[i]
+            if valid_bits & bit and state == INVALID:
+                states[i] = UNCOVERED
+                changed_bins.append(i)
+
+            if violated_bits & bit and (state == COVERED or state == UNCOVERED):
+                if state == UNCOVERED:
                     new_covered_cases += 1
-                self._covered_cases[key][i] = CoverageStates.BUG
+                    self._covered_count += 1
+                self._violated_count += 1
+                states[i] = BUG
                 new_case = True
-            elif bin_id in [get_micro_bin_id(x) for x in covered_assertions] and state == CoverageStates.UNCOVERED:
-                self._covered_cases[key][i] = CoverageStates.COVERED
+                changed_bins.append(i)
+            elif covered_bits & bit and state == UNCOVERED:
+                states[i] = COVERED
+                self._covered_count += 1
                 new_case = True
                 new_covered_cases += 1
-            
+                changed_bins.append(i)
+
+        if len(changed_bins) > 0:
+            changed_bins = sorted(set(changed_bins))
+            self.append_to_journal(key,changed_bins)
+            self.notify_change_listeners(key)
         if new_case:
-            self.write_coverage()
             self.print_coverage()
-        elif new_uncovered:
-            self.write_coverage()
+        return new_covered_cases, changed_bins
+
+    # Folds the micro-bin states of a macro-bin recorded by another Coverage over the same assertions into
+    # this one, each micro-bin keeps the lower of the two states. Returns the number of newly covered micro-bins.
+    def merge_case(self,key: int,states: np.ndarray):
+        assert(len(states) == self.micro_bin_count)
+        if not (key in self._covered_cases):
+            self._covered_cases[key] = np.full(self.micro_bin_count,INVALID,dtype=np.uint8)
+            changed_bins = np.arange(self.micro_bin_count)
+        else:
+            changed_bins = np.flatnonzero(states < self._covered_cases[key])
+        current = self._covered_cases[key]
+        lowered = np.minimum(current[changed_bins],states[changed_bins])
+        new_covered_cases = int(np.count_nonzero((lowered <= COVERED) & (current[changed_bins] > COVERED)))
+        self._violated_count += int(np.count_nonzero((lowered == BUG) & (current[changed_bins] != BUG)))
+        self._covered_count += new_covered_cases
+        current[changed_bins] = lowered
+
+        if len(changed_bins) > 0:
+            self.append_to_journal(key,changed_bins.tolist())
+            self.notify_change_listeners(key)
         return new_covered_cases
+
+    # Adds or replaces macro-bins without journaling them, they are persisted by the next write_coverage
+    def load_cases(self,cases: Dict[int,np.ndarray]):
+        for key, states in cases.items():
+            assert(len(states) == self.micro_bin_count)
+            self._covered_cases[key] = states.astype(np.uint8)
+        self._count_cases()
+
+    # listener(key, states) is called with a copy of the micro-bin states of a macro-bin whenever they change
+    def add_change_listener(self,listener: Callable[[int,np.ndarray],None]):
+        self._change_listeners.append(listener)
+
+    def notify_change_listeners(self,key: int):
+        for listener in self._change_listeners:
+            listener(key,self._covered_cases[key].copy())
+
+    def append_to_journal(self,key: int,changed_bins: List[int]):
+        key_cells = self.get_key_cells(key)
+        records = io.StringIO()
+        writer = csv.writer(records)
+        for i in changed_bins:
+            writer.writerow(key_cells + [self.micro_bin_ids[i],CoverageStates(int(self._covered_cases[key][i])).name])
+        if self.writer != None:
+            self.writer.append(self.journal_file_path,records.getvalue())
+        else:
+            with open(self.journal_file_path, 'a', newline='') as journalfile:
+                journalfile.write(records.getvalue())
+        self._journal_length += len(changed_bins)
+        if self._journal_length >= max(self.compaction_threshold,len(self._covered_cases)):
+            self.write_coverage()
+
+    # Folds journal records into the loaded cases, a truncated last record from a crash is ignored
+    def replay_journal(self):
+        headers = self.get_csv_header(include_micro_bins=False)
+        with open(self.journal_file_path, 'r', newline='') as journalfile:
+            for record in csv.reader(journalfile):
+                try:
+                    key = self.parse_key_cells(record[:len(headers)],headers)
+                    bin_id = record[len(headers)]
+                    state = CoverageStates[record[len(headers) + 1]]
+                except (IndexError, KeyError, ValueError):
+                    continue
+                if not (bin_id in self._micro_bin_indices):
+                    continue
+                if not (key in self._covered_cases):
+                    self._covered_cases[key] = np.full(self.micro_bin_count,INVALID,dtype=np.uint8)
+                i = self._micro_bin_indices[bin_id]
+                self._covered_cases[key][i] = min(self._covered_cases[key][i],state.value)
     
-    # TODO: change so only rewrites whole file if existing row edited
+    # Writes the full snapshot and empties the journal
     def write_coverage(self):
         fieldnames = self.get_csv_header()
-        with open(self.coverage_file_path, 'w', newline='') as coveragefile:
-            writer = csv.writer(coveragefile)
-            writer.writerow(fieldnames)
-            for key in self._covered_cases:
-                row = [convert_criteria_value_cell(x) for x in list(key)]
-                row.extend([x.name for x in list(self._covered_cases[key])])
-                writer.writerow(row)
+        snapshot = io.StringIO()
+        writer = csv.writer(snapshot)
+        writer.writerow(fieldnames)
+        for key in self._covered_cases:
+            writer.writerow(self.get_case_row(key))
+        if self.writer != None:
+            self.writer.write(self.coverage_file_path,snapshot.getvalue())
+            # The journal still holds the changes if the snapshot can't be written
+            self.writer.remove(self.journal_file_path,after=self.coverage_file_path)
+        else:
+            temporary_path = self.coverage_file_path + ".tmp"
+            with open(temporary_path, 'w', newline='') as coveragefile:
+                coveragefile.write(snapshot.getvalue())
+            os.replace(temporary_path,self.coverage_file_path)
+            if os.path.isfile(self.journal_file_path):
+                os.remove(self.journal_file_path)
+        self._journal_length = 0
 
         
     def parse_coverage_file(self):
         covered_cases = {}
-        with open(self.coverage_file_path, 'r', newline='') as coveragefile:
-            reader = csv.reader(coveragefile)
-            data = list(reader)
-            headers = data[0]
-            cov_criteria_len = len(self.get_csv_header(include_micro_bins=False))
-            for i in range(1,len(data),1):
-                new_key = data[i][:cov_criteria_len]
-                for j in range(len(new_key)):
-                    new_key[j] = self.parse_criteria_cell(new_key[j],headers[j])
-                new_key = tuple(new_key)
-                new_data = [CoverageStates[x] for x in data[i][cov_criteria_len:]]
-                covered_cases[new_key] = new_data
+        for key_headers, bin_ids, key_cells, state_cells in read_coverage_file(self.coverage_file_path):
+            new_key = self.parse_key_cells(key_cells,key_headers)
+            covered_cases[new_key] = self.parse_state_cells(state_cells,bin_ids)
         return covered_cases
+
+    # Conversions between the in-memory representation and CSV cells
+    def get_key_cells(self,key: int):
+        return [convert_criteria_value_cell(x) for x in self.coverage_variable_set.decode_key(key)]
+
+    def get_case_row(self,key: int):
+        return self.get_key_cells(key) + [STATE_NAMES[x] for x in self._covered_cases[key]]
+
+    def parse_key_cells(self,cells: List[str],headers: List[str]):
+        return self.coverage_variable_set.encode_key_tuple(tuple(self.parse_criteria_cell(cells[j],headers[j]) for j in range(len(cells))))
+
+    # Missing micro-bins, from assertions added since the file was written, are INVALID. Cells are matched
+    # to micro-bins by bin_ids when given, otherwise by position, and columns for unknown micro-bins are dropped.
+    def parse_state_cells(self,cells: List[str],bin_ids: List[str] = None):
+        states = np.full(self.micro_bin_count,INVALID,dtype=np.uint8)
+        if bin_ids == None:
+            for i, cell in enumerate(cells[:self.micro_bin_count]):
+                states[i] = CoverageStates[cell].value
+        else:
+            for bin_id, cell in zip(bin_ids,cells):
+                if bin_id in self._micro_bin_indices:
+                    states[self._micro_bin_indices[bin_id]] = CoverageStates[cell].value
+        return states
     
     def parse_criteria_cell(self,cell: str,header_var: str):
         if cell.isdigit():
@@ -149,6 +332,52 @@ class Coverage:
             fieldnames.extend(self.micro_bin_ids)
         return fieldnames
     
+BUG = CoverageStates.BUG.value
+COVERED = CoverageStates.COVERED.value
+UNCOVERED = CoverageStates.UNCOVERED.value
+INVALID = CoverageStates.INVALID.value
+STATE_NAMES = [s.name for s in sorted(CoverageStates,key=lambda s: s.value)]
+
+def get_journal_path(coverage_file_path: str):
+    return coverage_file_path + ".journal"
+
+# Splits a coverage file header into the coverage variable columns that make up the macro-bin key
+# and the micro-bin ids that follow them
+def split_coverage_header(header: List[str]):
+    key_column_count = 0
+    while key_column_count < len(header) and header[key_column_count] in CoverageVariable.__members__:
+        key_column_count += 1
+    return header[:key_column_count], header[key_column_count:]
+
+# Returns the (key headers, micro-bin ids) of a coverage snapshot, or None if the file is empty
+def read_coverage_header(path: str):
+    with open(path, 'r', newline='') as coveragefile:
+        header = next(csv.reader(coveragefile),None)
+    if header == None:
+        return None
+    return split_coverage_header(header)
+
+# Streams (key headers, micro-bin ids, key cells, state cells) for each row of a coverage snapshot
+def read_coverage_file(path: str):
+    with open(path, 'r', newline='') as coveragefile:
+        reader = csv.reader(coveragefile)
+        header = next(reader,None)
+        if header == None:
+            return
+        key_headers, bin_ids = split_coverage_header(header)
+        for row in reader:
+            if len(row) < len(key_headers):
+                continue
+            yield key_headers, bin_ids, row[:len(key_headers)], row[len(key_headers):]
+
+# Streams (key cells, micro-bin id, state name) for each record of a coverage journal
+def read_journal_file(path: str):
+    with open(path, 'r', newline='') as journalfile:
+        for record in csv.reader(journalfile):
+            if len(record) < 3:
+                continue
+            yield record[:-2], record[-2], record[-1]
+
 def get_micro_bin_id(assertion: assertion.Assertion):
     return str(assertion.ruleNumber)+"."+str(assertion.subcase)
 
@@ -0,0 +1,1174 @@
+import copy
+import math
+import time
+import numpy as np
+from enum import IntEnum, IntFlag
+from fnmatch import fnmatch
+from typing import Callable, Dict, List, Tuple
+
+# In-process stand-in for the carla Python API, selected through carla_backend. Value types behave like the
+# simulator's, and Client connects to a simulation of a procedurally built grid town run on the calling thread.
+# Only the parts of the API this repository calls are provided.
+
+class Vector3D:
+    def __init__(self,x: float = 0.0,y: float = 0.0,z: float = 0.0):
+        self.x = float(x)
+        self.y = float(y)
+        self.z = float(z)
+
+    def __add__(self,other):
+        return type(self)(self.x + other.x,self.y + other.y,self.z + other.z)
+
+    def __sub__(self,other):
+        return type(self)(self.x - other.x,self.y - other.y,self.z - other.z)
+
+    def __mul__(self,scalar: float):
+        return type(self)(self.x * scalar,self.y * scalar,self.z * scalar)
+
+    def __rmul__(self,scalar: float):
+        return self * scalar
+
+    def __truediv__(self,scalar: float):
+        return type(self)(self.x / scalar,self.y / scalar,self.z / scalar)
+
+    def __neg__(self):
+        return type(self)(-self.x,-self.y,-self.z)
+
+    def __eq__(self,other):
+        return isinstance(other,Vector3D) and self.x == other.x and self.y == other.y and self.z == other.z
+
+    def __hash__(self):
+        return hash((self.x,self.y,self.z))
+
+    def __repr__(self):
+        return type(self).__name__+"(x="+str(self.x)+", y="+str(self.y)+", z="+str(self.z)+")"
+
+    def length(self):
+        return math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
+    def squared_length(self):
+        return self.x * self.x + self.y * self.y + self.z * self.z
+
+    def distance(self,other):
+        return (self - other).length()
+
+    def dot(self,other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def cross(self,other):
+        return type(self)(self.y * other.z - self.z * other.y,self.z * other.x - self.x * other.z,self.x * other.y - self.y * other.x)
+
+    def make_unit_vector(self):
+        length = self.length()
+        if length == 0:
+            return type(self)(self.x,self.y,self.z)
+        return self / length
+
+class Location(Vector3D):
+    pass
+
+class Vector2D:
+    def __init__(self,x: float = 0.0,y: float = 0.0):
+        self.x = float(x)
+        self.y = float(y)
+
+    def __add__(self,other):
+        return Vector2D(self.x + other.x,self.y + other.y)
+
+    def __sub__(self,other):
+        return Vector2D(self.x - other.x,self.y - other.y)
+
+    def __mul__(self,scalar: float):
+        return Vector2D(self.x * scalar,self.y * scalar)
+
+    def __rmul__(self,scalar: float):
+        return self * scalar
+
+    def __truediv__(self,scalar: float):
+        return Vector2D(self.x / scalar,self.y / scalar)
+
+    def __eq__(self,other):
+        return isinstance(other,Vector2D) and self.x == other.x and self.y == other.y
+
+    def __repr__(self):
+        return "Vector2D(x="+str(self.x)+", y="+str(self.y)+")"
+
+    def length(self):
+        return math.hypot(self.x,self.y)
+
+class Rotation:
+    def __init__(self,pitch: float = 0.0,yaw: float = 0.0,roll: float = 0.0):
+        self.pitch = float(pitch)
+        self.yaw = float(yaw)
+        self.roll = float(roll)
+
+    def __eq__(self,other):
+        return isinstance(other,Rotation) and self.pitch == other.pitch and self.yaw == other.yaw and self.roll == other.roll
+
+    def __repr__(self):
+        return "Rotation(pitch="+str(self.pitch)+", yaw="+str(self.yaw)+", roll="+str(self.roll)+")"
+
+    # Axis vectors follow the simulator's left handed, z up convention
+    def get_forward_vector(self):
+        cp, sp, cy, sy = _rotation_terms(self)
+        return Vector3D(cp * cy,cp * sy,sp)
+
+    def get_right_vector(self):
+        cp, sp, cy, sy = _rotation_terms(self)
+        cr = math.cos(math.radians(self.roll))
+        sr = math.sin(math.radians(self.roll))
+        return Vector3D(cy * sp * sr - sy * cr,sy * sp * sr + cy * cr,-cp * sr)
+
+    def get_up_vector(self):
+        cp, sp, cy, sy = _rotation_terms(self)
+        cr = math.cos(math.radians(self.roll))
+        sr = math.sin(math.radians(self.roll))
+        return Vector3D(-cy * sp * cr - sy * sr,-sy * sp * cr + cy * sr,cp * cr)
+
+def _rotation_terms(rotation: Rotation):
+    pitch = math.radians(rotation.pitch)
+    yaw = math.radians(rotation.yaw)
+    return math.cos(pitch), math.sin(pitch), math.cos(yaw), math.sin(yaw)
+
+class Transform:
+    def __init__(self,location: Location = None,rotation: Rotation = None):
+        self.location = Location() if location == None else Location(location.x,location.y,location.z)
+        self.rotation = Rotation() if rotation == None else rotation
+
+    def __repr__(self):
+        return "Transform("+repr(self.location)+", "+repr(self.rotation)+")"
+
+    def get_forward_vector(self):
+        return self.rotation.get_forward_vector()
+
+    def get_right_vector(self):
+        return self.rotation.get_right_vector()
+
+    def get_up_vector(self):
+        return self.rotation.get_up_vector()
+
+    def transform(self,point: Vector3D):
+        return Location(self.location.x,self.location.y,self.location.z) + self.get_forward_vector() * point.x + self.get_right_vector() * point.y + self.get_up_vector() * point.z
+
+    # Point in the local frame of the transform
+    def inverse_transform(self,point: Vector3D):
+        relative = Vector3D(point.x - self.location.x,point.y - self.location.y,point.z - self.location.z)
+        return Location(relative.dot(self.get_forward_vector()),relative.dot(self.get_right_vector()),relative.dot(self.get_up_vector()))
+
+class BoundingBox:
+    def __init__(self,location: Vector3D = None,extent: Vector3D = None):
+        self.location = Location() if location == None else Location(location.x,location.y,location.z)
+        self.extent = Vector3D() if extent == None else Vector3D(extent.x,extent.y,extent.z)
+        self.rotation = Rotation()
+
+    # Like the simulator, the box's own rotation is ignored and transform places the box in the world
+    def contains(self,world_point: Vector3D,transform: Transform):
+        local = transform.inverse_transform(world_point) - self.location
+        return abs(local.x) <= self.extent.x and abs(local.y) <= self.extent.y and abs(local.z) <= self.extent.z
+
+class Color:
+    def __init__(self,r: int = 0,g: int = 0,b: int = 0,a: int = 255):
+        self.r = r
+        self.g = g
+        self.b = b
+        self.a = a
+
+class LaneMarkingType(IntEnum):
+    NONE = 0
+    Other = 1
+    Broken = 2
+    Solid = 3
+    SolidSolid = 4
+    SolidBroken = 5
+    BrokenSolid = 6
+    BrokenBroken = 7
+    BottsDots = 8
+    Grass = 9
+    Curb = 10
+
+class LaneMarkingColor(IntEnum):
+    Standard = 0
+    Blue = 1
+    Green = 2
+    Red = 3
+    Yellow = 4
+    Other = 5
+
+class LaneType(IntFlag):
+    NONE = 0x1
+    Driving = 0x2
+    Stop = 0x4
+    Shoulder = 0x8
+    Biking = 0x10
+    Sidewalk = 0x20
+    Border = 0x40
+    Restricted = 0x80
+    Parking = 0x100
+    Bidirectional = 0x200
+    Median = 0x400
+    Any = 0xFFFFFFFE
+
+class VehicleLightState(IntFlag):
+    NONE = 0
+    Position = 0x1
+    LowBeam = 0x2
+    HighBeam = 0x4
+    Brake = 0x8
+    RightBlinker = 0x10
+    LeftBlinker = 0x20
+    Reverse = 0x40
+    Fog = 0x80
+    Interior = 0x100
+    Special1 = 0x200
+    Special2 = 0x400
+    All = 0xFFFFFFFF
+
+class TrafficLightState(IntEnum):
+    Red = 0
+    Yellow = 1
+    Green = 2
+    Off = 3
+    Unknown = 4
+
+class LandmarkOrientation(IntEnum):
+    Positive = 0
+    Negative = 1
+    Both = 2
+
+# The simulator's enums can be looked up by value through .values
+for _enum in [LaneMarkingType,LaneMarkingColor,LaneType,VehicleLightState,TrafficLightState,LandmarkOrientation]:
+    _enum.values = {int(m): m for m in _enum}
+
+class LaneMarking:
+    def __init__(self,type: LaneMarkingType = LaneMarkingType.NONE,color: LaneMarkingColor = LaneMarkingColor.Standard,width: float = 0.0):
+        self.type = type
+        self.color = color
+        self.width = width
+
+class VehicleControl:
+    def __init__(self,throttle: float = 0.0,steer: float = 0.0,brake: float = 0.0,hand_brake: bool = False,reverse: bool = False,
+                 manual_gear_shift: bool = False,gear: int = 0):
+        self.throttle = throttle
+        self.steer = steer
+        self.brake = brake
+        self.hand_brake = hand_brake
+        self.reverse = reverse
+        self.manual_gear_shift = manual_gear_shift
+        self.gear = gear
+
+class WalkerControl:
+    def __init__(self,direction: Vector3D = None,speed: float = 0.0,jump: bool = False):
+        self.direction = Vector3D(1,0,0) if direction == None else direction
+        self.speed = speed
+        self.jump = jump
+
+class WeatherParameters:
+    def __init__(self,cloudiness: float = 0.0,precipitation: float = 0.0,precipitation_deposits: float = 0.0,wind_intensity: float = 0.0,
+                 sun_azimuth_angle: float = 0.0,sun_altitude_angle: float = 0.0,fog_density: float = 0.0,fog_distance: float = 0.0,
+                 wetness: float = 0.0,fog_falloff: float = 0.0):
+        self.cloudiness = cloudiness
+        self.precipitation = precipitation
+        self.precipitation_deposits = precipitation_deposits
+        self.wind_intensity = wind_intensity
+        self.sun_azimuth_angle = sun_azimuth_angle
+        self.sun_altitude_angle = sun_altitude_angle
+        self.fog_density = fog_density
+        self.fog_distance = fog_distance
+        self.wetness = wetness
+        self.fog_falloff = fog_falloff
+
+
+class WorldSettings:
+    def __init__(self,synchronous_mode: bool = False,fixed_delta_seconds: float = None,no_rendering_mode: bool = False):
+        self.synchronous_mode = synchronous_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.no_rendering_mode = no_rendering_mode
+
+class Timestamp:
+    def __init__(self,frame: int,elapsed_seconds: float,delta_seconds: float):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.delta_seconds = delta_seconds
+        self.platform_timestamp = time.time()
+
+class Landmark:
+    def __init__(self,road_id: int,s: float,type: str,value: float,orientation: LandmarkOrientation):
+        self.road_id = road_id
+        self.s = s
+        self.type = type
+        self.value = value
+        self.orientation = orientation
+
+# Map geometry. Lanes are straight directed segments: two per road, one each way, and one per way through a
+# junction. Roads join the nodes of a columns x rows grid spaced block metres apart, every node is a junction.
+# Traffic drives on the right, lane -1 of a road runs from its lower to its higher node.
+FAKE_LANE_WIDTH = 3.5
+FAKE_BLOCK_LENGTH = 100.0
+FAKE_SPEED_LIMITS = [30,40,50,60]
+FAKE_SPAWN_SPACING = 15.0
+
+class _Lane:
+    def __init__(self,index: int,road_id: int,lane_id: int,start: Tuple[float,float],end: Tuple[float,float],width: float,
+                 left_marking: LaneMarking,right_marking: LaneMarking,speed_limit: int,junction_id: int = -1):
+        self.index = index
+        self.road_id = road_id
+        self.lane_id = lane_id
+        self.start = start
+        self.end = end
+        self.width = width
+        self.left_marking = left_marking
+        self.right_marking = right_marking
+        self.speed_limit = speed_limit
+        self.junction_id = junction_id
+        self.length = math.hypot(end[0] - start[0],end[1] - start[1])
+        self.direction = ((end[0] - start[0]) / self.length,(end[1] - start[1]) / self.length)
+        self.yaw = math.degrees(math.atan2(self.direction[1],self.direction[0]))
+        self.successors: List[int] = []
+        self.predecessors: List[int] = []
+        # Lane of the same road running the other way, on this lane's left
+        self.opposite: int = None
+
+class Map:
+    def __init__(self,name: str = "FakeTown",columns: int = 4,rows: int = 4,block: float = FAKE_BLOCK_LENGTH,lane_width: float = FAKE_LANE_WIDTH):
+        self.name = "Carla/Maps/"+name
+        self.lane_width = lane_width
+        self.lanes: List[_Lane] = []
+        self.junctions: Dict[int,Junction] = {}
+        self._landmarks: List[Landmark] = []
+        half_size = 1.5 * lane_width
+        nodes = {(i,j): (i * block,j * block) for i in range(columns) for j in range(rows)}
+        node_junctions = {n: k for k, n in enumerate(sorted(nodes))}
+        incoming: Dict[Tuple[int,int],List[int]] = {n: [] for n in nodes}
+        outgoing: Dict[Tuple[int,int],List[int]] = {n: [] for n in nodes}
+
+        road_id = 0
+        for a in sorted(nodes):
+            for b in [(a[0] + 1,a[1]),(a[0],a[1] + 1)]:
+                if not (b in nodes):
+                    continue
+                ax, ay = nodes[a]
+                bx, by = nodes[b]
+                ux = (bx - ax) / block
+                uy = (by - ay) / block
+                centre_line = LaneMarking(LaneMarkingType.SolidSolid,LaneMarkingColor.Yellow) if road_id % 3 == 0 else LaneMarking(LaneMarkingType.Broken,LaneMarkingColor.Standard)
+                edge = LaneMarking(LaneMarkingType.Solid,LaneMarkingColor.Yellow if road_id % 4 == 1 else LaneMarkingColor.Standard)
+                speed_limit = FAKE_SPEED_LIMITS[road_id % len(FAKE_SPEED_LIMITS)]
+                # Offset of each lane's centre to its right, right of (ux, uy) is (-uy, ux)
+                ox = -uy * lane_width / 2
+                oy = ux * lane_width / 2
+                forward = self._add_lane(road_id,-1,(ax + ux * half_size + ox,ay + uy * half_size + oy),(bx - ux * half_size + ox,by - uy * half_size + oy),
+                                         centre_line,edge,speed_limit)
+                backward = self._add_lane(road_id,1,(bx - ux * half_size - ox,by - uy * half_size - oy),(ax + ux * half_size - ox,ay + uy * half_size - oy),
+                                          centre_line,edge,speed_limit)
+                forward.opposite = backward.index
+                backward.opposite = forward.index
+                outgoing[a].append(forward.index)
+                incoming[b].append(forward.index)
+                outgoing[b].append(backward.index)
+                incoming[a].append(backward.index)
+                self._landmarks.append(Landmark(road_id,0.0,"274",float(speed_limit),LandmarkOrientation.Both))
+                road_id += 1
+
+        no_marking = LaneMarking(LaneMarkingType.NONE,LaneMarkingColor.Standard)
+        for n in sorted(nodes):
+            junction_id = node_junctions[n]
+            connectors = []
+            for i in incoming[n]:
+                for o in outgoing[n]:
+                    if self.lanes[i].road_id == self.lanes[o].road_id:
+                        continue
+                    connector = self._add_lane(road_id,-1,self.lanes[i].end,self.lanes[o].start,no_marking,no_marking,self.lanes[i].speed_limit,junction_id)
+                    road_id += 1
+                    self._connect(i,connector.index)
+                    self._connect(connector.index,o)
+                    connectors.append(connector.index)
+            x, y = nodes[n]
+            self.junctions[junction_id] = Junction(self,junction_id,BoundingBox(Location(x,y,0),Vector3D(half_size,half_size,2)),connectors)
+        self.incoming_lanes = incoming
+        self.node_locations = nodes
+        self.node_junctions = node_junctions
+
+        self._starts = np.array([l.start for l in self.lanes])
+        self._directions = np.array([l.direction for l in self.lanes])
+        self._lengths = np.array([l.length for l in self.lanes])
+        self._widths = np.array([l.width for l in self.lanes])
+        self._spawn_points = [Transform(Location(*self._lane_point(l,s),0.5),Rotation(yaw=l.yaw))
+                              for l in self.lanes if l.junction_id < 0 for s in np.arange(5.0,l.length - 5.0,FAKE_SPAWN_SPACING)]
+
+    def _add_lane(self,road_id: int,lane_id: int,start,end,left_marking: LaneMarking,right_marking: LaneMarking,speed_limit: int,junction_id: int = -1):
+        lane = _Lane(len(self.lanes),road_id,lane_id,start,end,self.lane_width,left_marking,right_marking,speed_limit,junction_id)
+        self.lanes.append(lane)
+        return lane
+
+    def _connect(self,a: int,b: int):
+        self.lanes[a].successors.append(b)
+        self.lanes[b].predecessors.append(a)
+
+    def _lane_point(self,lane: _Lane,s: float):
+        return (lane.start[0] + lane.direction[0] * s,lane.start[1] + lane.direction[1] * s)
+
+    # (lane index, s along it, distance from its centre line) of the lane closest to x, y
+    def project(self,x: float,y: float):
+        relative = np.array([x,y]) - self._starts
+        s = np.clip(np.einsum('ij,ij->i',relative,self._directions),0,self._lengths)
+        offsets = relative - self._directions * s[:,None]
+        distances = np.einsum('ij,ij->i',offsets,offsets)
+        i = int(np.argmin(distances))
+        return i, float(s[i]), math.sqrt(float(distances[i]))
+
+    # True if a vehicle can get from lane a to lane b, or back, through at most two lane ends
+    def lanes_connected(self,a: int,b: int):
+        if a == b:
+            return True
+        for first in [self.lanes[a].successors,self.lanes[a].predecessors]:
+            for c in first:
+                if c == b or b in self.lanes[c].successors or b in self.lanes[c].predecessors:
+                    return True
+        return False
+
+    def get_waypoint(self,location: Location,project_to_road: bool = True,lane_type: LaneType = LaneType.Driving):
+        if not (lane_type & LaneType.Driving):
+            return None
+        i, s, distance = self.project(location.x,location.y)
+        if not project_to_road and distance > self.lanes[i].width / 2:
+            return None
+        return Waypoint(self,self.lanes[i],s)
+
+    def get_spawn_points(self):
+        return [Transform(t.location,Rotation(t.rotation.pitch,t.rotation.yaw,t.rotation.roll)) for t in self._spawn_points]
+
+    def generate_waypoints(self,distance: float):
+        return [Waypoint(self,l,float(s)) for l in self.lanes for s in np.arange(0,l.length,distance)]
+
+    def get_topology(self):
+        return [(Waypoint(self,l,0.0),Waypoint(self,l,l.length)) for l in self.lanes]
+
+    def get_all_landmarks_of_type(self,type: str):
+        return [l for l in self._landmarks if l.type == type]
+
+    def get_all_landmarks(self):
+        return list(self._landmarks)
+
+class Waypoint:
+    def __init__(self,map: Map,lane: _Lane,s: float):
+        self._map = map
+        self._lane = lane
+        self.s = s
+        x, y = map._lane_point(lane,s)
+        self.transform = Transform(Location(x,y,0),Rotation(yaw=lane.yaw))
+        self.road_id = lane.road_id
+        self.section_id = 0
+        self.lane_id = lane.lane_id
+        self.lane_width = lane.width
+        self.lane_type = LaneType.Driving
+        self.junction_id = lane.junction_id
+        self.is_junction = lane.junction_id >= 0
+        self.left_lane_marking = lane.left_marking
+        self.right_lane_marking = lane.right_marking
+        self.id = hash((lane.index,round(s,3)))
+
+    def get_junction(self):
+        if not self.is_junction:
+            return None
+        return self._map.junctions[self.junction_id]
+
+    # Waypoints distance further along the lane, one for each way the lane branches within that distance
+    def next(self,distance: float):
+        s = self.s + distance
+        if s <= self._lane.length:
+            return [Waypoint(self._map,self._lane,s)]
+        remaining = s - self._lane.length
+        waypoints = []
+        for i in self._lane.successors:
+            waypoints.extend(Waypoint(self._map,self._map.lanes[i],0.0).next(remaining))
+        return waypoints
+
+    def previous(self,distance: float):
+        s = self.s - distance
+        if s >= 0:
+            return [Waypoint(self._map,self._lane,s)]
+        waypoints = []
+        for i in self._lane.predecessors:
+            lane = self._map.lanes[i]
+            waypoints.extend(Waypoint(self._map,lane,lane.length).previous(-s))
+        return waypoints
+
+    def next_until_lane_end(self,distance: float):
+        return [Waypoint(self._map,self._lane,float(s)) for s in np.arange(self.s + distance,self._lane.length,distance)] + [Waypoint(self._map,self._lane,self._lane.length)]
+
+    # The opposite lane is the left lane, as in the simulator it faces the other way
+    def get_left_lane(self):
+        if self._lane.opposite == None:
+            return None
+        lane = self._map.lanes[self._lane.opposite]
+        return Waypoint(self._map,lane,max(0.0,lane.length - self.s))
+
+    def get_right_lane(self):
+        return None
+
+class Junction:
+    def __init__(self,map: Map,junction_id: int,bounding_box: BoundingBox,lanes: List[int]):
+        self._map = map
+        self.id = junction_id
+        self.bounding_box = bounding_box
+        self._lanes = lanes
+
+    # (entry, exit) waypoints of every lane through the junction
+    def get_waypoints(self,lane_type: LaneType = LaneType.Driving):
+        return [(Waypoint(self._map,self._map.lanes[i],0.0),Waypoint(self._map,self._map.lanes[i],self._map.lanes[i].length)) for i in self._lanes]
+
+# Blueprint attributes are strings, as in the simulator
+class ActorBlueprint:
+    def __init__(self,id: str,tags: List[str],attributes: Dict[str,str],extent: Tuple[float,float,float]):
+        self.id = id
+        self.tags = tags
+        self.attributes = attributes
+        self.extent = extent
+
+    def has_attribute(self,name: str):
+        return name in self.attributes
+
+    def get_attribute(self,name: str):
+        return self.attributes[name]
+
+    def set_attribute(self,name: str,value: str):
+        self.attributes[name] = str(value)
+
+    def has_tag(self,tag: str):
+        return tag in self.tags
+
+class BlueprintLibrary(list):
+    # Copies, so attributes set on one result don't leak into later ones
+    def filter(self,pattern: str):
+        return BlueprintLibrary(copy.deepcopy(b) for b in self if fnmatch(b.id,pattern) or pattern in b.tags)
+
+    def find(self,id: str):
+        for b in self:
+            if b.id == id:
+                return copy.deepcopy(b)
+        raise IndexError("blueprint '"+id+"' not found")
+
+FAKE_BIKE_BLUEPRINT_IDS = ["vehicle.harley-davidson.low_rider","vehicle.diamondback.century","vehicle.yamaha.yzf","vehicle.kawasaki.ninja","vehicle.bh.crossbike","vehicle.gazelle.omafiets"]
+FAKE_CAR_BLUEPRINT_IDS = ["vehicle.audi.a2","vehicle.audi.etron","vehicle.audi.tt","vehicle.chevrolet.impala","vehicle.citroen.c3","vehicle.dodge.charger_police",
+                          "vehicle.ford.mustang","vehicle.tesla.model3","vehicle.ford.ambulance"]
+FAKE_TRUCK_BLUEPRINT_IDS = ["vehicle.tesla.cybertruck","vehicle.carlamotors.carlacola","vehicle.carlamotors.firetruck"]
+
+def _build_blueprint_library():
+    blueprints = []
+    for id in FAKE_CAR_BLUEPRINT_IDS:
+        blueprints.append(ActorBlueprint(id,["vehicle"],{"role_name": "autopilot","number_of_wheels": "4"},(2.4,1.0,0.8)))
+    for id in FAKE_TRUCK_BLUEPRINT_IDS:
+        blueprints.append(ActorBlueprint(id,["vehicle"],{"role_name": "autopilot","number_of_wheels": "4"},(3.2,1.3,1.5)))
+    for id in FAKE_BIKE_BLUEPRINT_IDS:
+        blueprints.append(ActorBlueprint(id,["vehicle"],{"role_name": "autopilot","number_of_wheels": "2"},(1.1,0.4,0.8)))
+    for i in range(1,4):
+        blueprints.append(ActorBlueprint("walker.pedestrian.000"+str(i),["walker"],{"role_name": "pedestrian"},(0.3,0.3,0.9)))
+    for id in ["sensor.other.lane_invasion","sensor.other.collision"]:
+        blueprints.append(ActorBlueprint(id,["sensor"],{"role_name": "front"},(0,0,0)))
+    return BlueprintLibrary(blueprints)
+
+class ActorSnapshot:
+    def __init__(self,id: int,state: Tuple[float,...]):
+        self.id = id
+        self._state = state
+
+    def get_transform(self):
+        s = self._state
+        return Transform(Location(s[0],s[1],s[2]),Rotation(yaw=s[3]))
+
+    def get_velocity(self):
+        s = self._state
+        return Vector3D(s[4],s[5],0)
+
+class WorldSnapshot:
+    def __init__(self,frame: int,timestamp: Timestamp,states: Dict[int,Tuple[float,...]]):
+        self.id = frame
+        self.frame = frame
+        self.timestamp = timestamp
+        self._states = states
+
+    def __iter__(self):
+        return (ActorSnapshot(i,s) for i, s in self._states.items())
+
+    def __len__(self):
+        return len(self._states)
+
+    def has_actor(self,actor_id: int):
+        return actor_id in self._states
+
+    def find(self,actor_id: int):
+        state = self._states.get(actor_id)
+        if state == None:
+            return None
+        return ActorSnapshot(actor_id,state)
+
+class Actor:
+    def __init__(self,world: "World",id: int,type_id: str,attributes: Dict[str,str],transform: Transform,extent: Tuple[float,float,float] = (0,0,0)):
+        self._world = world
+        self.id = id
+        self.type_id = type_id
+        self.attributes = attributes
+        self.bounding_box = BoundingBox(Location(0,0,extent[2]),Vector3D(*extent))
+        self.parent = None
+        self.is_alive = True
+        self._x = transform.location.x
+        self._y = transform.location.y
+        self._z = transform.location.z
+        self._yaw = transform.rotation.yaw
+        self._vx = 0.0
+        self._vy = 0.0
+
+    # Transforms and locations are new objects each call, callers may edit them
+    def get_transform(self):
+        return Transform(Location(self._x,self._y,self._z),Rotation(yaw=self._yaw))
+
+    def get_location(self):
+        return Location(self._x,self._y,self._z)
+
+    def get_velocity(self):
+        return Vector3D(self._vx,self._vy,0)
+
+    def set_transform(self,transform: Transform):
+        self._x = transform.location.x
+        self._y = transform.location.y
+        self._z = transform.location.z
+        self._yaw = transform.rotation.yaw
+
+    def set_target_velocity(self,velocity: Vector3D):
+        self._vx = velocity.x
+        self._vy = velocity.y
+
+    def destroy(self):
+        if not self.is_alive:
+            return False
+        self.is_alive = False
+        self._world._remove_actor(self)
+        return True
+
+    def _state(self):
+        return (self._x,self._y,self._z,self._yaw,self._vx,self._vy)
+
+    def _step(self,dt: float):
+        pass
+
+# Kinematic bicycle model driven by the last VehicleControl applied
+class Vehicle(Actor):
+    max_acceleration = 4.0
+    max_deceleration = 8.0
+    max_steer_angle = math.radians(35)
+    max_speed = 50.0
+
+    def __init__(self,world: "World",id: int,type_id: str,attributes: Dict[str,str],transform: Transform,extent: Tuple[float,float,float]):
+        super().__init__(world,id,type_id,attributes,transform,extent)
+        self._control = VehicleControl()
+        self._light_state = VehicleLightState.NONE
+        self._speed = 0.0
+        self._wheelbase = max(1.2 * extent[0],0.5)
+
+    def apply_control(self,control: VehicleControl):
+        self._control = control
+
+    def get_control(self):
+        return self._control
+
+    def set_light_state(self,light_state: VehicleLightState):
+        self._light_state = VehicleLightState(int(light_state))
+
+    def get_light_state(self):
+        return self._light_state
+
+    def set_autopilot(self,enabled: bool = True,port: int = 8000):
+        pass
+
+    # Speed limit in km/h of the lane the vehicle is on
+    def get_speed_limit(self):
+        i, _, _ = self._world.map.project(self._x,self._y)
+        return float(self._world.map.lanes[i].speed_limit)
+
+    def set_target_velocity(self,velocity: Vector3D):
+        super().set_target_velocity(velocity)
+        self._speed = math.hypot(velocity.x,velocity.y)
+
+    def _step(self,dt: float):
+        control = self._control
+        acceleration = control.throttle * self.max_acceleration - max(control.brake,1.0 if control.hand_brake else 0.0) * self.max_deceleration
+        if self._speed > 0:
+            acceleration -= 0.02 * self._speed
+        self._speed = min(max(self._speed + acceleration * dt,0.0),self.max_speed)
+        direction = -1.0 if control.reverse else 1.0
+        self._yaw += math.degrees(direction * self._speed / self._wheelbase * math.tan(control.steer * self.max_steer_angle)) * dt
+        self._yaw = (self._yaw + 180) % 360 - 180
+        heading = math.radians(self._yaw)
+        self._vx = direction * self._speed * math.cos(heading)
+        self._vy = direction * self._speed * math.sin(heading)
+        self._x += self._vx * dt
+        self._y += self._vy * dt
+
+class Walker(Actor):
+    def __init__(self,world: "World",id: int,type_id: str,attributes: Dict[str,str],transform: Transform,extent: Tuple[float,float,float]):
+        super().__init__(world,id,type_id,attributes,transform,extent)
+        self._control = WalkerControl()
+
+    def apply_control(self,control: WalkerControl):
+        self._control = control
+
+    def get_control(self):
+        return self._control
+
+    def _step(self,dt: float):
+        direction = self._control.direction
+        length = math.hypot(direction.x,direction.y)
+        if length == 0 or self._control.speed <= 0:
+            self._vx = 0.0
+            self._vy = 0.0
+            return
+        self._vx = direction.x / length * self._control.speed
+        self._vy = direction.y / length * self._control.speed
+        self._yaw = math.degrees(math.atan2(self._vy,self._vx))
+        self._x += self._vx * dt
+        self._y += self._vy * dt
+
+# Cycles green, yellow, red, with the lights facing along x and along y out of phase
+class TrafficLight(Actor):
+    green_time = 10.0
+    yellow_time = 2.0
+
+    def __init__(self,world: "World",id: int,transform: Transform,lane: int,phase: int):
+        super().__init__(world,id,"traffic.traffic_light",{},transform)
+        self.lane = lane
+        self.phase = phase
+        self._light_state = TrafficLightState.Red
+
+    def get_state(self):
+        return self._light_state
+
+    def set_state(self,state: TrafficLightState):
+        self._light_state = state
+
+    def _update(self,elapsed_seconds: float):
+        cycle = 2 * (self.green_time + self.yellow_time)
+        t = (elapsed_seconds + self.phase * (self.green_time + self.yellow_time)) % cycle
+        if t < self.green_time:
+            self._light_state = TrafficLightState.Green
+        elif t < self.green_time + self.yellow_time:
+            self._light_state = TrafficLightState.Yellow
+        else:
+            self._light_state = TrafficLightState.Red
+
+class LaneInvasionEvent:
+    def __init__(self,frame: int,timestamp: float,actor: Actor,crossed_lane_markings: List[LaneMarking]):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.actor = actor
+        self.crossed_lane_markings = crossed_lane_markings
+
+class CollisionEvent:
+    def __init__(self,frame: int,timestamp: float,actor: Actor,other_actor: Actor):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.actor = actor
+        self.other_actor = other_actor
+        self.normal_impulse = Vector3D()
+
+# Lane invasion and collision sensors. Callbacks are called from World.tick on the ticking thread.
+class Sensor(Actor):
+    def __init__(self,world: "World",id: int,type_id: str,attributes: Dict[str,str],transform: Transform,parent: Actor):
+        super().__init__(world,id,type_id,attributes,transform)
+        self.parent = parent
+        self._callback: Callable = None
+        self._lane = None
+        self._off_lane = False
+        self._contacts = set()
+
+    def listen(self,callback: Callable):
+        self._callback = callback
+
+    def stop(self):
+        self._callback = None
+
+    def is_listening(self):
+        return self._callback != None
+
+    def get_transform(self):
+        return self.parent.get_transform()
+
+    def get_location(self):
+        return self.parent.get_location()
+
+    # Crossing out of a lane sideways, into another lane or off the road, crosses the marking on that side
+    def _detect_lane_invasion(self,lane: int,on_lane: bool):
+        map = self._world.map
+        crossed = None
+        if self._lane != None and map.lanes[self._lane].junction_id < 0:
+            previous = map.lanes[self._lane]
+            if (on_lane and not map.lanes_connected(self._lane,lane)) or (not on_lane and not self._off_lane):
+                lateral = (self.parent._x - previous.start[0]) * -previous.direction[1] + (self.parent._y - previous.start[1]) * previous.direction[0]
+                crossed = previous.right_marking if lateral > 0 else previous.left_marking
+        self._off_lane = not on_lane
+        if on_lane or self._lane == None:
+            self._lane = lane
+        if crossed != None:
+            return LaneInvasionEvent(self._world.frame,self._world.elapsed_seconds,self.parent,[crossed])
+        return None
+
+    def _detect_collisions(self,distance_from_lane: float):
+        contacts = set()
+        for other in self._world._bodies:
+            if other is self.parent or not _boxes_overlap(self.parent,other):
+                continue
+            contacts.add(other.id)
+        if distance_from_lane > self._world.off_road_distance:
+            contacts.add(self._world.static_prop.id)
+        events = []
+        for i in contacts - self._contacts:
+            other = self._world.static_prop if i == self._world.static_prop.id else self._world._actors[i]
+            events.append(CollisionEvent(self._world.frame,self._world.elapsed_seconds,self.parent,other))
+        self._contacts = contacts
+        return events
+
+def _boxes_overlap(a: Actor,b: Actor):
+    ea = a.bounding_box.extent
+    eb = b.bounding_box.extent
+    dx = b._x - a._x
+    dy = b._y - a._y
+    reach = math.hypot(ea.x,ea.y) + math.hypot(eb.x,eb.y)
+    if dx * dx + dy * dy > reach * reach:
+        return False
+    # Separating axis test on the footprints
+    axes = []
+    for actor in [a,b]:
+        yaw = math.radians(actor._yaw)
+        axes.append((math.cos(yaw),math.sin(yaw)))
+        axes.append((-math.sin(yaw),math.cos(yaw)))
+    for ax, ay in axes:
+        ra = ea.x * abs(axes[0][0] * ax + axes[0][1] * ay) + ea.y * abs(axes[1][0] * ax + axes[1][1] * ay)
+        rb = eb.x * abs(axes[2][0] * ax + axes[2][1] * ay) + eb.y * abs(axes[3][0] * ax + axes[3][1] * ay)
+        if abs(dx * ax + dy * ay) > ra + rb:
+            return False
+    return True
+
+class ActorList(list):
+    def filter(self,pattern: str):
+        return ActorList(a for a in self if fnmatch(a.type_id,pattern))
+
+    def find(self,actor_id: int):
+        for a in self:
+            if a.id == actor_id:
+                return a
+        return None
+
+class DebugHelper:
+    def draw_point(self,*args,**kwargs):
+        pass
+
+    def draw_line(self,*args,**kwargs):
+        pass
+
+    def draw_arrow(self,*args,**kwargs):
+        pass
+
+    def draw_box(self,*args,**kwargs):
+        pass
+
+    def draw_string(self,*args,**kwargs):
+        pass
+
+# Steps every actor on the caller's thread. In synchronous mode the world only advances in tick(), otherwise
+# it advances by whole steps of fixed_delta_seconds (0.05 when unset) as wall clock time passes, checked
+# whenever a snapshot is requested.
+class World:
+    default_delta_seconds = 0.05
+
+    def __init__(self,map: Map):
+        self.map = map
+        self.id = id(self)
+        self.frame = 0
+        self.elapsed_seconds = 0.0
+        self.debug = DebugHelper()
+        self.off_road_distance = 2.5 * map.lane_width
+        self._settings = WorldSettings()
+        self._weather = WeatherParameters(cloudiness=10,sun_altitude_angle=45)
+        self._blueprints = _build_blueprint_library()
+        self._next_id = 1
+        self._actors: Dict[int,Actor] = {}
+        # Vehicles and walkers, the actors that move and collide
+        self._bodies: List[Actor] = []
+        self._sensors: List[Sensor] = []
+        self._last_step_time = time.perf_counter()
+        self.spectator = self._add_actor(Actor(self,self._new_id(),"spectator",{},Transform(Location(0,0,50),Rotation(pitch=-90))))
+        self.static_prop = Actor(self,self._new_id(),"static.prop.building",{},Transform())
+        self._traffic_lights: Dict[int,TrafficLight] = {}
+        for n, lanes in map.incoming_lanes.items():
+            if len(lanes) < 4:
+                continue
+            for i in lanes:
+                lane = map.lanes[i]
+                x = lane.end[0] - lane.direction[1] * lane.width
+                y = lane.end[1] + lane.direction[0] * lane.width
+                phase = 0 if abs(lane.direction[0]) > abs(lane.direction[1]) else 1
+                light = TrafficLight(self,self._new_id(),Transform(Location(x,y,0),Rotation(yaw=lane.yaw + 180)),i,phase)
+                self._traffic_lights[i] = self._add_actor(light)
+        self._update_traffic_lights()
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id - 1
+
+    def _add_actor(self,actor: Actor):
+        self._actors[actor.id] = actor
+        if isinstance(actor,(Vehicle,Walker)):
+            self._bodies.append(actor)
+        elif isinstance(actor,Sensor):
+            self._sensors.append(actor)
+        return actor
+
+    def _remove_actor(self,actor: Actor):
+        self._actors.pop(actor.id,None)
+        if actor in self._bodies:
+            self._bodies.remove(actor)
+        if actor in self._sensors:
+            self._sensors.remove(actor)
+        for s in [s for s in self._sensors if s.parent is actor]:
+            s.destroy()
+
+    def _update_traffic_lights(self):
+        for light in self._traffic_lights.values():
+            light._update(self.elapsed_seconds)
+
+    def get_map(self):
+        return self.map
+
+    def get_spectator(self):
+        return self.spectator
+
+    def get_blueprint_library(self):
+        return self._blueprints
+
+    def get_settings(self):
+        return copy.copy(self._settings)
+
+    def apply_settings(self,settings: WorldSettings):
+        self._settings = copy.copy(settings)
+        self._last_step_time = time.perf_counter()
+        return self.frame
+
+    def get_weather(self):
+        return copy.copy(self._weather)
+
+    def set_weather(self,weather: WeatherParameters):
+        self._weather = copy.copy(weather)
+
+    def get_actors(self,actor_ids: List[int] = None):
+        if actor_ids == None:
+            return ActorList(self._actors.values())
+        return ActorList(self._actors[i] for i in actor_ids if i in self._actors)
+
+    def get_actor(self,actor_id: int):
+        return self._actors.get(actor_id)
+
+    def _blocked(self,transform: Transform,extent: Tuple[float,float,float]):
+        reach = math.hypot(extent[0],extent[1])
+        for other in self._bodies:
+            e = other.bounding_box.extent
+            limit = 0.8 * (reach + math.hypot(e.x,e.y))
+            if (other._x - transform.location.x) ** 2 + (other._y - transform.location.y) ** 2 < limit * limit:
+                return True
+        return False
+
+    def try_spawn_actor(self,blueprint: ActorBlueprint,transform: Transform,attach_to: Actor = None):
+        attributes = dict(blueprint.attributes)
+        if blueprint.id.startswith("sensor."):
+            if attach_to == None:
+                raise RuntimeError("Sensors need an actor to attach to")
+            return self._add_actor(Sensor(self,self._new_id(),blueprint.id,attributes,transform,attach_to))
+        if self._blocked(transform,blueprint.extent):
+            return None
+        if blueprint.id.startswith("walker."):
+            return self._add_actor(Walker(self,self._new_id(),blueprint.id,attributes,transform,blueprint.extent))
+        return self._add_actor(Vehicle(self,self._new_id(),blueprint.id,attributes,transform,blueprint.extent))
+
+    def spawn_actor(self,blueprint: ActorBlueprint,transform: Transform,attach_to: Actor = None):
+        actor = self.try_spawn_actor(blueprint,transform,attach_to)
+        if actor == None:
+            raise RuntimeError("Spawn failed because of collision at spawn position")
+        return actor
+
+    # Lights controlling the lane of waypoint if its end is within distance
+    def get_traffic_lights_from_waypoint(self,waypoint: Waypoint,distance: float):
+        light = self._traffic_lights.get(waypoint._lane.index)
+        if light == None or waypoint._lane.length - waypoint.s > distance:
+            return []
+        return [light]
+
+    def get_traffic_lights_in_junction(self,junction_id: int):
+        return [l for l in self._traffic_lights.values() if self.map.node_junctions.get(self._light_node(l)) == junction_id]
+
+    def _light_node(self,light: TrafficLight):
+        for n, lanes in self.map.incoming_lanes.items():
+            if light.lane in lanes:
+                return n
+        return None
+
+    def step(self,delta_seconds: float):
+        for actor in self._bodies:
+            actor._step(delta_seconds)
+        self.frame += 1
+        self.elapsed_seconds += delta_seconds
+        self._update_traffic_lights()
+
+        events = []
+        projections = {}
+        for sensor in list(self._sensors):
+            parent = sensor.parent
+            if not (parent.id in projections):
+                projections[parent.id] = self.map.project(parent._x,parent._y)
+            lane, _, distance = projections[parent.id]
+            if sensor.type_id == "sensor.other.lane_invasion":
+                event = sensor._detect_lane_invasion(lane,distance <= self.map.lanes[lane].width / 2)
+                if event != None:
+                    events.append((sensor,event))
+            elif sensor.type_id == "sensor.other.collision":
+                events.extend((sensor,e) for e in sensor._detect_collisions(distance))
+        for sensor, event in events:
+            if sensor._callback != None:
+                sensor._callback(event)
+        return self.frame
+
+    def _delta_seconds(self):
+        if self._settings.fixed_delta_seconds == None:
+            return self.default_delta_seconds
+        return self._settings.fixed_delta_seconds
+
+    def tick(self,seconds: float = 10.0):
+        return self.step(self._delta_seconds())
+
+    def _catch_up(self):
+        if self._settings.synchronous_mode:
+            return
+        delta_seconds = self._delta_seconds()
+        now = time.perf_counter()
+        while now - self._last_step_time >= delta_seconds:
+            self.step(delta_seconds)
+            self._last_step_time += delta_seconds
+
+    def get_snapshot(self):
+        self._catch_up()
+        states = {i: a._state() for i, a in self._actors.items()}
+        return WorldSnapshot(self.frame,Timestamp(self.frame,self.elapsed_seconds,self._delta_seconds()),states)
+
+    def wait_for_tick(self,seconds: float = 10.0):
+        if not self._settings.synchronous_mode:
+            self.step(self._delta_seconds())
+            self._last_step_time = time.perf_counter()
+        return self.get_snapshot()
+
+# Batch commands for Client.apply_batch, each takes an actor or actor id like the simulator's
+class command:
+    class Response:
+        def __init__(self,actor_id: int,error: str = ""):
+            self.actor_id = actor_id
+            self.error = error
+
+        def has_error(self):
+            return self.error != ""
+
+    class ApplyVehicleControl:
+        def __init__(self,actor,control: VehicleControl):
+            self.actor_id = actor if isinstance(actor,int) else actor.id
+            self.control = control
+
+        def _apply(self,world: World):
+            world._actors[self.actor_id].apply_control(self.control)
+
+    class ApplyWalkerControl:
+        def __init__(self,actor,control: WalkerControl):
+            self.actor_id = actor if isinstance(actor,int) else actor.id
+            self.control = control
+
+        def _apply(self,world: World):
+            world._actors[self.actor_id].apply_control(self.control)
+
+    class ApplyTransform:
+        def __init__(self,actor,transform: Transform):
+            self.actor_id = actor if isinstance(actor,int) else actor.id
+            self.transform = transform
+
+        def _apply(self,world: World):
+            world._actors[self.actor_id].set_transform(self.transform)
+
+    class ApplyTargetVelocity:
+        def __init__(self,actor,velocity: Vector3D):
+            self.actor_id = actor if isinstance(actor,int) else actor.id
+            self.velocity = velocity
+
+        def _apply(self,world: World):
+            world._actors[self.actor_id].set_target_velocity(self.velocity)
+
+    class SetVehicleLightState:
+        def __init__(self,actor,light_state: VehicleLightState):
+            self.actor_id = actor if isinstance(actor,int) else actor.id
+            self.light_state = light_state
+
+        def _apply(self,world: World):
+            world._actors[self.actor_id].set_light_state(self.light_state)
+
+    class DestroyActor:
+        def __init__(self,actor):
+            self.actor_id = actor if isinstance(actor,int) else actor.id
+
+        def _apply(self,world: World):
+            world._actors[self.actor_id].destroy()
+
+# Worlds by (host, port), so clients in one process made with the same address share a simulation
+_servers: Dict[Tuple[str,int],World] = {}
+
+class Client:
+    def __init__(self,host: str = "localhost",port: int = 2000,worker_threads: int = 0):
+        self.host = host
+        self.port = port
+        if not ((host,port) in _servers):
+            _servers[(host,port)] = World(Map())
+
+    def set_timeout(self,seconds: float):
+        pass
+
+    def get_server_version(self):
+        return "fake"
+
+    def get_client_version(self):
+        return "fake"
+
+    def get_world(self):
+        return _servers[(self.host,self.port)]
+
+    def get_available_maps(self):
+        return ["/Game/Carla/Maps/FakeTown"]
+
+    # Any name loads a grid town, named after it so caches keyed by map name stay apart
+    def load_world(self,map_name: str,reset_settings: bool = True):
+        world = World(Map(map_name.split("/")[-1]))
+        _servers[(self.host,self.port)] = world
+        return world
+
+    # Not part of the carla API: points this address at world, such as one on a bigger town than load_world makes
+    def set_world(self,world: World):
+        _servers[(self.host,self.port)] = world
+
+    def reload_world(self,reset_settings: bool = True):
+        return self.load_world(self.get_world().map.name)
+
+    def apply_batch(self,commands: list):
+        self.apply_batch_sync(commands)
+
+    def apply_batch_sync(self,commands: list,do_tick: bool = False):
+        world = self.get_world()
+        responses = []
+        for c in commands:
+            try:
+                c._apply(world)
+                responses.append(command.Response(c.actor_id))
+            except (KeyError, AttributeError) as e:
+                responses.append(command.Response(c.actor_id,repr(e)))
+        if do_tick:
+            world.tick()
+        return responses
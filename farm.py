@@ -0,0 +1,136 @@
+import argparse
+import queue
+import random
+import multiprocessing
+import numpy as np
+from carla_backend import carla
+from typing import Callable, List, Tuple
+from coverage import Coverage
+from persistence import AsyncWriter, FsyncPolicy
+from npc_control import PATH_FOLLOWERS
+from world_state import build_coverage_space
+from rules import ScenarioContext, build_assertions
+import main as scenario_runner
+
+FARM_DIRECTORY = "out/farm"
+
+# Runs random scenarios headlessly against the simulator at host:port, sending every change to its session
+# coverage to the coordinator as ("delta", worker, key, states bytes) followed by ("done", worker, error)
+def run_worker(worker: int,host: str,port: int,args,deltas: multiprocessing.Queue,client_factory: Callable = None):
+    error = None
+    try:
+        if args.seed != None:
+            random.seed(args.seed + worker)
+            np.random.seed(args.seed + worker)
+        if client_factory == None:
+            client_factory = carla.Client
+        client = client_factory(host,port)
+        client.set_timeout(25)
+
+        persistence_writer = AsyncWriter(FsyncPolicy[args.fsync.upper()])
+        try:
+            session = scenario_runner.TestSession(persistence_writer,FARM_DIRECTORY+"/"+host+"_"+str(port),profile=args.profile)
+            session.session_coverage.add_change_listener(lambda key, states: deltas.put(("delta",worker,key,states.tobytes())))
+            try:
+                scenario_runner.run_random_scenarios(client,args,session)
+            finally:
+                session.close()
+        finally:
+            persistence_writer.close()
+    except Exception as e:
+        error = repr(e)
+    deltas.put(("done",worker,error))
+
+# Launches one worker process per simulator endpoint and merges the coverage they find into coverage_path.
+# client_factory(host, port) makes the client each worker connects with, so the farm can be run against
+# a fake simulator, it must be picklable.
+class Farm:
+    def __init__(self,endpoints: List[Tuple[str,int]],args,client_factory: Callable = None,coverage_path: str = "out/global_coverage.csv"):
+        self.endpoints = endpoints
+        self.args = args
+        self.client_factory = client_factory
+        self.coverage_path = coverage_path
+
+    def run(self):
+        deltas = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_worker,args=(i,host,port,self.args,deltas,self.client_factory),name="FarmWorker-"+str(i))
+                   for i, (host, port) in enumerate(self.endpoints)]
+        persistence_writer = AsyncWriter(FsyncPolicy[self.args.fsync.upper()])
+        finished = False
+        try:
+            assertion_catalogue = build_assertions(ScenarioContext())
+            global_coverage = Coverage(self.coverage_path,assertion_catalogue,build_coverage_space(),writer=persistence_writer)
+            for w in workers:
+                w.start()
+            new_covered_cases = self.merge_deltas(deltas,workers,global_coverage)
+            global_coverage.write_coverage()
+            print("Farm covered",new_covered_cases,"new cases")
+            global_coverage.print_coverage()
+            finished = True
+        finally:
+            # On an error or interrupt nothing is merging the workers' coverage any more, so they are stopped
+            # rather than left to finish their scenarios
+            if not finished:
+                for w in workers:
+                    if w.is_alive():
+                        print("Stopping",w.name)
+                        w.terminate()
+            for w in workers:
+                if w.pid != None:
+                    w.join()
+            persistence_writer.close()
+
+    def merge_deltas(self,deltas: multiprocessing.Queue,workers: List[multiprocessing.Process],global_coverage: Coverage):
+        new_covered_cases = 0
+        running = len(workers)
+        while running > 0:
+            try:
+                message = deltas.get(timeout=1)
+            except queue.Empty:
+                # A worker killed outside Python never reports back
+                if not any(w.is_alive() for w in workers) and deltas.empty():
+                    break
+                continue
+            if message[0] == "delta":
+                _, worker, key, states = message
+                new_covered_cases += global_coverage.merge_case(key,np.frombuffer(states,dtype=np.uint8))
+            elif message[0] == "done":
+                _, worker, error = message
+                running -= 1
+                host, port = self.endpoints[worker]
+                if error != None:
+                    print("Worker for",host+":"+str(port),"failed:",error)
+                else:
+                    print("Worker for",host+":"+str(port),"finished")
+        return new_covered_cases
+
+def parse_endpoint(endpoint: str):
+    host, _, port = endpoint.rpartition(":")
+    return (host if host != "" else "localhost",int(port))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("endpoints",nargs="+",help="host:port of each simulator, one worker is run per endpoint")
+    parser.add_argument("--scenarios",type=int,default=1,help="Number of random scenarios each worker runs")
+    parser.add_argument("--max-ticks",type=int,default=None,help="Tick budget per scenario")
+    parser.add_argument("--max-seconds",type=float,default=None,help="Wall clock budget per scenario")
+    parser.add_argument("--sync",action='store_true')
+    parser.add_argument("--delta",type=float,default=0.1)
+    parser.add_argument("--max-speed",action='store_true')
+    parser.add_argument("--seed",type=int,default=None,help="Worker n is seeded with seed + n")
+    parser.add_argument("--guided",action='store_true',help="Aim scenarios at the least covered variable values")
+    parser.add_argument("--precompute-junctions",action='store_true')
+    parser.add_argument("--record",action='store_true',help="Write a trace of each scenario under each worker's output directory")
+    parser.add_argument("--npc-follower",choices=list(PATH_FOLLOWERS),default="pure_pursuit",help="How NPCs are driven along their paths")
+    parser.add_argument("--profile",action='store_true',help="Write tick stage and oracle timings under each worker's output directory")
+    parser.add_argument("--fsync",choices=[p.name.lower() for p in FsyncPolicy],default=FsyncPolicy.ON_FLUSH.name.lower())
+    args = parser.parse_args()
+    if args.max_speed and not args.sync:
+        parser.error("--max-speed needs --sync")
+    if args.max_ticks == None and args.max_seconds == None:
+        parser.error("workers need a --max-ticks or --max-seconds budget")
+
+    Farm([parse_endpoint(e) for e in args.endpoints],args).run()
+
+if __name__ == '__main__':
+    main()
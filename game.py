@@ -1,5 +1,5 @@
 import pygame
-from typing import List
+from typing import List, Tuple
 
 class Game():
     def __init__(self,screen):
@@ -19,6 +19,8 @@ class Game():
         self.bug_description_rects = []
         self.progress_text = self.header_font.render("0 / 100",True,(0,0,0),None)
         self.level_text = self.header_font.render("LV. 1",True,(0,0,0),None)
+        self.profile_font = pygame.font.SysFont("ComicSans.tff",18)
+        self.profile_texts = []
 
         self.score_header_rect = self.score_header_text.get_rect()
         self.score_text_rect = self.score_text.get_rect()
@@ -61,6 +63,15 @@ class Game():
             self.bug_description_texts.append(txt)
             self.bug_description_rects.append(txt.get_rect())
 
+    # Lists the slowest oracles as (name, summary) pairs from TickProfiler.get_slowest in the bottom right corner
+    def update_profile_panel(self,slowest: List[Tuple[str,Tuple]]):
+        self.profile_texts = []
+        if len(slowest) == 0:
+            return
+        self.profile_texts.append(self.profile_font.render("Slowest oracles, p99 ms",True,(0,0,0),None))
+        for name, summary in slowest:
+            self.profile_texts.append(self.profile_font.render(name+"  %.2f" % summary[4],True,(0,0,0),None))
+
     def handle_input(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -85,6 +96,11 @@ class Game():
             self.bug_description_rects[index].center = (320,320 + i * 18)
             self.screen.blit(self.bug_description_texts[index],self.bug_description_rects[index])
 
+        for i, txt in enumerate(self.profile_texts):
+            rect = txt.get_rect()
+            rect.topright = (632,480 - 8 - (len(self.profile_texts) - i) * 14)
+            self.screen.blit(txt,rect)
+
         pygame.draw.rect(self.screen,(150,150,150),pygame.rect.Rect(self.progbar_spec[0],self.progbar_spec[1],self.progbar_spec[2],self.progbar_spec[3]))
         pygame.draw.rect(self.screen,(0,0,200),self.progress_bar)
         self.screen.blit(self.progress_text,self.progress_text_rect)
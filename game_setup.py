@@ -1,7 +1,7 @@
 from typing import List
 import pygame
-import carla
-from test_setup import reversed_spawn
+from carla_backend import carla
+from test_setup import reversed_spawn, ACTOR_BLUEPRINT_IDS
 from fnmatch import fnmatch
 
 def game_setup_loop(screen,spectator,world,map):
@@ -10,16 +10,7 @@ def game_setup_loop(screen,spectator,world,map):
     vehicle_font = pygame.font.SysFont("ComicSans.tff",48)
     instructions, instruction_txts, instruction_txt_rects = set_instruction_texts(font,["Move cursor with arrow keys","Press SPACE to place the vehicle under test"])
     vehicle_display_names = ["Audi Etron","Chevrolet Impala","Pedestrian","Motorbike","Police Car","Ford Mustang","Delivery Truck","Citreon C3","Bike"]
-    vehicle_blueprint_ids = ["vehicle.audi.etron",
-                             "vehicle.chevrolet.impala",
-                             "walker.pedestrian.0001",
-                             "vehicle.harley-davidson.low_rider",
-                             "vehicle.dodge.charger_police",
-                             "vehicle.ford.mustang",
-                             "vehicle.carlamotors.carlacola",
-                             "vehicle.citroen.c3",
-                             "vehicle.diamondback.century"
-                             ]
+    vehicle_blueprint_ids = ACTOR_BLUEPRINT_IDS
     vehicle_index = 0
     vehicle_display_txt = vehicle_font.render(vehicle_display_names[0],True,(255,0,0),None)
     vehicle_display_rect = vehicle_display_txt.get_rect()
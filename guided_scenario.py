@@ -0,0 +1,145 @@
+import random
+from carla_backend import carla
+import numpy as np
+from enum import Enum
+from typing import Dict
+import test_setup
+from coverage import Coverage
+from coverage_variables import *
+from road_graph_index import RoadGraphIndex, load_road_graph_index
+
+# Range of the weather parameter that getWeatherLevel maps to each level
+WEATHER_LEVEL_RANGES = {
+    Levels.NONE: (0,0),
+    Levels.LOW: (1,25),
+    Levels.MEDIUM: (26,50),
+    Levels.HIGH: (51,75),
+    Levels.VERY_HIGH: (76,100)
+}
+
+# Range of sun altitude that get_time_of_day maps to each time of day
+SUN_ALTITUDE_RANGES = {
+    TimesOfDay.NIGHT: (-90,-11),
+    TimesOfDay.SUNRISE: (-9,20),
+    TimesOfDay.DAY: (21,159),
+    TimesOfDay.SUNSET: (160,180)
+}
+
+# Number of actors within 25m of the ego that get_density_level maps to each level
+DENSITY_LEVEL_ACTOR_COUNTS = {
+    Levels.NONE: (0,0),
+    Levels.LOW: (1,5),
+    Levels.MEDIUM: (6,15),
+    Levels.HIGH: (16,25),
+    Levels.VERY_HIGH: (26,32)
+}
+
+# Variables the generator can steer a scenario towards
+GUIDED_VARIABLES = [
+    CoverageVariable.RAIN,
+    CoverageVariable.GROUND_WATER,
+    CoverageVariable.CLOUD,
+    CoverageVariable.TIME_OF_DAY,
+    CoverageVariable.ROAD_GRAPH,
+    CoverageVariable.SPEED_LIMIT,
+    CoverageVariable.VEHICLE_DENSITY,
+    CoverageVariable.PEDESTRIAN_DENSITY,
+    CoverageVariable.BIKES_PRESENT,
+    CoverageVariable.CARS_PRESENT,
+    CoverageVariable.EMERGENCY_VEHICLE_STATUS
+]
+
+# Builds scenarios aimed at the values of each coverage variable that the least micro-bins have been covered
+# with so far. Each value is picked with probability proportional to 1 / (1 + covered micro-bins), or
+# uniformly with probability exploration, so well covered values are still revisited now and then.
+class GuidedScenarioGenerator:
+    def __init__(self,coverage: Coverage,exploration: float = 0.1):
+        self.coverage = coverage
+        self.exploration = exploration
+        # Map name to the road graph index of the map
+        self._road_graph_indices: Dict[str,RoadGraphIndex] = {}
+
+    def choose_targets(self):
+        variable_set = self.coverage.coverage_variable_set
+        level_counts = self.coverage.get_level_counts()
+        targets: Dict[CoverageVariable,Enum] = {}
+        for variable in GUIDED_VARIABLES:
+            i = variable_set.get_variable_index(variable)
+            members = list(variable_set.variables[i][1])
+            if random.random() < self.exploration:
+                targets[variable] = random.choice(members)
+            else:
+                weights = 1 / (1 + level_counts[i])
+                targets[variable] = members[int(np.random.choice(len(members),p=weights / weights.sum()))]
+        return targets
+
+    def get_road_graph_index(self,map: carla.Map):
+        index = self._road_graph_indices.get(map.name)
+        if index == None:
+            index = load_road_graph_index(map)
+            self._road_graph_indices[map.name] = index
+        return index
+
+    # Spawn points with the target road graph and speed limit, then lane positions with them, dropping the
+    # speed limit and then the road graph if the map has neither
+    def get_ego_spawn_points(self,map: carla.Map,targets: Dict[CoverageVariable,Enum]):
+        index = self.get_road_graph_index(map)
+        road_graph = targets[CoverageVariable.ROAD_GRAPH]
+        speed_limit = targets[CoverageVariable.SPEED_LIMIT]
+        for spawn_points in [lambda: index.get_spawn_points(road_graph,speed_limit),
+                             lambda: index.get_transforms(road_graph,speed_limit),
+                             lambda: index.get_spawn_points(road_graph),
+                             lambda: index.get_transforms(road_graph)]:
+            candidates = spawn_points()
+            if len(candidates) > 0:
+                return candidates
+        return map.get_spawn_points()
+
+    # Same contract as setup_random_scenario, returns the (actor, path) of each non-ego actor spawned
+    def setup(self,world: carla.World,map: carla.Map,spectator: carla.Actor):
+        targets = self.choose_targets()
+        print("Targeting",", ".join(v.name+"="+targets[v].name for v in GUIDED_VARIABLES))
+
+        world.set_weather(carla.WeatherParameters(
+            precipitation = random.randint(*WEATHER_LEVEL_RANGES[targets[CoverageVariable.RAIN]]),
+            precipitation_deposits = random.randint(*WEATHER_LEVEL_RANGES[targets[CoverageVariable.GROUND_WATER]]),
+            cloudiness = random.randint(*WEATHER_LEVEL_RANGES[targets[CoverageVariable.CLOUD]]),
+            sun_altitude_angle = random.randint(*SUN_ALTITUDE_RANGES[targets[CoverageVariable.TIME_OF_DAY]])
+        ))
+
+        ego_spawn = test_setup.reversed_spawn(random.choice(self.get_ego_spawn_points(map,targets)))
+        test_setup.spawn_ego(world,ego_spawn)
+
+        actor_spawns = test_setup.spawn_points_near(map.get_spawn_points(),ego_spawn.location) + test_setup.lane_spawn_points_near(map,ego_spawn.location)
+        actor_spawns = [s for s in actor_spawns if (s.location - ego_spawn.location).length() > 5]
+        paths = []
+        if len(actor_spawns) > 0:
+            for blueprint_id in self.choose_actor_blueprints(targets):
+                path = test_setup.spawn_path_actor(world,blueprint_id,actor_spawns)
+                if path != None:
+                    paths.append(path)
+                    if blueprint_id in test_setup.EMERGENCY_BLUEPRINT_IDS and targets[CoverageVariable.EMERGENCY_VEHICLE_STATUS] == EmergencyVehicleStatus.SIREN:
+                        path[0].set_light_state(carla.VehicleLightState.Special1)
+        print("Spawned",len(paths),"actors")
+        test_setup.overhead_spectator(spectator,ego_spawn.location)
+        return paths
+
+    # Picks the blueprints to spawn near the ego. Cars, bikes and emergency vehicles all count towards
+    # vehicle density, so presence targets win over the density target when they disagree.
+    def choose_actor_blueprints(self,targets: Dict[CoverageVariable,Enum]):
+        blueprint_ids = []
+        if targets[CoverageVariable.EMERGENCY_VEHICLE_STATUS] != EmergencyVehicleStatus.ABSENT:
+            blueprint_ids.append(random.choice(test_setup.EMERGENCY_BLUEPRINT_IDS))
+        vehicle_pool = []
+        if targets[CoverageVariable.CARS_PRESENT] == BooleanEnum.TRUE:
+            vehicle_pool.extend(test_setup.CAR_BLUEPRINT_IDS)
+            blueprint_ids.append(random.choice(test_setup.CAR_BLUEPRINT_IDS))
+        if targets[CoverageVariable.BIKES_PRESENT] == BooleanEnum.TRUE:
+            vehicle_pool.extend(test_setup.BIKE_BLUEPRINT_IDS)
+            blueprint_ids.append(random.choice(test_setup.BIKE_BLUEPRINT_IDS))
+        vehicle_count = random.randint(*DENSITY_LEVEL_ACTOR_COUNTS[targets[CoverageVariable.VEHICLE_DENSITY]])
+        if len(vehicle_pool) > 0:
+            blueprint_ids.extend(random.choice(vehicle_pool) for _ in range(vehicle_count - len(blueprint_ids)))
+        pedestrian_count = random.randint(*DENSITY_LEVEL_ACTOR_COUNTS[targets[CoverageVariable.PEDESTRIAN_DENSITY]])
+        blueprint_ids.extend(random.choice(test_setup.PEDESTRIAN_BLUEPRINT_IDS) for _ in range(pedestrian_count))
+        return blueprint_ids
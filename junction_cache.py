@@ -0,0 +1,56 @@
+from carla_backend import carla
+import numpy as np
+from typing import Dict
+
+# Everything derived from an entry lane of a junction, filled in the first time the ego enters from it
+class JunctionEntry:
+    def __init__(self,entrypoint: carla.Waypoint,destinations):
+        self.entrypoint = entrypoint
+        self.destinations = destinations
+        self.roundabout = None
+        self.status = None
+        self.partitioned_junction = None
+
+# Junction geometry that never changes for the loaded map, so only needs querying once per junction
+class JunctionTopology:
+    def __init__(self,junction: carla.Junction):
+        self.junction = junction
+        self.id = junction.id
+        self.bounding_box = junction.bounding_box
+        self.waypoints = junction.get_waypoints(carla.LaneType.Driving)
+        self.entrypoints = [t[0] for t in self.waypoints]
+        self._entry_locations = np.array([[e.transform.location.x,e.transform.location.y,e.transform.location.z] for e in self.entrypoints]).reshape(-1,3)
+        self.entries: Dict[int,JunctionEntry] = {}
+        # (up, down, left, right) connections of the junction
+        self.road_graph = None
+
+    # Index of the first entrypoint closest to location, entrypoints shared by several paths map to the same index
+    def nearest_entrypoint_index(self,location: carla.Location):
+        offsets = self._entry_locations - np.array([location.x,location.y,location.z])
+        return int(np.argmin(np.einsum('ij,ij->i',offsets,offsets)))
+
+    def get_entry(self,index: int):
+        entry = self.entries.get(index)
+        if entry == None:
+            location = self.entrypoints[index].transform.location
+            destinations = [w[1] for w in self.waypoints if (w[0].transform.location - location).length() < 0.01]
+            entry = JunctionEntry(self.entrypoints[index],destinations)
+            self.entries[index] = entry
+        return entry
+
+class JunctionTopologyCache:
+    def __init__(self):
+        self._topologies: Dict[int,JunctionTopology] = {}
+
+    def __len__(self):
+        return len(self._topologies)
+
+    def __contains__(self,junction_id: int):
+        return junction_id in self._topologies
+
+    def get(self,junction: carla.Junction):
+        topology = self._topologies.get(junction.id)
+        if topology == None:
+            topology = JunctionTopology(junction)
+            self._topologies[junction.id] = topology
+        return topology
@@ -1,6 +1,6 @@
 import argparse
 import random
-import carla
+from carla_backend import carla
 from assertion import Assertion
 from validity_requirements import *
 from coverage import *
@@ -9,62 +9,194 @@ import time
 import test_setup
 import numpy as np
 import score_writer
-from world_state import WorldState, dot2d, get_emergency_vehicle_status
+from world_state import WorldState, EmergencyVehicleRegistry, WalkerRegistry, build_coverage_space
 from fnmatch import fnmatch
 import pygame
 from game import Game
-from os import linesep
+import os
 import game_setup
 from checker_utils import *
-import random
-
-class TestActor:
-    def __init__(self):
-        self.pos = 0
-    def getPos(self):
-        return self.pos
-
-off_road_event_flag = False
-static_collision_event_flag = False
-no_stopping_line_event_flag = False
-no_overtaking_event_flag = False
-crossing_into_right_lane_event_flag = False
+from actor_snapshot import ActorSnapshotCache
+from map_cache import load_lane_grid
+from junction_cache import JunctionTopologyCache
+from persistence import AsyncWriter, FsyncPolicy
+from sensor_events import SensorEventBus
+from guided_scenario import GuidedScenarioGenerator
+from rules import ScenarioContext, build_assertions, get_bin_bits, assertionCheckTick
+from scenario_trace import TraceRecorder, new_trace_path
+from profiler import TickProfiler, DisabledProfiler
+from npc_control import NpcController, PATH_FOLLOWERS
+
+# Coverage and score output shared by every scenario run in this process
+class TestSession:
+    def __init__(self,writer: AsyncWriter,out_directory: str = "out",profile: bool = False):
+        self.writer = writer
+        self.out_directory = out_directory
+        os.makedirs(out_directory,exist_ok=True)
+        self.timestamp = time.strftime("%d-%m-%Y_%H-%M-%S",time.localtime())
+        # Coverage only needs the micro-bin ids and validity requirements, which don't depend on the scenario
+        assertion_catalogue = build_assertions(ScenarioContext())
+        coverage_space = build_coverage_space()
+        self.global_coverage = Coverage(out_directory+"/global_coverage.csv",assertion_catalogue,coverage_space,writer=writer)
+        self.session_coverage = Coverage(out_directory+"/coverage_"+self.timestamp+".csv",assertion_catalogue,coverage_space,writer=writer)
+        self.scorer = score_writer.ScoreWriter(out_directory+"/score_"+self.timestamp+".csv",writer=writer)
+        self.new_covered_cases = 0
+        if profile:
+            self.profiler = TickProfiler(out_directory+"/profile_"+self.timestamp,writer=writer)
+        else:
+            self.profiler = DisabledProfiler()
+
+    def close(self):
+        self.profiler.close()
+
+# Sleeps so tick is called at most rate times a second, never sleeps if rate is None
+class TickClock:
+    def __init__(self,rate: float = None):
+        self.period = 0 if rate == None else 1 / rate
+        self._last_tick = time.perf_counter()
+
+    def tick(self):
+        if self.period <= 0:
+            return
+        remaining = self.period - (time.perf_counter() - self._last_tick)
+        if remaining > 0:
+            time.sleep(remaining)
+        self._last_tick = time.perf_counter()
+
+# The simulator only advances when world.tick() is called, by delta_seconds of simulated time each step.
+# Returns the settings beforehand so they can be restored.
+def enable_synchronous_mode(world,delta_seconds: float):
+    previous_settings = world.get_settings()
+    settings = world.get_settings()
+    settings.synchronous_mode = True
+    settings.fixed_delta_seconds = delta_seconds
+    world.apply_settings(settings)
+    return previous_settings
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-s","--scenario",default="none")
     parser.add_argument("-r","--random",action='store_true')
+    parser.add_argument("--host",default="localhost")
+    parser.add_argument("--port",type=int,default=2000)
+    parser.add_argument("--precompute-junctions",action='store_true')
+    parser.add_argument("--fsync",choices=[p.name.lower() for p in FsyncPolicy],default=FsyncPolicy.ON_FLUSH.name.lower())
+    parser.add_argument("--headless",action='store_true',help="Run random scenarios back to back without the pygame window")
+    parser.add_argument("--scenarios",type=int,default=1,help="Number of random scenarios to run when headless")
+    parser.add_argument("--max-ticks",type=int,default=None,help="Tick budget per scenario")
+    parser.add_argument("--max-seconds",type=float,default=None,help="Wall clock budget per scenario")
+    parser.add_argument("--sync",action='store_true',help="Step the simulator with world.tick() instead of letting it run freely")
+    parser.add_argument("--delta",type=float,default=0.1,help="Simulated seconds per tick")
+    parser.add_argument("--max-speed",action='store_true',help="Tick as fast as possible instead of in real time, needs --sync")
+    parser.add_argument("--seed",type=int,default=None,help="Seed for scenario generation and ego behaviour")
+    parser.add_argument("--guided",action='store_true',help="Aim random scenarios at the least covered variable values")
+    parser.add_argument("--record",action='store_true',help="Write a trace of each scenario under out/traces that replay.py can re-check offline")
+    parser.add_argument("--npc-follower",choices=list(PATH_FOLLOWERS),default="pure_pursuit",help="How NPCs are driven along their paths")
+    parser.add_argument("--profile",action='store_true',help="Time each tick stage and assertion oracle into out/profile_<time>.csv and .jsonl")
     args = parser.parse_args()
+    if args.max_speed and not args.sync:
+        parser.error("--max-speed needs --sync")
+    if args.seed != None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
 
-    has_junction = False
-    junction_status = JunctionStates.NONE
-    quads = None
-    
-    client = carla.Client('localhost', 2000)
+    client = carla.Client(args.host, args.port)
     client.set_timeout(25)
+
+    if args.headless:
+        return run_headless(client,args)
+
     world, is_test_scenario = test_setup.setupForTest(args.scenario,client)
 
     pygame.init()
     screen = pygame.display.set_mode((640,480))
 
     if not is_test_scenario:
-        kill_list = [a for a in world.get_actors() if fnmatch(a.type_id,"*walker*") or fnmatch(a.type_id,"*vehicle*") or fnmatch(a.type_id,"*sensor*")]
-        for a in kill_list:
-            a.destroy()
+        clear_scenario_actors(world)
         if not args.random:
             world = game_setup.world_settings_loop(screen,client,world)
 
-    world_state = WorldState(world)
     map = world.get_map()
     spectator = world.get_spectator()
 
-    vehicle_paths = []
-    if not is_test_scenario:
-        if args.random:
-            vehicle_paths = setup_random_scenario(world,map,spectator)
-        else:
-            vehicle_paths = game_setup.game_setup_loop(screen,spectator,world,map)
+    persistence_writer = AsyncWriter(FsyncPolicy[args.fsync.upper()])
+    session = None
+    try:
+        session = TestSession(persistence_writer,profile=args.profile)
+        vehicle_paths = []
+        if not is_test_scenario:
+            if args.random:
+                vehicle_paths = get_scenario_generator(args,session)(world,map,spectator)
+            else:
+                vehicle_paths = game_setup.game_setup_loop(screen,spectator,world,map)
+        run_scenario(client,world,vehicle_paths,is_test_scenario,session,args,game=Game(screen))
+    finally:
+        if session != None:
+            session.close()
+        persistence_writer.close()
+
+# Runs args.scenarios random scenarios one after another with no UI, each until its tick or time budget runs out
+def run_headless(client: carla.Client,args):
+    persistence_writer = AsyncWriter(FsyncPolicy[args.fsync.upper()])
+    session = None
+    try:
+        session = TestSession(persistence_writer,profile=args.profile)
+        run_random_scenarios(client,args,session)
+        session.global_coverage.print_coverage()
+    finally:
+        if session != None:
+            session.close()
+        persistence_writer.close()
+
+# Returns the function used to set up random scenarios, called as setup(world, map, spectator)
+def get_scenario_generator(args,session: TestSession):
+    if args.guided:
+        return GuidedScenarioGenerator(session.global_coverage).setup
+    return setup_random_scenario
+
+def run_random_scenarios(client: carla.Client,args,session: TestSession):
+    setup_scenario = get_scenario_generator(args,session)
+    for i in range(args.scenarios):
+        world = client.get_world()
+        clear_scenario_actors(world)
+        vehicle_paths = setup_scenario(world,world.get_map(),world.get_spectator())
+        ticks = run_scenario(client,world,vehicle_paths,False,session,args)
+        print("Scenario",i + 1,"of",args.scenarios,"ran for",ticks,"ticks")
+        clear_scenario_actors(world)
+
+def clear_scenario_actors(world):
+    kill_list = [a for a in world.get_actors() if fnmatch(a.type_id,"*walker*") or fnmatch(a.type_id,"*vehicle*") or fnmatch(a.type_id,"*sensor*")]
+    for a in kill_list:
+        a.destroy()
+
+# Checks the assertions every tick until the budget in args runs out, or forever when there isn't one.
+# Returns the number of ticks run.
+def run_scenario(client: carla.Client,world,vehicle_paths,is_test_scenario: bool,session: TestSession,args,game: Game = None):
+    if not args.sync:
+        return run_scenario_ticks(client,world,vehicle_paths,is_test_scenario,session,args,game)
+    previous_settings = enable_synchronous_mode(world,args.delta)
+    try:
+        # Actors spawned while setting up only appear once the world has been stepped
+        world.tick()
+        return run_scenario_ticks(client,world,vehicle_paths,is_test_scenario,session,args,game)
+    finally:
+        world.apply_settings(previous_settings)
+
+def run_scenario_ticks(client: carla.Client,world,vehicle_paths,is_test_scenario: bool,session: TestSession,args,game: Game = None):
+    has_junction = False
+
+    snapshots = ActorSnapshotCache()
+    junction_cache = JunctionTopologyCache()
+    emergency_registry = EmergencyVehicleRegistry(world,snapshots)
+    walker_registry = WalkerRegistry(world)
+    world_state = WorldState(world,snapshots,junction_cache,emergency_registry)
+    spectator = world.get_spectator()
+
+    # Per tick waypoint lookups are answered from the rasterised lanes of the map
+    map = load_lane_grid(world.get_map())
+    if args.precompute_junctions:
+        precompute_junction_topologies(map,junction_cache)
 
     ego_vehicle = None
     non_ego_actors = [x for x in world.get_actors()]
@@ -76,257 +208,133 @@ def main():
             break
     if ego_vehicle == None:
         print("Couldn't find ego vehicle in",len(non_ego_vehicles),"vehicles searched")
-        return -1
+        return 0
     
     non_ego_actors = [x for x in non_ego_actors if x.id != ego_vehicle.id]
     other_vehicles_and_pedestrians = [x for x in non_ego_actors if vehicle_or_pedestrian(x)]
     non_ego_vehicles = [x for x in non_ego_vehicles if x.id != ego_vehicle.id]
 
-    global off_road_event_flag
-    global no_overtaking_event_flag
-    global no_stopping_line_event_flag
-    global crossing_into_right_lane_event_flag
-    off_road_event_flag = False
+    event_bus = SensorEventBus()
     li_blueprint = world.get_blueprint_library().find('sensor.other.lane_invasion')
     lane_invasion_sensor = world.spawn_actor(li_blueprint,carla.Transform(carla.Location(0,0,0)),attach_to=ego_vehicle)
-    lane_invasion_sensor.listen(lane_callback)
+    lane_invasion_sensor.listen(event_bus.lane_callback)
 
-    global static_collision_event_flag
-    static_collision_event_flag = False
     collision_blueprint = world.get_blueprint_library().find('sensor.other.collision')
     collision_sensor = world.spawn_actor(collision_blueprint,carla.Transform(carla.Location(0,0,0)),attach_to=ego_vehicle)
-    collision_sensor.listen(collision_callback)
-
-    for i,s in enumerate(world.get_map().get_spawn_points()):
-        world.debug.draw_string(s.location + carla.Vector3D(0,0,2),str(i),life_time=60)
-
-    traffic_light_status = (False,False)
-    
-    active_assertions = [
-        Assertion(126, 0,
-                "Maintain a safe stopping distance",
-                (lambda: any(within_box_in_front_of_vehicle(ego_vehicle,t,stoppingDistance(ego_vehicle.get_velocity().length()) + 5,world) for t in other_vehicles_and_pedestrians)),
-                (lambda: not any(within_box_in_front_of_vehicle(ego_vehicle,t,stoppingDistance(ego_vehicle.get_velocity().length()),world) for t in other_vehicles_and_pedestrians)),
-                previous_tick_precondition=True,
-                validityRequirements=ValidityRequirement({
-                    CoverageVariable.VEHICLE_DENSITY: [Levels.LOW, Levels.MEDIUM,Levels.HIGH,Levels.VERY_HIGH]
-                }
-                )),
-        Assertion(124, 0,
-                "You must not exceed maximum speed limits",
-                (lambda: ego_vehicle.get_speed_limit() != None),
-                (lambda: ego_vehicle.get_velocity().length() <= ego_vehicle.get_speed_limit())
-                ),
-        Assertion(170, 0,
-                  "Give way to vehicles on major road",
-                  lambda: junction_status == JunctionStates.T_ON_MINOR and any(vehicleInJunction(v,currentJunction(ego_vehicle,map)) for v in non_ego_vehicles),
-                  lambda: not (junction_status == JunctionStates.T_ON_MINOR 
-                               and any(vehicleInJunction(v,currentJunction(ego_vehicle,map)) and (not performingSafeLeftTurn(ego_vehicle,v,quads,junction_status) and not performingSafeRightTurn(ego_vehicle,v,quads,junction_status)) for v in non_ego_vehicles)) 
-                               or ego_vehicle.get_velocity().length() < 0.1,
-                  validityRequirements=IN_JUNCTION_REQUIREMENTS
-                ),
-        Assertion(170, 1,
-                  "Give way to vehicles on major road (major case)",
-                  lambda: junction_status == JunctionStates.T_ON_MAJOR and any(vehicleInJunction(v,currentJunction(ego_vehicle,map)) for v in non_ego_vehicles),
-                  lambda: (not (junction_status == JunctionStates.T_ON_MAJOR and (any(vehicleInJunction(v,currentJunction(ego_vehicle,map)) for v in non_ego_vehicles))) or straightOnAtJunction(ego_vehicle,junction_status))
-                            or ego_vehicle.get_velocity().length() < 0.1,
-                  validityRequirements=IN_JUNCTION_REQUIREMENTS
-                ),
-        Assertion(103,0,
-                  "Give signals before manoeuvering at junctions",
-                  lambda: junction_status != JunctionStates.NONE,
-                  lambda: ((ego_vehicle.get_light_state() == carla.VehicleLightState.RightBlinker or not ego_vehicle.get_control().steer > 0) and (ego_vehicle.get_light_state() == carla.VehicleLightState.LeftBlinker or not ego_vehicle.get_control().steer < 0)) or not junction_status != JunctionStates.NONE,
-                  validityRequirements=IN_JUNCTION_REQUIREMENTS
-                ),
-        Assertion(219,0,
-                  "Stop to let emergency service vehicles pass",
-                  lambda: active_emergency_vehicle_within_distance(ego_vehicle,world,50),
-                  lambda: parked_left(ego_vehicle,map) or not active_emergency_vehicle_within_distance(ego_vehicle,world,30),
-                  validityRequirements=ValidityRequirement({CoverageVariable.EMERGENCY_VEHICLE_STATUS: [EmergencyVehicleStatus.PRESENT,EmergencyVehicleStatus.SIREN]})
-                  ),
-        Assertion(238,0,
-                  "No waiting or parking on yellow or red lines",
-                  lambda: lane_markings_present(ego_vehicle,map,[carla.LaneMarkingType.Solid,carla.LaneMarkingType.SolidSolid],colors=[carla.LaneMarkingColor.Red,carla.LaneMarkingColor.Yellow]) and not active_emergency_vehicle_within_distance(ego_vehicle,world,50),
-                  lambda: not (parked_left(ego_vehicle,map) and no_stopping_line_event_flag)
-                  ),
-        Assertion(129,0,
-                  "Must not cross solid road markings",
-                  lambda: lane_markings_present(ego_vehicle,map,[carla.LaneMarkingType.Solid,carla.LaneMarkingType.SolidSolid,carla.LaneMarkingType.SolidBroken,carla.LaneMarkingType.BrokenSolid]),
-                  lambda: not (no_overtaking_event_flag and not any([v.get_velocity().length() <= 0 and vehicle_in_overtake_range(ego_vehicle,v,world) for v in non_ego_vehicles]))),
-        Assertion(160,
-                  0,
-                  "Stay in the left lane unless safely overtaking",
-                  lambda: not not_in_left_lane(ego_vehicle,map,junction_status),
-                  lambda: not (not_in_left_lane(ego_vehicle,map,junction_status) and not any([vehicle_in_overtake_range(ego_vehicle,v,world) for v in non_ego_vehicles])),
-                  previous_tick_precondition=True
-                  ),
-        Assertion(0,0,
-                  "Must stop at traffic lights",
-                  lambda: traffic_light_status[0],
-                  lambda: (ego_vehicle.get_velocity().length() <= 0 or ego_vehicle.get_control().brake > ego_vehicle.get_control().throttle) or not (traffic_light_status[0] and not traffic_light_status[1])
-                  ),
-        Assertion(0,1,
-                  "Stay on road",
-                  lambda: True,
-                  lambda: not off_road_event_flag),
-        Assertion(0,2,
-                  "Collision with terrain",
-                  lambda: True,
-                  lambda: not static_collision_event_flag)
-    ]
-
-    session_timestamp = time.strftime("%d-%m-%Y_%H-%M-%S",time.localtime())
-
-    global_coverage = Coverage("out/global_coverage.csv",active_assertions,world_state.coverage_space)
-    session_coverage = Coverage("out/coverage_"+session_timestamp+".csv",active_assertions,world_state.coverage_space)
-    scorer = score_writer.ScoreWriter("out/score_"+session_timestamp+".csv")
-
-    clock = pygame.time.Clock()
-    game = Game(screen)
-    new_covered_cases_in_session = 0
+    collision_sensor.listen(event_bus.collision_callback)
+    if args.sync:
+        world.tick()
+
+    if game != None:
+        for i,s in enumerate(world.get_map().get_spawn_points()):
+            world.debug.draw_string(s.location + carla.Vector3D(0,0,2),str(i),life_time=60)
+
+    # Oracles read actor state through the per-tick snapshot rather than the actors themselves
+    ctx = ScenarioContext(world,map,snapshots.track(ego_vehicle),
+                          [snapshots.track(x) for x in other_vehicles_and_pedestrians],
+                          [snapshots.track(x) for x in non_ego_vehicles],
+                          emergency_registry,walker_registry)
+    ego_vehicle = ctx.ego_vehicle
+    active_assertions = build_assertions(ctx)
+    profiler = session.profiler
+    profiler.instrument_assertions(active_assertions)
+    validity_matcher = CompiledValidityMatcher([a.validityRequirements for a in active_assertions],world_state.coverage_space)
+
+    npc_controller = NpcController(client,world,map,vehicle_paths,args.npc_follower)
+
+    recorder = None
+    if args.record:
+        recorder = TraceRecorder(new_trace_path(os.path.join(session.out_directory,"traces"),session.timestamp),ctx,world_state.coverage_space,world.get_map().name)
+
+    clock = TickClock(None if args.max_speed else 1 / args.delta)
+    ticks = 0
+    start_time = time.perf_counter()
     
-    while True:
-
-        if not is_test_scenario:
-            if len(other_vehicles_and_pedestrians) > 0:
-                execute_vehicle_behaviour(vehicle_paths,world)
-            execute_ego_behaviour(ego_vehicle)
-
-        traffic_light_status = american_traffic_light_status(ego_vehicle,map,world)
-        current_junction = currentJunction(ego_vehicle,map)
-
-        # Might cause issues for double junctions
-        if current_junction == None and has_junction:
-            has_junction = False
-            junction_status = JunctionStates.NONE
-            quads = None
-        if not has_junction and current_junction != None:
-            has_junction = True
-            junction_status, quads = getJunctionStatus(ego_vehicle,current_junction)
-            print(junction_status)
-
-        qual_vars = world_state.get_coverage_state(ego_vehicle,non_ego_vehicles,map)
-        score_change, triggered_assertions, covered_assertions, valid_assertions, bug_descriptions = assertionCheckTick(active_assertions,qual_vars)
-        new_covered_cases_in_session += global_coverage.try_cover(qual_vars,triggered_assertions,covered_assertions,valid_assertions)
-        session_coverage.try_cover(qual_vars,triggered_assertions,covered_assertions,valid_assertions)
-
-        # world.debug.draw_line(ego_wp.transform.location,ego_wp.transform.location + carla.Vector3D(0,0,5),life_time=0.1)
-        # for w in ego_wp.next(10):
-        #     world.debug.draw_line(w.transform.location,w.transform.location + carla.Vector3D(0,0,5),color=carla.Color(0,255,0),life_time=0.1)
-        # for w in ego_wp.previous(10):
-        #     world.debug.draw_line(w.transform.location,w.transform.location + carla.Vector3D(0,0,5),color=carla.Color(0,0,255),life_time=0.1)
-
-        if score_change != 0:
-            scorer.add_and_update_scenario_score(score_change)
-
-        off_road_event_flag = False
-        static_collision_event_flag = False
-        no_stopping_line_event_flag = False
-        no_overtaking_event_flag = False
-        crossing_into_right_lane_event_flag = False
-
-        game.update_score_text(str(scorer.score),str(new_covered_cases_in_session),bug_descriptions)
-        global_max, _, global_covered = global_coverage.get_num_cases()
-        game.update_global_coverage_progress(global_covered,global_max)
-        game.handle_input()
-        game.render()
-        if (spectator.get_location() - ego_vehicle.get_location()).length() > 32:
-            spec_trans = spectator.get_transform()
-            ego_loc = ego_vehicle.get_location()
-            spectator.set_transform(carla.Transform(carla.Location(ego_loc.x,ego_loc.y,spec_trans.location.z),spec_trans.rotation))
-        clock.tick(10)
-
-def execute_vehicle_behaviour(vehicle_paths: List[Tuple[carla.Actor,List[carla.Location]]],world):
-    vehicles = [v[0] for v in vehicle_paths]
-    paths = [p[1] for p in vehicle_paths]
-    vehicle_threshold = 4
-    human_threshold = 1
-
-    for i in range(len(vehicles)):
-        is_vehicle = fnmatch(vehicles[i].type_id,"*vehicle*")
-        if is_vehicle:
-            threshold = vehicle_threshold
-        else:
-            threshold = human_threshold
-        loc_vec_2d = vehicles[i].get_location()
-        loc_vec_2d.z = 0
-        if len(paths[i]) > 0 and (loc_vec_2d - paths[i][0]).length() < threshold:
-            del paths[i][0]
-        if len(paths[i]) > 0:
-            forward_vec = vehicles[i].get_transform().get_forward_vector()
-            # print(vehicles[i].get_location())
-            dir_to_point = paths[i][0] - loc_vec_2d
-            if is_vehicle:
-                forward_vec.z = 0
-                dir_to_point.z = 0
-                dir_to_point = dir_to_point / dir_to_point.length()
-                steer = (1 - dot2d(forward_vec,dir_to_point))
-                if dot2d(vehicles[i].get_transform().get_right_vector(),dir_to_point) < 0:
-                    steer *= -1
-                vehicles[i].apply_control(carla.VehicleControl(throttle=0.6,steer=steer))
-            else:
-                vehicles[i].apply_control(carla.WalkerControl(direction=dir_to_point,speed=0.1))
-        else:
-            if is_vehicle:
-                vehicles[i].apply_control(carla.VehicleControl(brake=1))
-            else:
-                vehicles[i].apply_control(carla.WalkerControl())
-
-def execute_ego_behaviour(ego_vehicle):
-    ego_vehicle.apply_control(carla.VehicleControl(throttle=random.uniform(0,1),steer=random.uniform(-1,1)))
-
-def not_in_left_lane(ego_vehicle,map,junction_status):
-    global crossing_into_right_lane_event_flag
-    ego_loc = ego_vehicle.get_location()
-    ego_wp = map.get_waypoint(ego_loc)
-    return junction_status == JunctionStates.NONE and (crossing_into_right_lane_event_flag or
-                                                        (ego_wp.transform.location - map.get_waypoint(ego_loc + ego_vehicle.get_transform().get_right_vector() * ego_wp.lane_width).transform.location).length() < 0.1)
-
-def lane_callback(li_event):
-    global off_road_event_flag
-    global no_stopping_line_event_flag
-    global no_overtaking_event_flag
-    global crossing_into_right_lane_event_flag
-    crossed_markings = [l.type for l in li_event.crossed_lane_markings]
-    colors = [l.color for l in li_event.crossed_lane_markings]
-    if any([c in [carla.LaneMarkingType.Grass,carla.LaneMarkingType.Curb,carla.LaneMarkingType.NONE] for c in crossed_markings]):
-        off_road_event_flag = True
-    if any([c in [carla.LaneMarkingType.SolidSolid,carla.LaneMarkingType.SolidBroken] for c in crossed_markings]):
-        no_overtaking_event_flag = True
-    if any([c in [carla.LaneMarkingType.SolidSolid,carla.LaneMarkingType.SolidBroken,carla.LaneMarkingType.Broken,carla.LaneMarkingType.BrokenSolid,carla.LaneMarkingType.BrokenBroken] for c in crossed_markings]):
-        crossing_into_right_lane_event_flag = True
-    if any([c in [carla.LaneMarkingColor.Red,carla.LaneMarkingColor.Yellow] for c in colors]):
-        no_stopping_line_event_flag = True
-
-def collision_callback(col_event):
-    global static_collision_event_flag
-    if not vehicle_or_pedestrian(col_event.other_actor):
-        static_collision_event_flag = True
-
-def assertionCheckTick(assertions: List[assertion.Assertion],qualitative_coverage_state: List[Tuple[CoverageVariable,Enum]]):
-    score_change = 0
-    valid_assertions = []
-    covered_assertions = []
-    triggered_assertions = []
-    triggered_descriptions = []
-
-    for i in range(len(assertions)):
-        if assertions[i].IsActive(qualitative_coverage_state):
-            valid_assertions.append(assertions[i])
-            violated_before_tick = assertions[i].violated
-            assertions[i].Check()
-            if assertions[i].precondition_active_in_tick:
-                covered_assertions.append(assertions[i])
-                if assertions[i].violated_in_tick:
-                    triggered_assertions.append(assertions[i])
-            if assertions[i].violated and not violated_before_tick:
-                if assertions[i].zero_value:
-                    triggered_descriptions.append("- Unfair test: "+assertions[i].description)
-                else:
-                    triggered_descriptions.append("+ "+assertions[i].description)
-                    score_change += 1
-
-    return score_change, triggered_assertions, covered_assertions, valid_assertions, triggered_descriptions
+    try:
+        while (args.max_ticks == None or ticks < args.max_ticks) and (args.max_seconds == None or time.perf_counter() - start_time < args.max_seconds):
+            profiler.start_tick()
+
+            if not is_test_scenario:
+                npc_controller.apply(snapshots.world_snapshot,[carla.command.ApplyVehicleControl(ego_vehicle.id,random_ego_control())])
+            profiler.lap("npc_control")
+            if args.sync:
+                world.tick()
+            profiler.lap("world_tick")
+
+            snapshots.new_tick(world)
+            ctx.events = event_bus.take(snapshots.world_snapshot.frame)
+            emergency_registry.refresh(snapshots.world_snapshot)
+            walker_registry.refresh(snapshots.world_snapshot)
+            ctx.update_geometry()
+            profiler.lap("snapshot")
+            ctx.traffic_light_status = american_traffic_light_status(ego_vehicle,map,world)
+            current_junction = currentJunction(ego_vehicle,map)
+
+            # Might cause issues for double junctions
+            if current_junction == None and has_junction:
+                has_junction = False
+                ctx.junction_status = JunctionStates.NONE
+                ctx.quads = None
+            if not has_junction and current_junction != None:
+                has_junction = True
+                ctx.junction_status, ctx.quads = getJunctionStatus(ego_vehicle,current_junction,junction_cache)
+                print(ctx.junction_status)
+            profiler.lap("junction")
+
+            qual_vars = world_state.get_coverage_state(ego_vehicle,ctx.non_ego_vehicles,map,ctx.vehicle_index,ctx.pedestrian_index)
+            profiler.lap("coverage_state")
+            score_change, triggered_assertions, covered_assertions, valid_assertions, bug_descriptions = assertionCheckTick(active_assertions,qual_vars,validity_matcher)
+            profiler.lap("assertions")
+            coverage_key = world_state.coverage_space.encode_key(qual_vars)
+            valid_bits = get_bin_bits(valid_assertions)
+            covered_bits = get_bin_bits(covered_assertions)
+            violated_bits = get_bin_bits(triggered_assertions)
+            new_covered_cases, global_changed_bins = session.global_coverage.try_cover_bits(coverage_key,valid_bits,covered_bits,violated_bits)
+            session.new_covered_cases += new_covered_cases
+            profiler.lap("global_coverage")
+            session.session_coverage.try_cover_bits(coverage_key,valid_bits,covered_bits,violated_bits)
+            profiler.lap("session_coverage")
+            if recorder != None:
+                recorder.record(snapshots.world_snapshot.frame,snapshots.world_snapshot.timestamp.elapsed_seconds,ctx,coverage_key,world_state.get_weather())
+                profiler.lap("record")
+
+            # world.debug.draw_line(ego_wp.transform.location,ego_wp.transform.location + carla.Vector3D(0,0,5),life_time=0.1)
+            # for w in ego_wp.next(10):
+            #     world.debug.draw_line(w.transform.location,w.transform.location + carla.Vector3D(0,0,5),color=carla.Color(0,255,0),life_time=0.1)
+            # for w in ego_wp.previous(10):
+            #     world.debug.draw_line(w.transform.location,w.transform.location + carla.Vector3D(0,0,5),color=carla.Color(0,0,255),life_time=0.1)
+
+            if score_change != 0:
+                session.scorer.add_and_update_scenario_score(score_change)
+                profiler.lap("score")
+
+            if game != None:
+                # Text is only re-rendered when something it shows has changed
+                if score_change != 0 or new_covered_cases != 0 or len(bug_descriptions) > 0 or ticks == 0:
+                    game.update_score_text(str(session.scorer.score),str(session.new_covered_cases),bug_descriptions)
+                if len(global_changed_bins) > 0 or ticks == 0:
+                    global_max, _, global_covered = session.global_coverage.get_num_cases()
+                    game.update_global_coverage_progress(global_covered,global_max)
+                game.handle_input()
+                game.render()
+                if (spectator.get_location() - ego_vehicle.get_location()).length() > 32:
+                    spec_trans = spectator.get_transform()
+                    ego_loc = ego_vehicle.get_location()
+                    spectator.set_transform(carla.Transform(carla.Location(ego_loc.x,ego_loc.y,spec_trans.location.z),spec_trans.rotation))
+                profiler.lap("game")
+            if profiler.end_tick() and game != None:
+                game.update_profile_panel(profiler.get_slowest())
+            ticks += 1
+            clock.tick()
+    finally:
+        lane_invasion_sensor.stop()
+        collision_sensor.stop()
+        if recorder != None:
+            recorder.close()
+    return ticks
+
+def random_ego_control():
+    return carla.VehicleControl(throttle=random.uniform(0,1),steer=random.uniform(-1,1))
 
 def setup_random_scenario(world,map,spectator):
     
@@ -339,29 +347,17 @@ def setup_random_scenario(world,map,spectator):
     world.set_weather(weather_params)
     
     spawns = map.get_spawn_points()
-    ego_bp = world.get_blueprint_library().filter("vehicle.tesla.cybertruck")[0]
-    ego_bp.set_attribute('role_name', 'hero')
     ego_spawn = test_setup.reversed_spawn(random.choice(spawns))
-    ego = world.spawn_actor(ego_bp,ego_spawn)
-    actor_spawns = [t for t in spawns if (t.location - ego_spawn.location).length() < 25]
+    test_setup.spawn_ego(world,ego_spawn)
+    actor_spawns = test_setup.spawn_points_near(spawns,ego_spawn.location)
     actor_count = random.randrange(27)
     print("Spawned",actor_count,"vehicles")
-    vehicle_blueprint_ids = ["vehicle.audi.etron",
-                             "vehicle.chevrolet.impala",
-                             "walker.pedestrian.0001",
-                             "vehicle.harley-davidson.low_rider",
-                             "vehicle.dodge.charger_police",
-                             "vehicle.ford.mustang",
-                             "vehicle.carlamotors.carlacola",
-                             "vehicle.citroen.c3",
-                             "vehicle.diamondback.century"
-                             ]
     paths = []
     for i in range(actor_count):
-        actor = world.try_spawn_actor(world.get_blueprint_library().filter(random.choice(vehicle_blueprint_ids))[0],test_setup.reversed_spawn(random.choice(actor_spawns)))
-        if actor != None:
-            paths.append((actor,[random.choice(actor_spawns).location]))
-    spectator.set_transform(carla.Transform(ego.get_location() + carla.Vector3D(0,0,30),carla.Rotation(pitch=-90)))
+        path = test_setup.spawn_path_actor(world,random.choice(test_setup.ACTOR_BLUEPRINT_IDS),actor_spawns)
+        if path != None:
+            paths.append(path)
+    test_setup.overhead_spectator(spectator,ego_spawn.location)
     return paths
 
 if __name__ == '__main__':
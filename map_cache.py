@@ -0,0 +1,204 @@
+import os
+import math
+import tempfile
+import zipfile
+import numpy as np
+from carla_backend import carla
+
+MAP_CACHE_DIRECTORY = "out/map_cache"
+LANE_GRID_VERSION = 1
+
+# Rasterised lookup of the driving lanes of a map. Each cell stores the lane sample nearest its centre so
+# get_waypoint can be answered without querying the map. Queries outside the rasterised area, or on a
+# different level to the stored sample, fall back to the real map.
+class LaneGrid:
+    def __init__(self,map: carla.Map,samples: dict,origin: np.ndarray,resolution: float,cells: np.ndarray):
+        self.map = map
+        self.samples = samples
+        self.origin = origin
+        self.resolution = resolution
+        self.cells = cells
+        self.level_tolerance = 4
+        self._junctions = {}
+
+    def __getattr__(self,name):
+        return getattr(self.map,name)
+
+    def get_waypoint(self,location: carla.Location,project_to_road: bool = True,lane_type: carla.LaneType = carla.LaneType.Driving):
+        if not project_to_road or lane_type != carla.LaneType.Driving:
+            return self.map.get_waypoint(location,project_to_road,lane_type)
+        sample = self.get_sample(location)
+        if sample < 0:
+            return self.map.get_waypoint(location)
+        return GridWaypoint(self,sample,location)
+
+    # Returns the index of the lane sample for the cell containing location or -1 if there isn't one
+    def get_sample(self,location: carla.Location):
+        cell_x = int((location.x - self.origin[0]) // self.resolution)
+        cell_y = int((location.y - self.origin[1]) // self.resolution)
+        if cell_x < 0 or cell_y < 0 or cell_x >= self.cells.shape[0] or cell_y >= self.cells.shape[1]:
+            return -1
+        sample = int(self.cells[cell_x,cell_y])
+        if sample >= 0 and abs(self.samples["z"][sample] - location.z) > self.level_tolerance:
+            return -1
+        return sample
+
+    def get_junction(self,junction_id: int,waypoint: "GridWaypoint"):
+        junction = self._junctions.get(junction_id)
+        if junction == None:
+            junction = waypoint.resolve().get_junction()
+            if junction != None:
+                self._junctions[junction.id] = junction
+        return junction
+
+    def save(self,path: str):
+        save_npz(path,version=LANE_GRID_VERSION,origin=self.origin,resolution=self.resolution,cells=self.cells,**self.samples)
+
+class GridLaneMarking:
+    def __init__(self,marking_type: int,color: int):
+        self.type = carla.LaneMarkingType.values[marking_type]
+        self.color = carla.LaneMarkingColor.values[color]
+
+# Stands in for a carla.Waypoint, the location is the query projected onto the lane centre line.
+# Anything not held in the grid is read from the real waypoint, which is only looked up when needed.
+class GridWaypoint:
+    def __init__(self,grid: LaneGrid,sample: int,location: carla.Location):
+        self._grid = grid
+        self._query = location
+        self._waypoint = None
+        samples = grid.samples
+        yaw = float(samples["yaw"][sample])
+        forward_x = math.cos(math.radians(yaw))
+        forward_y = math.sin(math.radians(yaw))
+        sample_x = float(samples["x"][sample])
+        sample_y = float(samples["y"][sample])
+        along = (location.x - sample_x) * forward_x + (location.y - sample_y) * forward_y
+        self.transform = carla.Transform(carla.Location(sample_x + forward_x * along,sample_y + forward_y * along,float(samples["z"][sample])),
+                                         carla.Rotation(yaw=yaw))
+        self.lane_width = float(samples["lane_width"][sample])
+        self.road_id = int(samples["road_id"][sample])
+        self.section_id = int(samples["section_id"][sample])
+        self.lane_id = int(samples["lane_id"][sample])
+        self.junction_id = int(samples["junction_id"][sample])
+        self.is_junction = self.junction_id >= 0
+        self.left_lane_marking = GridLaneMarking(int(samples["left_type"][sample]),int(samples["left_color"][sample]))
+        self.right_lane_marking = GridLaneMarking(int(samples["right_type"][sample]),int(samples["right_color"][sample]))
+
+    def __getattr__(self,name):
+        return getattr(self.resolve(),name)
+
+    def resolve(self):
+        if self._waypoint == None:
+            self._waypoint = self._grid.map.get_waypoint(self._query)
+        return self._waypoint
+
+    def get_junction(self):
+        if not self.is_junction:
+            return None
+        return self._grid.get_junction(self.junction_id,self)
+
+# Returns a real carla.Waypoint for APIs that will not accept a GridWaypoint
+def carla_waypoint(waypoint):
+    if isinstance(waypoint,GridWaypoint):
+        return waypoint.resolve()
+    return waypoint
+
+def build_lane_grid(map: carla.Map,resolution: float = 1.0,sample_distance: float = 1.0):
+    waypoints = [w for w in map.generate_waypoints(sample_distance) if w.lane_type == carla.LaneType.Driving]
+    samples = {
+        "x": np.array([w.transform.location.x for w in waypoints]),
+        "y": np.array([w.transform.location.y for w in waypoints]),
+        "z": np.array([w.transform.location.z for w in waypoints]),
+        "yaw": np.array([w.transform.rotation.yaw for w in waypoints]),
+        "lane_width": np.array([w.lane_width for w in waypoints]),
+        "road_id": np.array([w.road_id for w in waypoints],dtype=np.int32),
+        "section_id": np.array([w.section_id for w in waypoints],dtype=np.int32),
+        "lane_id": np.array([w.lane_id for w in waypoints],dtype=np.int32),
+        "junction_id": np.array([w.get_junction().id if w.is_junction else -1 for w in waypoints],dtype=np.int32),
+        "left_type": np.array([int(w.left_lane_marking.type) for w in waypoints],dtype=np.int16),
+        "left_color": np.array([int(w.left_lane_marking.color) for w in waypoints],dtype=np.int16),
+        "right_type": np.array([int(w.right_lane_marking.type) for w in waypoints],dtype=np.int16),
+        "right_color": np.array([int(w.right_lane_marking.color) for w in waypoints],dtype=np.int16)
+    }
+    if len(waypoints) == 0:
+        return LaneGrid(map,samples,np.zeros(2),resolution,np.full((0,0),-1,dtype=np.int32))
+
+    # Each sample claims the cells within a lane width of it, closest sample wins
+    reach = samples["lane_width"].max()
+    origin = np.array([samples["x"].min() - reach,samples["y"].min() - reach])
+    shape = (int((samples["x"].max() + reach - origin[0]) // resolution) + 1,int((samples["y"].max() + reach - origin[1]) // resolution) + 1)
+    cells = np.full(shape,-1,dtype=np.int32)
+    best_distances = np.full(shape,np.inf)
+    sample_cell_x = ((samples["x"] - origin[0]) // resolution).astype(np.int64)
+    sample_cell_y = ((samples["y"] - origin[1]) // resolution).astype(np.int64)
+    sample_indices = np.arange(len(waypoints))
+    offset_range = int(math.ceil(reach / resolution))
+    for offset_x in range(-offset_range,offset_range + 1):
+        for offset_y in range(-offset_range,offset_range + 1):
+            cell_x = sample_cell_x + offset_x
+            cell_y = sample_cell_y + offset_y
+            distances = (origin[0] + (cell_x + 0.5) * resolution - samples["x"])**2 + (origin[1] + (cell_y + 0.5) * resolution - samples["y"])**2
+            in_range = (cell_x >= 0) & (cell_y >= 0) & (cell_x < shape[0]) & (cell_y < shape[1]) & (distances <= samples["lane_width"]**2)
+            flat_cells = cell_x[in_range] * shape[1] + cell_y[in_range]
+            distances = distances[in_range]
+            indices = sample_indices[in_range]
+            order = np.lexsort((distances,flat_cells))
+            first_in_cell = np.ones(len(order),dtype=bool)
+            first_in_cell[1:] = flat_cells[order][1:] != flat_cells[order][:-1]
+            order = order[first_in_cell]
+            closer = distances[order] < best_distances.flat[flat_cells[order]]
+            order = order[closer]
+            best_distances.flat[flat_cells[order]] = distances[order]
+            cells.flat[flat_cells[order]] = indices[order]
+    return LaneGrid(map,samples,origin,resolution,cells)
+
+# Writes arrays to path through a temporary file in the same directory, so a crash never leaves a partly
+# written cache and processes building the same cache at once each replace it whole
+def save_npz(path: str,**arrays):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path),prefix=os.path.basename(path)+".",suffix=".tmp")
+    try:
+        with os.fdopen(descriptor,'wb') as cachefile:
+            np.savez_compressed(cachefile,**arrays)
+        os.replace(temporary_path,path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+# Arrays saved at path, or None if there is no file or it can't be read
+def load_npz(path: str):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return {k: data[k] for k in data.files}
+    except (OSError,ValueError,EOFError,zipfile.BadZipFile) as e:
+        print("Ignoring unreadable cache",path+":",e)
+        return None
+
+# Saves a cache, reporting rather than raising if it can't be written as it can be rebuilt next time
+def try_save_cache(cache,path: str):
+    try:
+        cache.save(path)
+    except OSError as e:
+        print("Could not save cache",path+":",e)
+
+def lane_grid_path(map: carla.Map,directory: str = MAP_CACHE_DIRECTORY):
+    return os.path.join(directory,map.name.split("/")[-1]+"_lanes.npz")
+
+# Loads the lane grid for map from disk, building and saving it the first time the map is seen
+def load_lane_grid(map: carla.Map,resolution: float = 1.0,directory: str = MAP_CACHE_DIRECTORY):
+    path = lane_grid_path(map,directory)
+    data = load_npz(path)
+    if data != None:
+        try:
+            if int(data["version"]) == LANE_GRID_VERSION and float(data["resolution"]) == resolution:
+                samples = {k: data[k] for k in data if not (k in ["version","origin","resolution","cells"])}
+                return LaneGrid(map,samples,data["origin"],resolution,data["cells"])
+        except KeyError as e:
+            print("Ignoring lane grid",path,"missing",e)
+    print("Building lane grid for",map.name)
+    grid = build_lane_grid(map,resolution)
+    try_save_cache(grid,path)
+    return grid
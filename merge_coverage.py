@@ -0,0 +1,211 @@
+import argparse
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Tuple
+from coverage import CoverageStates, INVALID, STATE_NAMES, get_journal_path, read_coverage_header, read_coverage_file, read_journal_file
+
+# Macro-bins merged in memory before they are sorted and spilled to a run file
+DEFAULT_CHUNK_ROWS = 100000
+# Run files read at once by the final merge, more are first merged in rounds
+MAX_OPEN_RUNS = 64
+
+# Folds coverage snapshots and journals into one set of macro-bins without going through Coverage, so files
+# written with different assertion sets can be combined. Rows are merged in memory chunk_rows macro-bins at a
+# time, each chunk is spilled to a run file sorted by key, and write k-way merges the runs, so memory is
+# bounded by chunk_rows however large the inputs and the result are. Micro-bin columns are matched by id and
+# each micro-bin keeps the state with the lowest value (BUG > COVERED > UNCOVERED > INVALID).
+class CoverageMerger:
+    def __init__(self,chunk_rows: int = DEFAULT_CHUNK_ROWS,temporary_directory: str = None):
+        self.key_headers: List[str] = None
+        self.bin_ids: List[str] = []
+        self._bin_indices: Dict[str,int] = {}
+        self.chunk_rows = chunk_rows
+        self.merged_count = 0
+        self._directory = tempfile.mkdtemp(prefix="merge_coverage_",dir=temporary_directory)
+        self._runs: List[str] = []
+        self._run_count = 0
+        # Key cells in key_headers order to a bytearray of CoverageStates values, indexed like bin_ids, for the
+        # macro-bins of the chunk not yet spilled
+        self._chunk: Dict[Tuple[str],bytearray] = {}
+
+    # Removes the run files
+    def close(self):
+        shutil.rmtree(self._directory,ignore_errors=True)
+
+    def _get_bin_index(self,bin_id: str):
+        index = self._bin_indices.get(bin_id)
+        if index == None:
+            index = len(self.bin_ids)
+            self.bin_ids.append(bin_id)
+            self._bin_indices[bin_id] = index
+        return index
+
+    def _get_key_order(self,key_headers: List[str]):
+        if self.key_headers == None:
+            self.key_headers = list(key_headers)
+        if sorted(key_headers) != sorted(self.key_headers):
+            raise Exception("Coverage variables "+str(key_headers)+" don't match "+str(self.key_headers))
+        return [key_headers.index(h) for h in self.key_headers]
+
+    def _get_states(self,key: Tuple[str]):
+        states = self._chunk.get(key)
+        if states == None:
+            if len(self._chunk) >= self.chunk_rows:
+                self._spill()
+            states = bytearray()
+            self._chunk[key] = states
+        return states
+
+    def _merge_state(self,key: Tuple[str],bin_index: int,state: int):
+        states = self._get_states(key)
+        if bin_index >= len(states):
+            states.extend([INVALID] * (bin_index + 1 - len(states)))
+        if state < states[bin_index]:
+            states[bin_index] = state
+
+    def _new_run_path(self):
+        self._run_count += 1
+        return os.path.join(self._directory,"run_"+str(self._run_count)+".csv")
+
+    # Writes the chunk to a run file sorted by key
+    def _spill(self):
+        if len(self._chunk) == 0:
+            return
+        path = self._new_run_path()
+        write_run(path,sorted(self._chunk.items()))
+        self._runs.append(path)
+        self._chunk = {}
+
+    def add_coverage_file(self,path: str):
+        header = read_coverage_header(path)
+        if header == None:
+            return
+        key_order = self._get_key_order(header[0])
+        bin_indices = [self._get_bin_index(b) for b in header[1]]
+        for _, _, key_cells, state_cells in read_coverage_file(path):
+            key = tuple(key_cells[i] for i in key_order)
+            self._get_states(key)
+            for bin_index, cell in zip(bin_indices,state_cells):
+                self._merge_state(key,bin_index,CoverageStates[cell].value)
+
+    # Journal records carry no header, their key cells are in the column order of the coverage snapshot they
+    # belong to, which is the journal's path without .journal unless coverage_path is given
+    def add_journal_file(self,path: str,coverage_path: str = None):
+        if coverage_path == None:
+            coverage_path = path[:-len(".journal")] if path.endswith(".journal") else path
+        header = read_coverage_header(coverage_path) if os.path.isfile(coverage_path) else None
+        if header == None:
+            print("Skipping journal",path,"as its coverage file",coverage_path,"has no header")
+            return
+        key_order = self._get_key_order(header[0])
+        for key_cells, bin_id, state in read_journal_file(path):
+            if len(key_cells) != len(key_order) or not (state in CoverageStates.__members__):
+                continue
+            self._merge_state(tuple(key_cells[i] for i in key_order),self._get_bin_index(bin_id),CoverageStates[state].value)
+
+    # Writes the merged macro-bins to path in key order, through a temporary file so the old contents survive a
+    # failure. Returns the number of macro-bins written.
+    def write(self,path: str):
+        self._spill()
+        while len(self._runs) > MAX_OPEN_RUNS:
+            merged_path = self._new_run_path()
+            write_run(merged_path,merge_runs(self._runs[:MAX_OPEN_RUNS]))
+            for p in self._runs[:MAX_OPEN_RUNS]:
+                os.remove(p)
+            self._runs = self._runs[MAX_OPEN_RUNS:] + [merged_path]
+
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+        self.merged_count = 0
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'w', newline='') as coveragefile:
+            writer = csv.writer(coveragefile)
+            writer.writerow(self.key_headers + self.bin_ids)
+            for key, states in merge_runs(self._runs):
+                writer.writerow(list(key) + [STATE_NAMES[x] for x in states] + [STATE_NAMES[INVALID]] * (len(self.bin_ids) - len(states)))
+                self.merged_count += 1
+        os.replace(temporary_path,path)
+        return self.merged_count
+
+# Run files hold one row per macro-bin in key order: the key cells, then its states as one digit per micro-bin
+def write_run(path: str,cases):
+    with open(path, 'w', newline='') as runfile:
+        writer = csv.writer(runfile)
+        for key, states in cases:
+            writer.writerow(list(key) + ["".join(str(x) for x in states)])
+
+def read_run(path: str):
+    with open(path, 'r', newline='') as runfile:
+        for row in csv.reader(runfile):
+            yield tuple(row[:-1]), bytearray(int(c) for c in row[-1])
+
+# Each micro-bin keeps the lower state, missing trailing micro-bins are INVALID
+def merge_states(a: bytearray,b: bytearray):
+    if len(a) < len(b):
+        a, b = b, a
+    return bytearray(min(x,y) for x, y in zip(a,b)) + a[len(b):]
+
+# Streams (key, states) in key order from run files, combining the rows of each key across runs
+def merge_runs(paths: List[str]):
+    key = None
+    states = None
+    for run_key, run_states in heapq.merge(*[read_run(p) for p in paths],key=lambda row: row[0]):
+        if run_key == key:
+            states = merge_states(states,run_states)
+            continue
+        if key != None:
+            yield key, states
+        key, states = run_key, run_states
+    if key != None:
+        yield key, states
+
+def get_input_paths(paths: List[str]):
+    input_paths = []
+    for p in paths:
+        if os.path.isdir(p):
+            input_paths.extend(sorted(os.path.join(p,f) for f in os.listdir(p) if f.endswith(".csv") and "coverage" in f))
+        else:
+            input_paths.append(p)
+    return input_paths
+
+# Merges every coverage file in paths, and the journal next to each, into output_path
+def merge_coverage_files(paths: List[str],output_path: str,include_journals: bool = True,chunk_rows: int = DEFAULT_CHUNK_ROWS):
+    # Run files go next to the output, where there is room for it
+    if os.path.dirname(output_path) != "":
+        os.makedirs(os.path.dirname(output_path),exist_ok=True)
+    merger = CoverageMerger(chunk_rows,os.path.dirname(output_path) or None)
+    try:
+        input_paths = get_input_paths(paths)
+        for p in input_paths:
+            if os.path.isfile(p):
+                merger.add_coverage_file(p)
+        if include_journals:
+            for p in input_paths:
+                if os.path.isfile(get_journal_path(p)):
+                    merger.add_journal_file(get_journal_path(p),p)
+        if merger.key_headers == None:
+            raise Exception("No coverage files found in "+str(paths))
+        merger.write(output_path)
+    finally:
+        merger.close()
+    # The output's own journal has been folded into the new snapshot
+    if include_journals and output_path in input_paths and os.path.isfile(get_journal_path(output_path)):
+        os.remove(get_journal_path(output_path))
+    return merger
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge coverage files, taking the most severe state of each micro-bin")
+    parser.add_argument("inputs",nargs="+",help="Coverage files, or directories of them")
+    parser.add_argument("-o","--output",default="out/global_coverage.csv")
+    parser.add_argument("--no-journals",action='store_true',help="Ignore the .journal file next to each input")
+    parser.add_argument("--chunk-rows",type=int,default=DEFAULT_CHUNK_ROWS,help="Macro-bins held in memory before they are spilled to a temporary file")
+    args = parser.parse_args()
+
+    merger = merge_coverage_files(args.inputs,args.output,not args.no_journals,args.chunk_rows)
+    print("Merged",merger.merged_count,"macro-bins over",len(merger.bin_ids),"micro-bins into",args.output)
+
+if __name__ == '__main__':
+    main()
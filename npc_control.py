@@ -0,0 +1,137 @@
+from carla_backend import carla
+import numpy as np
+from fnmatch import fnmatch
+from typing import List, Tuple
+from path_following import PurePursuitFollower
+
+# Steers vehicles by 1 - forward . direction to the next point of their path, towards the side the point is
+# on, at a fixed throttle, without looking at the roads. A point counts as reached within vehicle_threshold
+# metres (human_threshold for walkers), and actors brake or stop once their path is used up.
+class PointFollower:
+    vehicle_threshold = 4
+    human_threshold = 1
+    throttle = 0.6
+    walker_speed = 0.1
+
+    def __init__(self,map: carla.Map,vehicle_paths: List[Tuple[carla.Actor,List[carla.Location]]]):
+        self.is_vehicle = np.array([fnmatch(p[0].type_id,"*vehicle*") for p in vehicle_paths],dtype=bool)
+        self.thresholds = np.where(self.is_vehicle,self.vehicle_threshold,self.human_threshold)
+
+        # Every path's points one after another, path i runs from path_starts[i] to path_ends[i]
+        points = [(l.x,l.y,l.z) for p in vehicle_paths for l in p[1]]
+        self.points = np.array(points,dtype=float).reshape(len(points),3)
+        lengths = np.array([len(p[1]) for p in vehicle_paths],dtype=np.int64)
+        self.path_ends = np.cumsum(lengths)
+        self.path_starts = self.path_ends - lengths
+        # Index into points of the point each actor is heading for
+        self.next_points = self.path_starts.copy()
+
+    # Moves on to the following point for actors within their threshold of the one they are heading for,
+    # and returns the (N,3) offsets from each actor to its next point on the ground, NaN once a path is used up
+    def advance(self,positions: np.ndarray):
+        offsets = np.full((len(positions),3),np.nan)
+        has_point = self.next_points < self.path_ends
+        targets = self.points[np.minimum(self.next_points[has_point],len(self.points) - 1)]
+        offsets[has_point,0] = targets[:,0] - positions[has_point,0]
+        offsets[has_point,1] = targets[:,1] - positions[has_point,1]
+        offsets[has_point,2] = targets[:,2]
+        reached = np.zeros(len(positions),dtype=bool)
+        reached[has_point] = np.linalg.norm(offsets[has_point],axis=1) < self.thresholds[has_point]
+        if reached.any():
+            self.next_points[reached] += 1
+            offsets[reached] = np.nan
+            still_has_point = reached & (self.next_points < self.path_ends)
+            targets = self.points[self.next_points[still_has_point]]
+            offsets[still_has_point,0] = targets[:,0] - positions[still_has_point,0]
+            offsets[still_has_point,1] = targets[:,1] - positions[still_has_point,1]
+            offsets[still_has_point,2] = targets[:,2]
+        return offsets
+
+    # Steer for each vehicle given its yaw in degrees and the offset to its next point
+    def get_steering(self,yaws: np.ndarray,offsets: np.ndarray):
+        yaw = np.radians(yaws)
+        forward_x = np.cos(yaw)
+        forward_y = np.sin(yaw)
+        length = np.hypot(offsets[:,0],offsets[:,1])
+        direction_x = offsets[:,0] / length
+        direction_y = offsets[:,1] / length
+        steer = 1 - (forward_x * direction_x + forward_y * direction_y)
+        # The right vector is the forward vector turned 90 degrees clockwise
+        to_right = -forward_y * direction_x + forward_x * direction_y
+        return np.where(to_right < 0,-steer,steer)
+
+    # Controls for each actor from its (x, y, yaw, speed) in states, None for actors with NaN states
+    def get_controls(self,states: np.ndarray,delta_seconds: float):
+        present = ~np.isnan(states[:,0])
+        offsets = self.advance(states[:,:2])
+        steering = self.get_steering(states[:,2],offsets)
+        moving = ~np.isnan(offsets[:,0])
+        controls = [None for _ in range(len(states))]
+        for i in np.flatnonzero(present):
+            if self.is_vehicle[i]:
+                if moving[i]:
+                    controls[i] = carla.VehicleControl(throttle=self.throttle,steer=float(steering[i]))
+                else:
+                    controls[i] = carla.VehicleControl(brake=1)
+            else:
+                if moving[i]:
+                    controls[i] = carla.WalkerControl(direction=carla.Vector3D(*[float(x) for x in offsets[i]]),speed=self.walker_speed)
+                else:
+                    controls[i] = carla.WalkerControl()
+        return controls
+
+# Ways of driving NPCs along their paths, chosen by name with --npc-follower. Each is built from the map and
+# the scenario's (actor, path) pairs and gives the controls for the fleet from its states each tick.
+PATH_FOLLOWERS = {
+    "pure_pursuit": PurePursuitFollower,
+    "points": PointFollower
+}
+
+# Drives scenario NPCs along their paths. States for the whole fleet come from one world snapshot, the
+# follower works out every control at once, and they are all sent in one client.apply_batch.
+class NpcController:
+    def __init__(self,client: carla.Client,world: carla.World,map: carla.Map,vehicle_paths: List[Tuple[carla.Actor,List[carla.Location]]],follower: str = "pure_pursuit"):
+        self.client = client
+        self.world = world
+        self.ids = np.array([p[0].id for p in vehicle_paths],dtype=np.int64)
+        self.is_vehicle = np.array([fnmatch(p[0].type_id,"*vehicle*") for p in vehicle_paths],dtype=bool)
+        self.follower = PATH_FOLLOWERS[follower](map,vehicle_paths)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # (N,4) x, y, yaw, speed of each actor in world_snapshot, NaN for actors no longer in it
+    def read_states(self,world_snapshot: carla.WorldSnapshot):
+        states = np.full((len(self.ids),4),np.nan)
+        for i, actor_id in enumerate(self.ids):
+            state = world_snapshot.find(int(actor_id))
+            if state == None:
+                continue
+            transform = state.get_transform()
+            velocity = state.get_velocity()
+            states[i] = (transform.location.x,transform.location.y,transform.rotation.yaw,velocity.length())
+        return states
+
+    # The batch of commands controlling every NPC still in world_snapshot
+    def get_commands(self,world_snapshot: carla.WorldSnapshot):
+        controls = self.follower.get_controls(self.read_states(world_snapshot),world_snapshot.timestamp.delta_seconds)
+        commands = []
+        for actor_id, is_vehicle, control in zip(self.ids,self.is_vehicle,controls):
+            if control == None:
+                continue
+            if is_vehicle:
+                commands.append(carla.command.ApplyVehicleControl(int(actor_id),control))
+            else:
+                commands.append(carla.command.ApplyWalkerControl(int(actor_id),control))
+        return commands
+
+    # Sends the controls for this tick along with extra_commands in one batch. world_snapshot is fetched from
+    # the world when not given.
+    def apply(self,world_snapshot: carla.WorldSnapshot = None,extra_commands: List = None):
+        if world_snapshot == None:
+            world_snapshot = self.world.get_snapshot()
+        commands = self.get_commands(world_snapshot) if len(self.ids) > 0 else []
+        if extra_commands != None:
+            commands.extend(extra_commands)
+        if len(commands) > 0:
+            self.client.apply_batch(commands)
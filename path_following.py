@@ -0,0 +1,240 @@
+from carla_backend import carla
+import heapq
+import itertools
+import math
+import numpy as np
+from fnmatch import fnmatch
+from typing import List, Tuple
+from map_cache import carla_waypoint
+from world_state import dot2d
+
+ROUTE_STEP = 2.0
+POLYLINE_SPACING = 1.0
+
+# Key identifying a waypoint to within step metres along its lane
+def waypoint_key(waypoint: carla.Waypoint,step: float):
+    return (waypoint.road_id,waypoint.section_id,waypoint.lane_id,int(round(waypoint.s / step)))
+
+# A* search along the lanes from start, stepping step metres with waypoint.next, for a waypoint within step of
+# goal. Returns the waypoints from start to it, or None if there isn't one within max_expansions steps.
+def find_route(start: carla.Waypoint,goal: carla.Location,step: float = ROUTE_STEP,max_expansions: int = 20000):
+    counter = itertools.count()
+    start_key = waypoint_key(start,step)
+    costs = {start_key: 0.0}
+    parents = {start_key: None}
+    waypoints = {start_key: start}
+    frontier = [((start.transform.location - goal).length(),next(counter),0.0,start_key)]
+    expansions = 0
+    while len(frontier) > 0 and expansions < max_expansions:
+        _, _, cost, key = heapq.heappop(frontier)
+        if cost > costs[key]:
+            continue
+        waypoint = waypoints[key]
+        if (waypoint.transform.location - goal).length() <= step:
+            route = []
+            while key != None:
+                route.append(waypoints[key])
+                key = parents[key]
+            route.reverse()
+            return route
+        expansions += 1
+        for n in waypoint.next(step):
+            n_key = waypoint_key(n,step)
+            n_cost = cost + step
+            if n_cost < costs.get(n_key,math.inf):
+                costs[n_key] = n_cost
+                parents[n_key] = key
+                waypoints[n_key] = n
+                heapq.heappush(frontier,(n_cost + (n.transform.location - goal).length(),next(counter),n_cost,n_key))
+    return None
+
+# Lane waypoint to start routing an actor from: the lane it is on, or the lane beside it running the way it faces
+def get_start_waypoint(map: carla.Map,transform: carla.Transform):
+    waypoint = carla_waypoint(map.get_waypoint(transform.location))
+    forward = transform.get_forward_vector()
+    if dot2d(waypoint.transform.get_forward_vector(),forward) < 0:
+        opposite = waypoint.get_left_lane()
+        if opposite != None and opposite.lane_type == carla.LaneType.Driving and dot2d(opposite.transform.get_forward_vector(),forward) > 0:
+            return opposite
+    return waypoint
+
+# (M,2) corner points of a vehicle's route from transform through each of points in turn, following the lanes
+# where a route can be found and going straight to the point where one can't
+def build_vehicle_route(map: carla.Map,transform: carla.Transform,points: List[carla.Location],step: float = ROUTE_STEP):
+    corners = [(transform.location.x,transform.location.y)]
+    waypoint = get_start_waypoint(map,transform)
+    for p in points:
+        route = find_route(waypoint,p,step)
+        if route == None:
+            waypoint = carla_waypoint(map.get_waypoint(p))
+        else:
+            corners.extend((w.transform.location.x,w.transform.location.y) for w in route)
+            waypoint = route[-1]
+        corners.append((p.x,p.y))
+    return np.array(corners,dtype=float)
+
+# (M,2) corner points of a walker's route, straight between its points
+def build_walker_route(transform: carla.Transform,points: List[carla.Location]):
+    return np.array([(transform.location.x,transform.location.y)] + [(p.x,p.y) for p in points],dtype=float)
+
+# Resamples the polyline through corners every spacing metres along it. Returns the (N,2) points, N >= 2, and
+# the arc length of each from the start.
+def densify(corners: np.ndarray,spacing: float = POLYLINE_SPACING):
+    lengths = np.hypot(*np.diff(corners,axis=0).T) if len(corners) > 1 else np.zeros(0)
+    arc = np.concatenate([[0.0],np.cumsum(lengths)])
+    total = float(arc[-1])
+    s = np.append(np.arange(0.0,total,spacing),total)
+    if len(s) < 2:
+        s = np.array([0.0,total])
+    keep = np.concatenate([[True],lengths > 0])
+    if keep.sum() < 2:
+        return np.repeat(corners[:1],2,axis=0), s
+    points = np.stack([np.interp(s,arc[keep],corners[keep,0]),np.interp(s,arc[keep],corners[keep,1])],axis=1)
+    return points, s
+
+# Every route of a scenario in one array so lookups for the whole fleet are single NumPy operations. Route i
+# holds points[starts[i]:ends[i]]. Arc lengths are stored offset by offsets[i], keeping them increasing across
+# routes, so finding the segment at an arc length is one searchsorted over all routes.
+class RouteSet:
+    def __init__(self,routes: List[Tuple[np.ndarray,np.ndarray]]):
+        counts = np.array([len(r[0]) for r in routes],dtype=np.int64)
+        self.ends = np.cumsum(counts)
+        self.starts = self.ends - counts
+        self.lengths = np.array([r[1][-1] for r in routes],dtype=float)
+        # One metre gap between routes
+        self.offsets = np.concatenate([[0.0],np.cumsum(self.lengths + 1.0)[:-1]]) if len(routes) > 0 else np.zeros(0)
+        self.points = np.concatenate([r[0] for r in routes]) if len(routes) > 0 else np.zeros((0,2))
+        self.arc = np.concatenate([r[1] + o for r, o in zip(routes,self.offsets)]) if len(routes) > 0 else np.zeros(0)
+        segment_lengths = np.hypot(*np.diff(self.points,axis=0).T) if len(self.points) > 1 else np.zeros(0)
+        self.segment_lengths = np.append(segment_lengths,0.0)
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Index of the first point of the segment of each route in rows containing arc length s
+    def segment_at(self,rows: np.ndarray,s: np.ndarray):
+        segments = np.searchsorted(self.arc,self.offsets[rows] + s,side='right') - 1
+        return np.clip(segments,self.starts[rows],self.ends[rows] - 2)
+
+    # (N,2) points at arc lengths s along the routes in rows
+    def point_at(self,rows: np.ndarray,s: np.ndarray):
+        segments = self.segment_at(rows,s)
+        t = np.clip((self.offsets[rows] + s - self.arc[segments]) / np.maximum(self.segment_lengths[segments],1e-9),0,1)[:,None]
+        return self.points[segments] + t * (self.points[segments + 1] - self.points[segments])
+
+    # Arc length along the routes in rows of the point nearest each position, and its distance from it.
+    # Only the window of segments from behind metres before to ahead metres after the previous arc lengths s
+    # is searched, so a lookup costs O(log n) in the route length. Positions further than relocate_distance
+    # from anything in their window are searched for along the whole route.
+    def nearest(self,rows: np.ndarray,positions: np.ndarray,s: np.ndarray,behind: float = 2.0,ahead: float = 10.0,relocate_distance: float = 5.0):
+        window = int(math.ceil((behind + ahead) / POLYLINE_SPACING)) + 1
+        first = self.segment_at(rows,np.maximum(s - behind,0))
+        segments = np.minimum(first[:,None] + np.arange(window)[None,:],(self.ends[rows] - 2)[:,None])
+        new_s, distances = self._project(positions,segments)
+        lost = np.flatnonzero(distances > relocate_distance)
+        for i in lost:
+            whole = np.arange(self.starts[rows[i]],self.ends[rows[i]] - 1)[None,:]
+            relocated_s, relocated_distance = self._project(positions[i:i + 1],whole)
+            new_s[i] = relocated_s[0]
+            distances[i] = relocated_distance[0]
+        return new_s - self.offsets[rows], distances
+
+    # Projects each position onto its row of candidate segments, returning the offset arc length and
+    # distance of the nearest projection
+    def _project(self,positions: np.ndarray,segments: np.ndarray):
+        a = self.points[segments]
+        ab = self.points[segments + 1] - a
+        ap = positions[:,None,:] - a
+        length_squared = np.maximum(np.einsum('ijk,ijk->ij',ab,ab),1e-12)
+        t = np.clip(np.einsum('ijk,ijk->ij',ap,ab) / length_squared,0,1)
+        offset = ap - t[...,None] * ab
+        distance_squared = np.einsum('ijk,ijk->ij',offset,offset)
+        best = np.argmin(distance_squared,axis=1)
+        rows = np.arange(len(positions))
+        chosen = segments[rows,best]
+        s = self.arc[chosen] + t[rows,best] * self.segment_lengths[chosen]
+        return s, np.sqrt(distance_squared[rows,best])
+
+# Drives NPCs along routes expanded from their paths through the road graph, densified to one point a metre.
+# Vehicles steer by pure pursuit of the point lookahead metres ahead along the route and hold a target speed
+# with a PID on throttle and brake. The target speed drops to take the curve to the lookahead point within
+# max_lateral_acceleration and to stop at the end of the route within comfortable_deceleration. Walkers head
+# for their lookahead point at walker_speed.
+class PurePursuitFollower:
+    cruise_speed = 8.0
+    walker_speed = 1.4
+    min_lookahead = 4.0
+    lookahead_time = 0.5
+    max_lookahead = 15.0
+    # Front wheel angle at full steer
+    max_steer_angle = math.radians(45)
+    max_lateral_acceleration = 3.0
+    comfortable_deceleration = 3.0
+    arrive_distance = 1.0
+    speed_gains = (0.5,0.05,0.02)
+    max_throttle = 0.75
+
+    def __init__(self,map: carla.Map,vehicle_paths: List[Tuple[carla.Actor,List[carla.Location]]]):
+        self.is_vehicle = np.array([fnmatch(p[0].type_id,"*vehicle*") for p in vehicle_paths],dtype=bool)
+        routes = []
+        for (actor, points), is_vehicle in zip(vehicle_paths,self.is_vehicle):
+            transform = actor.get_transform()
+            if is_vehicle:
+                corners = build_vehicle_route(map,transform,points)
+            else:
+                corners = build_walker_route(transform,points)
+            routes.append(densify(corners))
+        self.routes = RouteSet(routes)
+        self.wheelbases = np.array([max(1.2 * p[0].bounding_box.extent.x,0.5) for p in vehicle_paths])
+        self.s = np.zeros(len(vehicle_paths))
+        self.finished = np.zeros(len(vehicle_paths),dtype=bool)
+        self.speed_error_integral = np.zeros(len(vehicle_paths))
+        self.previous_speed_error = np.zeros(len(vehicle_paths))
+
+    # Controls for each actor from its (x, y, yaw, speed) in states, None for actors with NaN states
+    def get_controls(self,states: np.ndarray,delta_seconds: float):
+        controls = [None for _ in range(len(states))]
+        rows = np.flatnonzero(~np.isnan(states[:,0]))
+        if len(rows) == 0:
+            return controls
+        positions = states[rows,:2]
+        yaw = np.radians(states[rows,2])
+        speed = states[rows,3]
+        self.s[rows], _ = self.routes.nearest(rows,positions,self.s[rows])
+        remaining = self.routes.lengths[rows] - self.s[rows]
+        self.finished[rows] |= remaining < self.arrive_distance
+
+        lookahead = np.clip(self.lookahead_time * speed + self.min_lookahead,self.min_lookahead,self.max_lookahead)
+        targets = self.routes.point_at(rows,np.minimum(self.s[rows] + lookahead,self.routes.lengths[rows]))
+        offsets = targets - positions
+        # Offsets in the actor's frame, y is to its right
+        local_x = np.cos(yaw) * offsets[:,0] + np.sin(yaw) * offsets[:,1]
+        local_y = -np.sin(yaw) * offsets[:,0] + np.cos(yaw) * offsets[:,1]
+        distance = np.maximum(np.hypot(local_x,local_y),1e-6)
+        curvature = 2 * local_y / (distance * distance)
+        steer = np.clip(np.arctan(self.wheelbases[rows] * curvature) / self.max_steer_angle,-1,1)
+
+        target_speed = np.minimum(self.cruise_speed,np.sqrt(2 * self.comfortable_deceleration * np.maximum(remaining,0)))
+        target_speed = np.minimum(target_speed,np.sqrt(self.max_lateral_acceleration / np.maximum(np.abs(curvature),1e-6)))
+        error = target_speed - speed
+        dt = max(delta_seconds,1e-3)
+        kp, ki, kd = self.speed_gains
+        self.speed_error_integral[rows] = np.clip(self.speed_error_integral[rows] + error * dt,-10,10)
+        command = kp * error + ki * self.speed_error_integral[rows] + kd * (error - self.previous_speed_error[rows]) / dt
+        self.previous_speed_error[rows] = error
+        throttle = np.clip(command,0,self.max_throttle)
+        brake = np.clip(-command,0,1)
+
+        for j, i in enumerate(rows):
+            if self.is_vehicle[i]:
+                if self.finished[i]:
+                    controls[i] = carla.VehicleControl(brake=1)
+                else:
+                    controls[i] = carla.VehicleControl(throttle=float(throttle[j]),steer=float(steer[j]),brake=float(brake[j]))
+            else:
+                if self.finished[i]:
+                    controls[i] = carla.WalkerControl()
+                else:
+                    direction = offsets[j] / distance[j]
+                    controls[i] = carla.WalkerControl(direction=carla.Vector3D(float(direction[0]),float(direction[1]),0),speed=self.walker_speed)
+        return controls
@@ -0,0 +1,164 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from enum import Enum
+from typing import Dict
+
+class FsyncPolicy(Enum):
+    NEVER = 0
+    ON_FLUSH = 1
+    EVERY_BATCH = 2
+
+class _PendingFile:
+    def __init__(self):
+        self.truncate = False
+        self.remove = False
+        # A removed file is kept, with anything appended since added to it, while this path's last write failed
+        self.remove_after = None
+        self.chunks = []
+
+# Writes files on a background thread so the tick loop never waits on disk. Requests arriving within
+# batch_interval of each other are coalesced per file: a whole-file write replaces anything queued before
+# it and appends are joined into one write. Files are written in the order they were last requested.
+# Failed writes are reported and skipped. The first failure that isn't an OSError is raised again by the
+# next flush or close. A remove can be made to depend on another file's write, see remove.
+class AsyncWriter:
+    def __init__(self,fsync_policy: FsyncPolicy = FsyncPolicy.ON_FLUSH,batch_interval: float = 0.5):
+        self.fsync_policy = fsync_policy
+        self.batch_interval = batch_interval
+        self._queue = queue.Queue()
+        self._closed = False
+        self._error = None
+        # Paths whose last write failed
+        self._failed_paths = set()
+        self._thread = threading.Thread(target=self._run,name="AsyncWriter",daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self,path: str,content: str):
+        self._queue.put(("write",path,content))
+
+    def append(self,path: str,content: str):
+        self._queue.put(("append",path,content))
+
+    # With after, path is only removed if after's last requested write succeeded, otherwise it is kept as it is
+    def remove(self,path: str,after: str = None):
+        self._queue.put(("remove",path,after))
+
+    # Blocks until everything requested so far is on disk
+    def flush(self):
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(("flush",None,done))
+        self._wait(done)
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(("close",None,done))
+        self._wait(done)
+        self._closed = True
+        self._thread.join()
+        self._raise_error()
+
+    # Waits for the background thread to get to done, or to have stopped without getting there
+    def _wait(self,done: threading.Event):
+        while not done.wait(0.5):
+            if not self._thread.is_alive():
+                return
+
+    def _raise_error(self):
+        error = self._error
+        self._error = None
+        if error != None:
+            raise error
+
+    def _record_error(self,error: Exception):
+        print("AsyncWriter failed:",repr(error))
+        if self._error == None:
+            self._error = error
+
+    def _run(self):
+        running = True
+        while running:
+            pending: Dict[str,_PendingFile] = {}
+            events = []
+            request = self._queue.get()
+            deadline = time.monotonic() + self.batch_interval
+            while True:
+                operation, path, payload = request
+                if operation == "flush" or operation == "close":
+                    events.append(payload)
+                    running = running and operation != "close"
+                else:
+                    self._queue_operation(pending,operation,path,payload)
+                try:
+                    if len(events) > 0:
+                        request = self._queue.get_nowait()
+                    else:
+                        request = self._queue.get(timeout=max(0,deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            try:
+                self._write_pending(pending,self.fsync_policy == FsyncPolicy.EVERY_BATCH or (len(events) > 0 and self.fsync_policy != FsyncPolicy.NEVER))
+            except Exception as e:
+                self._record_error(e)
+            for e in events:
+                e.set()
+
+    def _queue_operation(self,pending: Dict[str,_PendingFile],operation: str,path: str,payload: str):
+        pending_file = pending.pop(path,None)
+        if pending_file == None:
+            pending_file = _PendingFile()
+        if operation == "write":
+            pending_file.truncate = True
+            pending_file.remove = False
+            pending_file.remove_after = None
+            pending_file.chunks = [payload]
+        elif operation == "append":
+            pending_file.chunks.append(payload)
+        elif operation == "remove":
+            pending_file.truncate = True
+            pending_file.remove = True
+            pending_file.remove_after = payload
+            pending_file.chunks = []
+        pending[path] = pending_file
+
+    def _write_pending(self,pending: Dict[str,_PendingFile],fsync: bool):
+        for path, pending_file in pending.items():
+            if pending_file.remove and pending_file.remove_after in self._failed_paths:
+                print("Keeping",path,"as",pending_file.remove_after,"could not be written")
+                if len(pending_file.chunks) == 0:
+                    continue
+                pending_file.truncate = False
+                pending_file.remove = False
+            try:
+                if pending_file.remove and len(pending_file.chunks) == 0:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                elif pending_file.truncate:
+                    temporary_path = path + ".tmp"
+                    with open(temporary_path,'w',newline='') as f:
+                        f.write("".join(pending_file.chunks))
+                        if fsync:
+                            f.flush()
+                            os.fsync(f.fileno())
+                    os.replace(temporary_path,path)
+                else:
+                    with open(path,'a',newline='') as f:
+                        f.write("".join(pending_file.chunks))
+                        if fsync:
+                            f.flush()
+                            os.fsync(f.fileno())
+                self._failed_paths.discard(path)
+            except OSError as e:
+                print("Failed to write",path,":",e)
+                self._failed_paths.add(path)
+            except Exception as e:
+                self._failed_paths.add(path)
+                self._record_error(e)
@@ -0,0 +1,160 @@
+import csv
+import io
+import json
+import time
+import numpy as np
+from typing import Callable, Dict, List, Tuple
+from assertion import Assertion
+from coverage import get_micro_bin_id
+from persistence import AsyncWriter
+
+# Upper edges in seconds of the histogram bins durations are counted in, four per octave from 1 µs to about
+# 1 s. Longer durations go in the last bin.
+HISTOGRAM_EDGES = 1e-6 * 2 ** (np.arange(1,81) / 4)
+PROFILE_CSV_HEADER = ["tick","elapsed_s","kind","name","samples","mean_ms","p50_ms","p90_ms","p99_ms","max_ms"]
+
+# The last window durations of one stage or oracle, with a histogram over them kept up to date as
+# durations are added and the oldest drop out
+class TimingSeries:
+    def __init__(self,name: str,kind: str,window: int):
+        self.name = name
+        self.kind = kind
+        self.samples = np.zeros(window)
+        self.bins = np.zeros(window,dtype=np.int32)
+        self.histogram = np.zeros(len(HISTOGRAM_EDGES),dtype=np.int32)
+        self.count = 0
+
+    def add(self,seconds: float):
+        i = self.count % len(self.samples)
+        if self.count >= len(self.samples):
+            self.histogram[self.bins[i]] -= 1
+        b = min(int(np.searchsorted(HISTOGRAM_EDGES,seconds)),len(HISTOGRAM_EDGES) - 1)
+        self.samples[i] = seconds
+        self.bins[i] = b
+        self.histogram[b] += 1
+        self.count += 1
+
+    def get_window(self):
+        return self.samples[:min(self.count,len(self.samples))]
+
+    # (samples, mean, p50, p90, p99, max) over the window in milliseconds
+    def summary(self):
+        window = self.get_window() * 1000
+        if len(window) == 0:
+            return (0,0.0,0.0,0.0,0.0,0.0)
+        p50, p90, p99 = np.percentile(window,[50,90,99])
+        return (len(window),float(window.mean()),float(p50),float(p90),float(p99),float(window.max()))
+
+# Times the stages of each tick and every call to an instrumented assertion's oracles. Every export_interval
+# ticks a summary of each series is appended to <path_prefix>.csv and its histogram to <path_prefix>.jsonl.
+# Stages are timed as laps: lap(stage) charges the time since the previous lap, or the start of the tick, to stage.
+class TickProfiler:
+    def __init__(self,path_prefix: str,writer: AsyncWriter = None,window: int = 500,export_interval: int = 50):
+        self.csv_path = path_prefix + ".csv"
+        self.json_path = path_prefix + ".jsonl"
+        self.writer = writer
+        self.window = window
+        self.export_interval = export_interval
+        self.series: Dict[Tuple[str,str],TimingSeries] = {}
+        self.ticks = 0
+        self._start_time = time.perf_counter()
+        self._tick_start = None
+        self._lap_start = None
+        self._write(self.csv_path,",".join(PROFILE_CSV_HEADER) + "\n",append=False)
+        self._write(self.json_path,json.dumps({"histogram_edges_us": [round(e * 1e6,3) for e in HISTOGRAM_EDGES]}) + "\n",append=False)
+
+    def get_series(self,kind: str,name: str):
+        series = self.series.get((kind,name))
+        if series == None:
+            series = TimingSeries(name,kind,self.window)
+            self.series[(kind,name)] = series
+        return series
+
+    # Replaces the oracles of assertions with ones timing each call, named after the micro-bin
+    def instrument_assertions(self,assertions: List[Assertion]):
+        for a in assertions:
+            bin_id = get_micro_bin_id(a)
+            a.preconditionOracle = self._timed(self.get_series("oracle",bin_id+" precondition"),a.preconditionOracle)
+            a.assertionOracle = self._timed(self.get_series("oracle",bin_id+" assertion"),a.assertionOracle)
+
+    def _timed(self,series: TimingSeries,oracle: Callable[[],bool]):
+        def timed_oracle():
+            start = time.perf_counter()
+            try:
+                return oracle()
+            finally:
+                series.add(time.perf_counter() - start)
+        return timed_oracle
+
+    def start_tick(self):
+        self._tick_start = time.perf_counter()
+        self._lap_start = self._tick_start
+
+    def lap(self,stage: str):
+        now = time.perf_counter()
+        self.get_series("stage",stage).add(now - self._lap_start)
+        self._lap_start = now
+
+    # Returns True if a summary was exported at the end of this tick
+    def end_tick(self):
+        self.get_series("stage","tick").add(time.perf_counter() - self._tick_start)
+        self.ticks += 1
+        if self.ticks % self.export_interval == 0:
+            self.export()
+            return True
+        return False
+
+    # (name, summary) of the count series of kind with the highest p99
+    def get_slowest(self,kind: str = "oracle",count: int = 5):
+        summaries = [(s.name,s.summary()) for s in self.series.values() if s.kind == kind and s.count > 0]
+        summaries.sort(key=lambda x: x[1][4],reverse=True)
+        return summaries[:count]
+
+    def export(self):
+        elapsed = round(time.perf_counter() - self._start_time,3)
+        rows = io.StringIO()
+        writer = csv.writer(rows)
+        snapshot = {"tick": self.ticks,"elapsed_s": elapsed,"series": []}
+        for series in self.series.values():
+            if series.count == 0:
+                continue
+            summary = series.summary()
+            writer.writerow([self.ticks,elapsed,series.kind,series.name,summary[0]] + [round(x,4) for x in summary[1:]])
+            nonzero = np.flatnonzero(series.histogram)
+            snapshot["series"].append({"kind": series.kind,"name": series.name,"histogram": {int(b): int(series.histogram[b]) for b in nonzero}})
+        self._write(self.csv_path,rows.getvalue())
+        self._write(self.json_path,json.dumps(snapshot) + "\n")
+
+    def close(self):
+        if self.ticks % self.export_interval != 0:
+            self.export()
+
+    def _write(self,path: str,content: str,append: bool = True):
+        if self.writer != None:
+            if append:
+                self.writer.append(path,content)
+            else:
+                self.writer.write(path,content)
+        else:
+            with open(path,'a' if append else 'w',newline='') as profilefile:
+                profilefile.write(content)
+
+# Stands in for TickProfiler when profiling is off, so the tick loop needs no checks
+class DisabledProfiler:
+    def instrument_assertions(self,assertions: List[Assertion]):
+        pass
+
+    def start_tick(self):
+        pass
+
+    def lap(self,stage: str):
+        pass
+
+    def end_tick(self):
+        return False
+
+    def get_slowest(self,kind: str = "oracle",count: int = 5):
+        return []
+
+    def close(self):
+        pass
@@ -0,0 +1,285 @@
+import argparse
+import importlib
+import multiprocessing
+import numpy as np
+import os
+# Traces are replayed without the simulator, its Python API is only used if it is installed
+os.environ.setdefault("CARLA_BACKEND","auto")
+from carla_backend import carla
+from fnmatch import fnmatch
+from typing import List, Tuple
+from coverage import Coverage
+from persistence import AsyncWriter, FsyncPolicy
+from world_state import build_coverage_space, is_emergency_vehicle, get_emergency_status_of_vehicles
+from validity_requirements import CompiledValidityMatcher
+from checker_utils import JunctionStates
+from map_cache import GridLaneMarking
+from sensor_events import TickEvents
+from spatial_index import location_array
+from rules import ScenarioContext, get_bin_bits, assertionCheckTick
+from scenario_trace import TraceReader, find_traces, ACTOR_DTYPE, ACTOR_EGO, ACTOR_OTHER, ACTOR_VEHICLE
+
+# Stands in for a tracked actor, answering from its record for the current tick
+class ReplayActor:
+    def __init__(self,description: dict):
+        self.id = description["id"]
+        self.type_id = description["type_id"]
+        self.attributes = description["attributes"]
+        self.bounding_box = carla.BoundingBox(carla.Location(0,0,0),carla.Vector3D(*description["extent"]))
+        self._state = np.zeros(1,dtype=ACTOR_DTYPE)[0]
+        self._values = {}
+
+    def set_state(self,state: np.void):
+        self._state = state
+        self._values = {}
+
+    def get_transform(self):
+        transform = self._values.get("transform")
+        if transform == None:
+            t = [float(x) for x in self._state["transform"]]
+            transform = carla.Transform(carla.Location(t[0],t[1],t[2]),carla.Rotation(pitch=t[3],yaw=t[4],roll=t[5]))
+            self._values["transform"] = transform
+        return transform
+
+    def get_location(self):
+        location = self.get_transform().location
+        return carla.Location(location.x,location.y,location.z)
+
+    def get_velocity(self):
+        velocity = self._values.get("velocity")
+        if velocity == None:
+            velocity = carla.Vector3D(*[float(x) for x in self._state["velocity"]])
+            self._values["velocity"] = velocity
+        return velocity
+
+    def get_control(self):
+        c = self._state["control"]
+        return carla.VehicleControl(throttle=float(c[0]),steer=float(c[1]),brake=float(c[2]))
+
+    def get_light_state(self):
+        return carla.VehicleLightState(int(self._state["light_state"]))
+
+    def get_speed_limit(self):
+        speed_limit = float(self._state["speed_limit"])
+        return None if np.isnan(speed_limit) else speed_limit
+
+class ReplayJunction:
+    def __init__(self,junction_id: int,box: np.ndarray):
+        b = [float(x) for x in box]
+        self.id = junction_id
+        self.bounding_box = carla.BoundingBox(carla.Location(b[0],b[1],b[2]),carla.Vector3D(b[3],b[4],b[5]))
+        self.bounding_box.rotation = carla.Rotation(yaw=b[6])
+
+class ReplayWaypoint:
+    def __init__(self,values: np.ndarray,markings: np.ndarray,junction: ReplayJunction):
+        v = [float(x) for x in values]
+        self.transform = carla.Transform(carla.Location(v[0],v[1],v[2]),carla.Rotation(yaw=v[3]))
+        self.lane_width = v[4]
+        self.left_lane_marking = GridLaneMarking(int(markings[0]),int(markings[1]))
+        self.right_lane_marking = GridLaneMarking(int(markings[2]),int(markings[3]))
+        self._junction = junction
+        self.is_junction = junction != None
+
+    def get_junction(self):
+        return self._junction
+
+# Answers the map lookups the oracles make from the tick's record: queries nearer the ego than the location one
+# lane to its right get the ego's waypoint, the rest get the right hand lane's
+class ReplayMap:
+    def __init__(self,name: str):
+        self.name = name
+        self._ego_location = None
+        self._right_query = None
+        self._ego_waypoint = None
+        self._right_waypoint = None
+
+    def set_tick(self,record: np.void,ego_location: carla.Location):
+        junction = None
+        if record["junction_id"] >= 0:
+            junction = ReplayJunction(int(record["junction_id"]),record["junction_box"])
+        self._ego_location = ego_location
+        self._right_query = carla.Location(*[float(x) for x in record["right_query"]])
+        self._ego_waypoint = ReplayWaypoint(record["ego_waypoint"],record["ego_markings"],junction)
+        self._right_waypoint = ReplayWaypoint(record["right_waypoint"],record["right_markings"],None)
+
+    def get_waypoint(self,location: carla.Location,project_to_road: bool = True,lane_type = None):
+        if (location - self._ego_location).length() <= (location - self._right_query).length():
+            return self._ego_waypoint
+        return self._right_waypoint
+
+class ReplayDebugHelper:
+    def draw_box(self,*args,**kwargs):
+        pass
+
+    def draw_line(self,*args,**kwargs):
+        pass
+
+    def draw_point(self,*args,**kwargs):
+        pass
+
+    def draw_string(self,*args,**kwargs):
+        pass
+
+class ReplayWorld:
+    def __init__(self,map: ReplayMap,actors: List[ReplayActor]):
+        self.map = map
+        self.actors = actors
+        self.debug = ReplayDebugHelper()
+        self.weather = carla.WeatherParameters()
+
+    def get_map(self):
+        return self.map
+
+    def get_actors(self):
+        return self.actors
+
+    def get_weather(self):
+        return self.weather
+
+    def set_weather(self,weather: carla.WeatherParameters):
+        self.weather = weather
+
+class ReplayEmergencyRegistry:
+    def __init__(self,actors: List[ReplayActor]):
+        self._emergency_vehicles = [a for a in actors if is_emergency_vehicle(a)]
+        self._status = None
+
+    def refresh(self):
+        self._status = get_emergency_status_of_vehicles(self._emergency_vehicles)
+
+    def get_status(self):
+        return self._status
+
+class ReplayWalkerRegistry:
+    def __init__(self,actors: List[ReplayActor]):
+        # Traces only hold the actors present when recording started
+        self._walkers = [a for a in actors if fnmatch(a.type_id,"*walker*")]
+
+    def get_locations(self):
+        return np.array([location_array(a.get_location()) for a in self._walkers]).reshape(len(self._walkers),3)
+
+class ReplayResult:
+    def __init__(self,path: str,ticks: int,score: int,bug_descriptions: List[str],cover_records: List[Tuple[int,int,int,int]]):
+        self.path = path
+        self.ticks = ticks
+        self.score = score
+        self.bug_descriptions = bug_descriptions
+        # (key, valid bits, covered bits, violated bits) of each tick, see apply_cover_records
+        self.cover_records = cover_records
+
+# Re-evaluates assertions against the ticks of a recorded trace through the same ScenarioContext the live
+# runner fills in, with recorded actors, map answers and world state in place of the simulator
+class TraceReplay:
+    def __init__(self,trace: TraceReader):
+        self.trace = trace
+        self.coverage_space = build_coverage_space()
+        variables = [v[0].name for v in self.coverage_space.variables]
+        if variables != trace.meta["coverage_variables"]:
+            raise Exception("Trace "+trace.path+" was recorded with coverage variables "+str(trace.meta["coverage_variables"])+", expected "+str(variables))
+
+        descriptions = trace.meta["actors"]
+        self.actors = [ReplayActor(d) for d in descriptions]
+        ego_vehicle = [a for a, d in zip(self.actors,descriptions) if d["flags"] & ACTOR_EGO][0]
+        others = [a for a, d in zip(self.actors,descriptions) if d["flags"] & ACTOR_OTHER]
+        vehicles = [a for a, d in zip(self.actors,descriptions) if d["flags"] & ACTOR_VEHICLE]
+        self.map = ReplayMap(trace.meta["map"])
+        self.world = ReplayWorld(self.map,self.actors)
+        self.emergency_registry = ReplayEmergencyRegistry(self.actors)
+        self.walker_registry = ReplayWalkerRegistry(self.actors)
+        self.ctx = ScenarioContext(self.world,self.map,ego_vehicle,others,vehicles,self.emergency_registry,self.walker_registry)
+
+    # Loads tick into the context and returns its coverage key
+    def load_tick(self,tick: int):
+        record = self.trace.ticks[tick]
+        for actor, state in zip(self.actors,self.trace.actors[tick]):
+            actor.set_state(state)
+        ctx = self.ctx
+        self.map.set_tick(record,ctx.ego_vehicle.get_location())
+        w = [float(x) for x in record["weather"]]
+        self.world.set_weather(carla.WeatherParameters(cloudiness=w[0],precipitation=w[1],precipitation_deposits=w[2],sun_altitude_angle=w[3]))
+        self.emergency_registry.refresh()
+        frame = int(record["frame"])
+        ctx.events = TickEvents(frame,[(frame,t) for t in self.trace.get_events(tick)])
+        ctx.junction_status = JunctionStates(int(record["junction_status"]))
+        ctx.quads = self.trace.get_quads(tick)
+        ctx.traffic_light_status = (bool(record["traffic_light"][0]),bool(record["traffic_light"][1]))
+        ctx.update_geometry()
+        return int(record["coverage_key"])
+
+    # build_assertions(ctx) makes the assertions to check, as rules.build_assertions does
+    def run(self,build_assertions):
+        assertions = build_assertions(self.ctx)
+        matcher = CompiledValidityMatcher([a.validityRequirements for a in assertions],self.coverage_space)
+        variables = [v[0] for v in self.coverage_space.variables]
+        score = 0
+        bug_descriptions = []
+        cover_records = []
+        for tick in range(len(self.trace)):
+            key = self.load_tick(tick)
+            qual_vars = list(zip(variables,self.coverage_space.decode_key(key)))
+            score_change, triggered_assertions, covered_assertions, valid_assertions, descriptions = assertionCheckTick(assertions,qual_vars,matcher)
+            score += score_change
+            bug_descriptions.extend(descriptions)
+            record = (key,get_bin_bits(valid_assertions),get_bin_bits(covered_assertions),get_bin_bits(triggered_assertions))
+            # Covering the same record a third time in a row never changes a micro-bin
+            if len(cover_records) < 2 or cover_records[-1] != record or cover_records[-2] != record:
+                cover_records.append(record)
+        return ReplayResult(self.trace.path,len(self.trace),score,bug_descriptions,cover_records)
+
+# Covers coverage with the ticks of a replay in order, returns the number of newly covered micro-bins
+def apply_cover_records(coverage: Coverage,cover_records: List[Tuple[int,int,int,int]]):
+    new_covered_cases = 0
+    for key, valid_bits, covered_bits, violated_bits in cover_records:
+        new_covered, _ = coverage.try_cover_bits(key,valid_bits,covered_bits,violated_bits)
+        new_covered_cases += new_covered
+    return new_covered_cases
+
+# rules_module is the name of a module providing build_assertions, so traces can be re-scored against a new rule set
+def replay_trace(path: str,rules_module: str = "rules"):
+    return TraceReplay(TraceReader(path)).run(importlib.import_module(rules_module).build_assertions)
+
+def _replay_trace_job(job: Tuple[str,str]):
+    return replay_trace(*job)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths",nargs="+",help="Trace directories or directories to search for traces")
+    parser.add_argument("-o","--output",default="out/replay_coverage.csv",help="Coverage file the replayed ticks are covered in")
+    parser.add_argument("--rules",default="rules",help="Module whose build_assertions makes the assertions to check")
+    parser.add_argument("--processes",type=int,default=1,help="Number of traces replayed at once")
+    parser.add_argument("--fsync",choices=[p.name.lower() for p in FsyncPolicy],default=FsyncPolicy.ON_FLUSH.name.lower())
+    args = parser.parse_args()
+
+    traces = find_traces(args.paths)
+    if len(traces) == 0:
+        parser.error("no traces found")
+    assertion_catalogue = importlib.import_module(args.rules).build_assertions(ScenarioContext())
+    persistence_writer = AsyncWriter(FsyncPolicy[args.fsync.upper()])
+    try:
+        coverage = Coverage(args.output,assertion_catalogue,build_coverage_space(),writer=persistence_writer)
+        jobs = [(t,args.rules) for t in traces]
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes)
+            results = pool.imap(_replay_trace_job,jobs)
+        else:
+            pool = None
+            results = map(_replay_trace_job,jobs)
+        total_score = 0
+        new_covered_cases = 0
+        for result in results:
+            total_score += result.score
+            new_covered_cases += apply_cover_records(coverage,result.cover_records)
+            print(result.path+":",result.ticks,"ticks, score",result.score)
+            for description in result.bug_descriptions:
+                print("   ",description)
+        if pool != None:
+            pool.close()
+            pool.join()
+        coverage.write_coverage()
+        print("Replayed",len(traces),"traces, score",total_score,"and",new_covered_cases,"newly covered cases")
+        coverage.print_coverage()
+    finally:
+        persistence_writer.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import os
+import bisect
+import numpy as np
+from carla_backend import carla
+from typing import Dict, List, Tuple
+from coverage_variables import RoadGraphs, SpeedLimits
+from checker_utils import JunctionStates, JunctionStatusError, get_entry_junction_status
+from junction_cache import JunctionTopologyCache
+from map_cache import MAP_CACHE_DIRECTORY, save_npz, load_npz, try_save_cache
+from world_state import classify_road_graph
+
+ROAD_GRAPH_INDEX_VERSION = 1
+DEFAULT_SPEED_LIMIT = 30
+SPEED_LIMIT_LANDMARK_TYPE = "274"
+
+# Road graph, speed limit and the junction ahead for every spawn point of a map and for driving lane samples
+# between them, so scenarios can be placed in a coverage bin without trying spawn points until one fits.
+# Samples are parallel arrays: x, y, z, yaw, road_graph (RoadGraphs value, -1 if unknown), speed_limit,
+# junction_state (JunctionStates value of the next junction along the lane) and spawn_index (index into
+# map.get_spawn_points(), -1 for lane samples).
+class RoadGraphIndex:
+    def __init__(self,map: carla.Map,samples: Dict[str,np.ndarray]):
+        self.map = map
+        self.samples = samples
+        self.spawn_points = map.get_spawn_points()
+
+    def __len__(self):
+        return len(self.samples["x"])
+
+    # Indices of the samples matching every filter given
+    def find(self,road_graph: RoadGraphs = None,speed_limit: SpeedLimits = None,junction_state: JunctionStates = None,spawn_points_only: bool = False):
+        mask = np.ones(len(self),dtype=bool)
+        if road_graph != None:
+            mask &= self.samples["road_graph"] == road_graph.value
+        if speed_limit != None:
+            mask &= self.samples["speed_limit"] == speed_limit.value
+        if junction_state != None:
+            mask &= self.samples["junction_state"] == junction_state.value
+        if spawn_points_only:
+            mask &= self.samples["spawn_index"] >= 0
+        return np.flatnonzero(mask)
+
+    # Transform an actor can be spawned at for a sample, lane samples are raised off the road like spawn points are
+    def get_transform(self,index: int):
+        spawn_index = int(self.samples["spawn_index"][index])
+        if spawn_index >= 0:
+            return self.spawn_points[spawn_index]
+        return carla.Transform(carla.Location(float(self.samples["x"][index]),float(self.samples["y"][index]),float(self.samples["z"][index]) + 0.5),
+                               carla.Rotation(yaw=float(self.samples["yaw"][index])))
+
+    def get_spawn_points(self,road_graph: RoadGraphs = None,speed_limit: SpeedLimits = None,junction_state: JunctionStates = None):
+        return [self.spawn_points[self.samples["spawn_index"][i]] for i in self.find(road_graph,speed_limit,junction_state,spawn_points_only=True)]
+
+    def get_transforms(self,road_graph: RoadGraphs = None,speed_limit: SpeedLimits = None,junction_state: JunctionStates = None):
+        return [self.get_transform(i) for i in self.find(road_graph,speed_limit,junction_state)]
+
+    # Values of a sample column present on the map, e.g. which road graphs can be reached at all
+    def available(self,column: str):
+        return set(int(v) for v in np.unique(self.samples[column]))
+
+    def save(self,path: str):
+        save_npz(path,version=ROAD_GRAPH_INDEX_VERSION,**self.samples)
+
+# Maximum speed signs of each road as (s, speed, orientation) sorted by s
+def get_speed_limit_signs(map: carla.Map):
+    signs: Dict[int,List[Tuple[float,int,carla.LandmarkOrientation]]] = {}
+    for landmark in map.get_all_landmarks_of_type(SPEED_LIMIT_LANDMARK_TYPE):
+        signs.setdefault(landmark.road_id,[]).append((landmark.s,int(landmark.value),landmark.orientation))
+    for road_signs in signs.values():
+        road_signs.sort(key=lambda x: x[0])
+    return signs
+
+# Speed of the last sign passed on the road of a waypoint, lanes with negative ids run along increasing s
+def get_waypoint_speed_limit(waypoint: carla.Waypoint,signs: Dict[int,List[Tuple[float,int,carla.LandmarkOrientation]]]):
+    forward = waypoint.lane_id < 0
+    facing = carla.LandmarkOrientation.Positive if forward else carla.LandmarkOrientation.Negative
+    road_signs = [x for x in signs.get(waypoint.road_id,[]) if x[2] == facing or x[2] == carla.LandmarkOrientation.Both]
+    sign_s = [x[0] for x in road_signs]
+    if forward:
+        i = bisect.bisect_right(sign_s,waypoint.s) - 1
+    else:
+        i = bisect.bisect_left(sign_s,waypoint.s)
+    if i < 0 or i >= len(road_signs):
+        return DEFAULT_SPEED_LIMIT
+    return road_signs[i][1]
+
+# Junction status for a vehicle driving along the lane of waypoint into the next junction within lookahead
+def get_junction_state_ahead(waypoint: carla.Waypoint,topology_cache: JunctionTopologyCache,lookahead: float = 50,step: float = 5):
+    previous = waypoint
+    current = waypoint
+    travelled = 0
+    while not current.is_junction:
+        if travelled >= lookahead:
+            return JunctionStates.NONE
+        next_waypoints = current.next(step)
+        if len(next_waypoints) == 0:
+            return JunctionStates.NONE
+        previous = current
+        current = next_waypoints[0]
+        travelled += step
+    junction = current.get_junction()
+    if junction == None:
+        return JunctionStates.NONE
+    topology = topology_cache.get(junction)
+    entry = topology.get_entry(topology.nearest_entrypoint_index(previous.transform.location))
+    if entry.status == None:
+        try:
+            entry.status, entry.partitioned_junction = get_entry_junction_status(topology,entry)
+        except JunctionStatusError:
+            entry.status = JunctionStates.UNKNOWN
+    return entry.status
+
+def build_road_graph_index(map: carla.Map,sample_distance: float = 5.0,topology_cache: JunctionTopologyCache = None):
+    if topology_cache == None:
+        topology_cache = JunctionTopologyCache()
+    signs = get_speed_limit_signs(map)
+    spawn_waypoints = [map.get_waypoint(s.location) for s in map.get_spawn_points()]
+    lane_waypoints = [w for w in map.generate_waypoints(sample_distance) if w.lane_type == carla.LaneType.Driving]
+    waypoints = spawn_waypoints + lane_waypoints
+
+    road_graphs = []
+    for w in waypoints:
+        road_graph = classify_road_graph(w,topology_cache)
+        road_graphs.append(-1 if road_graph == None else RoadGraphs[road_graph].value)
+    spawn_points = map.get_spawn_points()
+    samples = {
+        "x": np.array([s.location.x for s in spawn_points] + [w.transform.location.x for w in lane_waypoints]),
+        "y": np.array([s.location.y for s in spawn_points] + [w.transform.location.y for w in lane_waypoints]),
+        "z": np.array([s.location.z for s in spawn_points] + [w.transform.location.z for w in lane_waypoints]),
+        "yaw": np.array([s.rotation.yaw for s in spawn_points] + [w.transform.rotation.yaw for w in lane_waypoints]),
+        "road_graph": np.array(road_graphs,dtype=np.int8),
+        "speed_limit": np.array([get_waypoint_speed_limit(w,signs) for w in waypoints],dtype=np.int16),
+        "junction_state": np.array([get_junction_state_ahead(w,topology_cache).value for w in waypoints],dtype=np.int8),
+        "spawn_index": np.concatenate([np.arange(len(spawn_points)),np.full(len(lane_waypoints),-1)]).astype(np.int32)
+    }
+    return RoadGraphIndex(map,samples)
+
+def road_graph_index_path(map: carla.Map,directory: str = MAP_CACHE_DIRECTORY):
+    return os.path.join(directory,map.name.split("/")[-1]+"_road_graphs.npz")
+
+# Loads the road graph index for map from disk, building and saving it the first time the map is seen
+def load_road_graph_index(map: carla.Map,directory: str = MAP_CACHE_DIRECTORY,topology_cache: JunctionTopologyCache = None):
+    path = road_graph_index_path(map,directory)
+    data = load_npz(path)
+    if data != None:
+        try:
+            if int(data["version"]) == ROAD_GRAPH_INDEX_VERSION and np.count_nonzero(data["spawn_index"] >= 0) == len(map.get_spawn_points()):
+                return RoadGraphIndex(map,{k: data[k] for k in data if k != "version"})
+        except KeyError as e:
+            print("Ignoring road graph index",path,"missing",e)
+    print("Building road graph index for",map.name)
+    index = build_road_graph_index(map,topology_cache=topology_cache)
+    try_save_cache(index,path)
+    return index
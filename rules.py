@@ -0,0 +1,166 @@
+from carla_backend import carla
+import numpy as np
+import assertion
+from assertion import Assertion
+from fnmatch import fnmatch
+from typing import List, Tuple
+from enum import Enum
+from validity_requirements import *
+from coverage_variables import *
+from checker_utils import *
+from spatial_index import SpatialGrid
+from sensor_events import SensorEventType, TickEvents
+
+# Per-scenario state the assertion oracles read, refreshed by run_scenario every tick
+class ScenarioContext:
+    def __init__(self,world=None,map=None,ego_vehicle=None,other_vehicles_and_pedestrians=None,non_ego_vehicles=None,emergency_registry=None,walker_registry=None):
+        self.world = world
+        self.map = map
+        self.ego_vehicle = ego_vehicle
+        if other_vehicles_and_pedestrians == None:
+            other_vehicles_and_pedestrians = []
+        if non_ego_vehicles == None:
+            non_ego_vehicles = []
+        self.other_vehicles_and_pedestrians = other_vehicles_and_pedestrians
+        self.non_ego_vehicles = non_ego_vehicles
+        self.emergency_registry = emergency_registry
+        self.walker_registry = walker_registry
+        self.walker_rows = np.array([fnmatch(x.type_id,"*walker*") for x in other_vehicles_and_pedestrians],dtype=bool)
+
+        self.junction_status = JunctionStates.NONE
+        self.quads = None
+        self.traffic_light_status = (False,False)
+        # Sensor events for the frame of the current tick
+        self.events = TickEvents()
+        self.update_geometry()
+
+    def update_geometry(self):
+        self.other_geometry = actor_geometry_array(self.other_vehicles_and_pedestrians)
+        self.vehicle_geometry = actor_geometry_array(self.non_ego_vehicles)
+        self.other_index = SpatialGrid(self.other_geometry[:,:3])
+        self.vehicle_index = SpatialGrid(self.vehicle_geometry[:,:3])
+        # Pedestrian density counts every walker in the world, including ones spawned after the scenario started
+        if self.walker_registry != None:
+            self.pedestrian_index = SpatialGrid(self.walker_registry.get_locations())
+        else:
+            self.pedestrian_index = SpatialGrid(self.other_geometry[self.walker_rows,:3])
+
+# Coverage micro-bins are numbered by position in this list, which is stored in each assertion's bin_index
+def build_assertions(ctx: ScenarioContext):
+    assertions = [
+        Assertion(126, 0,
+                "Maintain a safe stopping distance",
+                (lambda: within_box_in_front_mask(ctx.ego_vehicle,ctx.other_geometry,stoppingDistance(ctx.ego_vehicle.get_velocity().length()) + 5,ctx.world,ctx.other_index).any()),
+                (lambda: not within_box_in_front_mask(ctx.ego_vehicle,ctx.other_geometry,stoppingDistance(ctx.ego_vehicle.get_velocity().length()),ctx.world,ctx.other_index).any()),
+                previous_tick_precondition=True,
+                validityRequirements=ValidityRequirement({
+                    CoverageVariable.VEHICLE_DENSITY: [Levels.LOW, Levels.MEDIUM,Levels.HIGH,Levels.VERY_HIGH]
+                }
+                )),
+        Assertion(124, 0,
+                "You must not exceed maximum speed limits",
+                (lambda: ctx.ego_vehicle.get_speed_limit() != None),
+                (lambda: ctx.ego_vehicle.get_velocity().length() <= ctx.ego_vehicle.get_speed_limit())
+                ),
+        Assertion(170, 0,
+                  "Give way to vehicles on major road",
+                  lambda: ctx.junction_status == JunctionStates.T_ON_MINOR and any(vehicleInJunction(v,currentJunction(ctx.ego_vehicle,ctx.map)) for v in ctx.non_ego_vehicles),
+                  lambda: not (ctx.junction_status == JunctionStates.T_ON_MINOR 
+                               and any(vehicleInJunction(v,currentJunction(ctx.ego_vehicle,ctx.map)) and (not performingSafeLeftTurn(ctx.ego_vehicle,v,ctx.quads,ctx.junction_status) and not performingSafeRightTurn(ctx.ego_vehicle,v,ctx.quads,ctx.junction_status)) for v in ctx.non_ego_vehicles)) 
+                               or ctx.ego_vehicle.get_velocity().length() < 0.1,
+                  validityRequirements=IN_JUNCTION_REQUIREMENTS
+                ),
+        Assertion(170, 1,
+                  "Give way to vehicles on major road (major case)",
+                  lambda: ctx.junction_status == JunctionStates.T_ON_MAJOR and any(vehicleInJunction(v,currentJunction(ctx.ego_vehicle,ctx.map)) for v in ctx.non_ego_vehicles),
+                  lambda: (not (ctx.junction_status == JunctionStates.T_ON_MAJOR and (any(vehicleInJunction(v,currentJunction(ctx.ego_vehicle,ctx.map)) for v in ctx.non_ego_vehicles))) or straightOnAtJunction(ctx.ego_vehicle,ctx.junction_status))
+                            or ctx.ego_vehicle.get_velocity().length() < 0.1,
+                  validityRequirements=IN_JUNCTION_REQUIREMENTS
+                ),
+        Assertion(103,0,
+                  "Give signals before manoeuvering at junctions",
+                  lambda: ctx.junction_status != JunctionStates.NONE,
+                  lambda: ((ctx.ego_vehicle.get_light_state() == carla.VehicleLightState.RightBlinker or not ctx.ego_vehicle.get_control().steer > 0) and (ctx.ego_vehicle.get_light_state() == carla.VehicleLightState.LeftBlinker or not ctx.ego_vehicle.get_control().steer < 0)) or not ctx.junction_status != JunctionStates.NONE,
+                  validityRequirements=IN_JUNCTION_REQUIREMENTS
+                ),
+        Assertion(219,0,
+                  "Stop to let emergency service vehicles pass",
+                  lambda: active_emergency_vehicle_within_distance(ctx.ego_vehicle,ctx.world,50,ctx.emergency_registry),
+                  lambda: parked_left(ctx.ego_vehicle,ctx.map) or not active_emergency_vehicle_within_distance(ctx.ego_vehicle,ctx.world,30,ctx.emergency_registry),
+                  validityRequirements=ValidityRequirement({CoverageVariable.EMERGENCY_VEHICLE_STATUS: [EmergencyVehicleStatus.PRESENT,EmergencyVehicleStatus.SIREN]})
+                  ),
+        Assertion(238,0,
+                  "No waiting or parking on yellow or red lines",
+                  lambda: lane_markings_present(ctx.ego_vehicle,ctx.map,[carla.LaneMarkingType.Solid,carla.LaneMarkingType.SolidSolid],colors=[carla.LaneMarkingColor.Red,carla.LaneMarkingColor.Yellow]) and not active_emergency_vehicle_within_distance(ctx.ego_vehicle,ctx.world,50,ctx.emergency_registry),
+                  lambda: not (parked_left(ctx.ego_vehicle,ctx.map) and ctx.events.has(SensorEventType.NO_STOPPING_LINE))
+                  ),
+        Assertion(129,0,
+                  "Must not cross solid road markings",
+                  lambda: lane_markings_present(ctx.ego_vehicle,ctx.map,[carla.LaneMarkingType.Solid,carla.LaneMarkingType.SolidSolid,carla.LaneMarkingType.SolidBroken,carla.LaneMarkingType.BrokenSolid]),
+                  lambda: not (ctx.events.has(SensorEventType.NO_OVERTAKING) and not ((ctx.vehicle_geometry[:,GEOMETRY_SPEED] <= 0) & vehicle_in_overtake_range_mask(ctx.ego_vehicle,ctx.vehicle_geometry,ctx.world,ctx.vehicle_index)).any())),
+        Assertion(160,
+                  0,
+                  "Stay in the left lane unless safely overtaking",
+                  lambda: not not_in_left_lane(ctx.ego_vehicle,ctx.map,ctx.junction_status,ctx.events),
+                  lambda: not (not_in_left_lane(ctx.ego_vehicle,ctx.map,ctx.junction_status,ctx.events) and not vehicle_in_overtake_range_mask(ctx.ego_vehicle,ctx.vehicle_geometry,ctx.world,ctx.vehicle_index).any()),
+                  previous_tick_precondition=True
+                  ),
+        Assertion(0,0,
+                  "Must stop at traffic lights",
+                  lambda: ctx.traffic_light_status[0],
+                  lambda: (ctx.ego_vehicle.get_velocity().length() <= 0 or ctx.ego_vehicle.get_control().brake > ctx.ego_vehicle.get_control().throttle) or not (ctx.traffic_light_status[0] and not ctx.traffic_light_status[1])
+                  ),
+        Assertion(0,1,
+                  "Stay on road",
+                  lambda: True,
+                  lambda: not ctx.events.has(SensorEventType.OFF_ROAD)),
+        Assertion(0,2,
+                  "Collision with terrain",
+                  lambda: True,
+                  lambda: not ctx.events.has(SensorEventType.STATIC_COLLISION))
+    ]
+    for i, a in enumerate(assertions):
+        a.bin_index = i
+    return assertions
+
+def get_bin_bits(assertions: List[assertion.Assertion]):
+    bits = 0
+    for a in assertions:
+        bits |= 1 << a.bin_index
+    return bits
+
+def not_in_left_lane(ego_vehicle,map,junction_status,events: TickEvents):
+    ego_loc = ego_vehicle.get_location()
+    ego_wp = map.get_waypoint(ego_loc)
+    return junction_status == JunctionStates.NONE and (events.has(SensorEventType.CROSSING_INTO_RIGHT_LANE) or
+                                                        (ego_wp.transform.location - map.get_waypoint(ego_loc + ego_vehicle.get_transform().get_right_vector() * ego_wp.lane_width).transform.location).length() < 0.1)
+
+# matcher, compiled from the validity requirements of assertions, replaces checking each assertion's requirements in turn
+def assertionCheckTick(assertions: List[assertion.Assertion],qualitative_coverage_state: List[Tuple[CoverageVariable,Enum]],matcher: CompiledValidityMatcher = None):
+    score_change = 0
+    valid_assertions = []
+    covered_assertions = []
+    triggered_assertions = []
+    triggered_descriptions = []
+
+    if matcher != None:
+        active_indices = matcher.get_active_indices(qualitative_coverage_state)
+    else:
+        active_indices = [i for i in range(len(assertions)) if assertions[i].IsActive(qualitative_coverage_state)]
+
+    for i in active_indices:
+        valid_assertions.append(assertions[i])
+        violated_before_tick = assertions[i].violated
+        assertions[i].Check()
+        if assertions[i].precondition_active_in_tick:
+            covered_assertions.append(assertions[i])
+            if assertions[i].violated_in_tick:
+                triggered_assertions.append(assertions[i])
+        if assertions[i].violated and not violated_before_tick:
+            if assertions[i].zero_value:
+                triggered_descriptions.append("- Unfair test: "+assertions[i].description)
+            else:
+                triggered_descriptions.append("+ "+assertions[i].description)
+                score_change += 1
+
+    return score_change, triggered_assertions, covered_assertions, valid_assertions, triggered_descriptions
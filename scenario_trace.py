@@ -0,0 +1,219 @@
+import os
+import json
+import math
+import numpy as np
+from carla_backend import carla
+from fnmatch import fnmatch
+from typing import List
+from checker_utils import PartitionedJunction
+from sensor_events import SensorEventType
+
+TRACE_VERSION = 1
+TRACE_META_FILE = "meta.json"
+TRACE_TICKS_FILE = "ticks.bin"
+TRACE_ACTORS_FILE = "actors.bin"
+
+# One record per tick. Map lookups the oracles make are stored as their answers: the waypoint at the ego's
+# location and at the location one lane width to its right, and the bounding box of the junction the ego is in.
+# events is a bitmask with bit SensorEventType.value set for each event handed to the tick.
+TICK_DTYPE = np.dtype([
+    ("frame",np.int64),
+    ("timestamp",np.float64),
+    ("coverage_key",np.int64),
+    ("events",np.uint32),
+    # cloudiness, precipitation, precipitation_deposits, sun_altitude_angle
+    ("weather",np.float32,(4,)),
+    ("junction_status",np.int8),
+    ("traffic_light",np.bool_,(2,)),
+    ("has_quads",np.bool_),
+    # PartitionedJunction.get_vectors()
+    ("quads",np.float32,(6,)),
+    # Waypoint x, y, z, yaw, lane_width and left type, left color, right type, right color of its markings
+    ("ego_waypoint",np.float32,(5,)),
+    ("ego_markings",np.int16,(4,)),
+    ("right_query",np.float32,(3,)),
+    ("right_waypoint",np.float32,(5,)),
+    ("right_markings",np.int16,(4,)),
+    # -1 outside a junction, bounding box is location x, y, z, extent x, y, z and yaw
+    ("junction_id",np.int32),
+    ("junction_box",np.float32,(7,))
+])
+
+# One record per tracked actor per tick, in the actor order of the trace's metadata. speed_limit is NaN when
+# the actor has none, controls and light state are zero for walkers.
+ACTOR_DTYPE = np.dtype([
+    # x, y, z, pitch, yaw, roll
+    ("transform",np.float32,(6,)),
+    ("velocity",np.float32,(3,)),
+    # throttle, steer, brake
+    ("control",np.float32,(3,)),
+    ("light_state",np.uint32),
+    ("speed_limit",np.float32)
+])
+
+# Which lists of the ScenarioContext an actor was in
+ACTOR_EGO = 1
+ACTOR_OTHER = 2
+ACTOR_VEHICLE = 4
+
+# Writes the state the assertion oracles read each tick to a trace directory: meta.json describing the scenario
+# and its actors, and ticks.bin/actors.bin holding raw TICK_DTYPE/ACTOR_DTYPE records that TraceReader memory
+# maps. Records are buffered and appended every flush_interval ticks, a trace cut short keeps whole ticks.
+class TraceRecorder:
+    def __init__(self,path: str,ctx,coverage_space,map_name: str = None,flush_interval: int = 100):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._actors = [ctx.ego_vehicle] + list(ctx.other_vehicles_and_pedestrians)
+        flags = [ACTOR_EGO] + [ACTOR_OTHER for _ in ctx.other_vehicles_and_pedestrians]
+        actor_rows = {a.id: i for i, a in enumerate(self._actors)}
+        for v in ctx.non_ego_vehicles:
+            if not (v.id in actor_rows):
+                actor_rows[v.id] = len(self._actors)
+                self._actors.append(v)
+                flags.append(0)
+            flags[actor_rows[v.id]] |= ACTOR_VEHICLE
+        self._is_vehicle = [fnmatch(a.type_id,"*vehicle*") for a in self._actors]
+
+        os.makedirs(path,exist_ok=True)
+        meta = {
+            "version": TRACE_VERSION,
+            "map": map_name,
+            "coverage_variables": [v[0].name for v in coverage_space.variables],
+            "actors": [{"id": a.id,"type_id": a.type_id,"attributes": dict(a.attributes),"flags": f,
+                        "extent": [a.bounding_box.extent.x,a.bounding_box.extent.y,a.bounding_box.extent.z]}
+                       for a, f in zip(self._actors,flags)]
+        }
+        with open(os.path.join(path,TRACE_META_FILE),"w") as meta_file:
+            json.dump(meta,meta_file,indent=1)
+        self._ticks_file = open(os.path.join(path,TRACE_TICKS_FILE),"wb")
+        self._actors_file = open(os.path.join(path,TRACE_ACTORS_FILE),"wb")
+        self._ticks = np.zeros(flush_interval,dtype=TICK_DTYPE)
+        self._actor_states = np.zeros((flush_interval,len(self._actors)),dtype=ACTOR_DTYPE)
+        self._buffered = 0
+
+    def record(self,frame: int,timestamp: float,ctx,coverage_key: int,weather: carla.WeatherParameters):
+        tick = self._ticks[self._buffered]
+        tick["frame"] = frame
+        tick["timestamp"] = timestamp
+        tick["coverage_key"] = coverage_key
+        tick["events"] = sum(1 << t.value for t in ctx.events.types)
+        tick["weather"] = (weather.cloudiness,weather.precipitation,weather.precipitation_deposits,weather.sun_altitude_angle)
+        tick["junction_status"] = ctx.junction_status.value
+        tick["traffic_light"] = ctx.traffic_light_status
+        tick["has_quads"] = ctx.quads != None
+        tick["quads"] = ctx.quads.get_vectors() if ctx.quads != None else (0,0,0,0,0,0)
+
+        ego = ctx.ego_vehicle
+        ego_loc = ego.get_location()
+        ego_wp = ctx.map.get_waypoint(ego_loc)
+        right_query = ego_loc + ego.get_transform().get_right_vector() * ego_wp.lane_width
+        tick["ego_waypoint"], tick["ego_markings"] = _waypoint_values(ego_wp)
+        tick["right_query"] = (right_query.x,right_query.y,right_query.z)
+        tick["right_waypoint"], tick["right_markings"] = _waypoint_values(ctx.map.get_waypoint(right_query))
+        junction = ego_wp.get_junction()
+        if junction != None:
+            bb = junction.bounding_box
+            tick["junction_id"] = junction.id
+            tick["junction_box"] = (bb.location.x,bb.location.y,bb.location.z,bb.extent.x,bb.extent.y,bb.extent.z,bb.rotation.yaw)
+        else:
+            tick["junction_id"] = -1
+            tick["junction_box"] = 0
+
+        states = self._actor_states[self._buffered]
+        for i, actor in enumerate(self._actors):
+            transform = actor.get_transform()
+            velocity = actor.get_velocity()
+            state = states[i]
+            state["transform"] = (transform.location.x,transform.location.y,transform.location.z,
+                                  transform.rotation.pitch,transform.rotation.yaw,transform.rotation.roll)
+            state["velocity"] = (velocity.x,velocity.y,velocity.z)
+            if self._is_vehicle[i]:
+                control = actor.get_control()
+                state["control"] = (control.throttle,control.steer,control.brake)
+                state["light_state"] = int(actor.get_light_state())
+                speed_limit = actor.get_speed_limit()
+                state["speed_limit"] = math.nan if speed_limit == None else speed_limit
+            else:
+                state["control"] = 0
+                state["light_state"] = 0
+                state["speed_limit"] = math.nan
+
+        self._buffered += 1
+        if self._buffered == self.flush_interval:
+            self.flush()
+
+    # Actor states go first so a reader never sees a tick without them
+    def flush(self):
+        if self._buffered == 0:
+            return
+        self._actor_states[:self._buffered].tofile(self._actors_file)
+        self._actors_file.flush()
+        self._ticks[:self._buffered].tofile(self._ticks_file)
+        self._ticks_file.flush()
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._actors_file.close()
+        self._ticks_file.close()
+
+def _waypoint_values(waypoint):
+    location = waypoint.transform.location
+    return ((location.x,location.y,location.z,waypoint.transform.rotation.yaw,waypoint.lane_width),
+            (int(waypoint.left_lane_marking.type),int(waypoint.left_lane_marking.color),
+             int(waypoint.right_lane_marking.type),int(waypoint.right_lane_marking.color)))
+
+def _map_records(path: str,dtype: np.dtype):
+    if os.path.getsize(path) < dtype.itemsize:
+        return np.zeros(0,dtype=dtype)
+    return np.memmap(path,dtype=dtype,mode="r",shape=(os.path.getsize(path) // dtype.itemsize,))
+
+# Memory maps a trace written by TraceRecorder. ticks is an array of TICK_DTYPE records and actors an array of
+# ACTOR_DTYPE records shaped (ticks, actors in meta["actors"]).
+class TraceReader:
+    def __init__(self,path: str):
+        self.path = path
+        with open(os.path.join(path,TRACE_META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["version"] != TRACE_VERSION:
+            raise Exception("Trace "+path+" has version "+str(self.meta["version"])+", expected "+str(TRACE_VERSION))
+        actor_count = len(self.meta["actors"])
+        ticks = _map_records(os.path.join(path,TRACE_TICKS_FILE),TICK_DTYPE)
+        actors = _map_records(os.path.join(path,TRACE_ACTORS_FILE),ACTOR_DTYPE)
+        tick_count = len(ticks) if actor_count == 0 else min(len(ticks),len(actors) // actor_count)
+        self.ticks = ticks[:tick_count]
+        self.actors = actors[:tick_count * actor_count].reshape((tick_count,actor_count))
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def get_events(self,tick: int):
+        mask = int(self.ticks[tick]["events"])
+        return [t for t in SensorEventType if mask & (1 << t.value)]
+
+    def get_quads(self,tick: int):
+        record = self.ticks[tick]
+        if not record["has_quads"]:
+            return None
+        q = [float(x) for x in record["quads"]]
+        return PartitionedJunction(carla.Vector3D(q[0],q[1],0),carla.Vector3D(q[2],q[3],0),carla.Vector3D(q[4],q[5],0))
+
+# First unused directory under directory for a trace named after prefix
+def new_trace_path(directory: str,prefix: str):
+    i = 0
+    while os.path.exists(os.path.join(directory,prefix+"_"+str(i))):
+        i += 1
+    return os.path.join(directory,prefix+"_"+str(i))
+
+# Trace directories under each path, a path that is itself a trace is returned as is
+def find_traces(paths: List[str]):
+    traces = []
+    for path in paths:
+        if os.path.isfile(os.path.join(path,TRACE_META_FILE)):
+            traces.append(path)
+            continue
+        for root, directories, files in os.walk(path):
+            directories.sort()
+            if TRACE_META_FILE in files:
+                traces.append(root)
+    return traces
@@ -1,27 +1,33 @@
 import csv
+import io
 import os
+from persistence import AsyncWriter
 
+# The score is kept in memory and written out through writer on a background thread when one is given
 class ScoreWriter():
-    def __init__(self,score_file_path):
+    def __init__(self,score_file_path,writer: AsyncWriter = None):
          self.score_file_path = score_file_path
+         self.writer = writer
          self.score = 0
-         if not os.path.isfile(self.score_file_path):
+         if os.path.isfile(self.score_file_path):
+              with open(self.score_file_path, 'r', newline='') as scorefile:
+                   data = list(csv.reader(scorefile))
+                   assert(len(data) == 2)
+                   self.score = int(data[1][0])
+         else:
               self.update_score_file(0)
 
     def add_and_update_scenario_score(self,delta_score: int):
-        if os.path.isfile(self.score_file_path):
-            with open(self.score_file_path, 'r', newline='') as scorefile:
-                reader = csv.reader(scorefile)
-                data = list(reader)
-                assert(len(data) == 2)
-                self.score = int(data[1][0])
-                self.score += delta_score
-            self.update_score_file(self.score)
-        else:
-            self.update_score_file(0)
+        self.score += delta_score
+        self.update_score_file(self.score)
 
     def update_score_file(self,score: int):
-        with open(self.score_file_path, 'w', newline='') as scorefile:
-                writer = csv.DictWriter(scorefile, fieldnames=['score'])
-                writer.writeheader()
-                writer.writerow({'score': score})
\ No newline at end of file
+        contents = io.StringIO()
+        writer = csv.DictWriter(contents, fieldnames=['score'])
+        writer.writeheader()
+        writer.writerow({'score': score})
+        if self.writer != None:
+            self.writer.write(self.score_file_path,contents.getvalue())
+        else:
+            with open(self.score_file_path, 'w', newline='') as scorefile:
+                scorefile.write(contents.getvalue())
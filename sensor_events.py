@@ -0,0 +1,75 @@
+import threading
+from carla_backend import carla
+from enum import Enum
+from typing import List, Set, Tuple
+from checker_utils import vehicle_or_pedestrian
+
+class SensorEventType(Enum):
+    OFF_ROAD = 0
+    NO_OVERTAKING = 1
+    NO_STOPPING_LINE = 2
+    CROSSING_INTO_RIGHT_LANE = 3
+    STATIC_COLLISION = 4
+
+# Which event types crossing the given lane markings raises
+def classify_lane_invasion(crossed_lane_markings: List[carla.LaneMarking]):
+    crossed_markings = [l.type for l in crossed_lane_markings]
+    colors = [l.color for l in crossed_lane_markings]
+    types = set()
+    if any([c in [carla.LaneMarkingType.Grass,carla.LaneMarkingType.Curb,carla.LaneMarkingType.NONE] for c in crossed_markings]):
+        types.add(SensorEventType.OFF_ROAD)
+    if any([c in [carla.LaneMarkingType.SolidSolid,carla.LaneMarkingType.SolidBroken] for c in crossed_markings]):
+        types.add(SensorEventType.NO_OVERTAKING)
+    if any([c in [carla.LaneMarkingType.SolidSolid,carla.LaneMarkingType.SolidBroken,carla.LaneMarkingType.Broken,carla.LaneMarkingType.BrokenSolid,carla.LaneMarkingType.BrokenBroken] for c in crossed_markings]):
+        types.add(SensorEventType.CROSSING_INTO_RIGHT_LANE)
+    if any([c in [carla.LaneMarkingColor.Red,carla.LaneMarkingColor.Yellow] for c in colors]):
+        types.add(SensorEventType.NO_STOPPING_LINE)
+    return types
+
+def classify_collision(other_actor: carla.Actor):
+    if not vehicle_or_pedestrian(other_actor):
+        return {SensorEventType.STATIC_COLLISION}
+    return set()
+
+# The sensor events handed to one tick
+class TickEvents:
+    def __init__(self,frame: int = None,events: List[Tuple[int,SensorEventType]] = None):
+        if events == None:
+            events = []
+        self.frame = frame
+        self.events = events
+        self.types: Set[SensorEventType] = set(e[1] for e in events)
+
+    def has(self,event_type: SensorEventType):
+        return event_type in self.types
+
+# Collects sensor events from the callback threads, stamped with the frame they happened in. Each tick takes
+# every event up to and including its frame, events from later frames wait for the tick that reaches them
+# so none are lost between the oracles reading events and the next tick starting.
+class SensorEventBus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[int,SensorEventType]] = []
+
+    def publish(self,frame: int,types: Set[SensorEventType]):
+        if len(types) == 0:
+            return
+        with self._lock:
+            self._pending.extend((frame,t) for t in types)
+
+    def lane_callback(self,li_event: carla.LaneInvasionEvent):
+        self.publish(li_event.frame,classify_lane_invasion(li_event.crossed_lane_markings))
+
+    def collision_callback(self,col_event: carla.CollisionEvent):
+        self.publish(col_event.frame,classify_collision(col_event.other_actor))
+
+    # Removes and returns the events up to frame, or all pending events if frame is None
+    def take(self,frame: int = None):
+        with self._lock:
+            if frame == None:
+                events = self._pending
+                self._pending = []
+            else:
+                events = [e for e in self._pending if e[0] <= frame]
+                self._pending = [e for e in self._pending if e[0] > frame]
+        return TickEvents(frame,events)
@@ -0,0 +1,66 @@
+import numpy as np
+from typing import Dict, Tuple
+
+# Uniform grid over actor positions on the x-y plane, built once per tick and shared by every
+# proximity query in that tick. Positions are an (N,2) or (N,3) array, distances are checked
+# exactly using every column so results match a linear scan.
+class SpatialGrid:
+    def __init__(self,positions: np.ndarray,cell_size: float = 25):
+        self.cell_size = cell_size
+        self.positions = np.asarray(positions,dtype=float)
+        self._cells: Dict[Tuple[int,int],np.ndarray] = {}
+        if len(self.positions) == 0:
+            return
+        cells = np.floor(self.positions[:,:2] / cell_size).astype(np.int64)
+        order = np.lexsort((cells[:,1],cells[:,0]))
+        sorted_cells = cells[order]
+        boundaries = np.flatnonzero(np.any(np.diff(sorted_cells,axis=0) != 0,axis=1)) + 1
+        for group in np.split(order,boundaries):
+            cell = cells[group[0]]
+            self._cells[(int(cell[0]),int(cell[1]))] = group
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Indices of every position in a cell overlapping the given x-y rectangle
+    def _candidates(self,min_x: float,min_y: float,max_x: float,max_y: float):
+        min_cell_x = int(np.floor(min_x / self.cell_size))
+        max_cell_x = int(np.floor(max_x / self.cell_size))
+        min_cell_y = int(np.floor(min_y / self.cell_size))
+        max_cell_y = int(np.floor(max_y / self.cell_size))
+        if (max_cell_x - min_cell_x + 1) * (max_cell_y - min_cell_y + 1) > len(self._cells):
+            groups = [g for c, g in self._cells.items() if min_cell_x <= c[0] <= max_cell_x and min_cell_y <= c[1] <= max_cell_y]
+        else:
+            groups = []
+            for x in range(min_cell_x,max_cell_x + 1):
+                for y in range(min_cell_y,max_cell_y + 1):
+                    group = self._cells.get((x,y))
+                    if group is not None:
+                        groups.append(group)
+        if len(groups) == 0:
+            return np.zeros(0,dtype=np.int64)
+        return np.concatenate(groups)
+
+    # Indices of positions strictly closer than radius to centre
+    def query_radius(self,centre: np.ndarray,radius: float):
+        centre = np.asarray(centre,dtype=float)
+        candidates = self._candidates(centre[0] - radius,centre[1] - radius,centre[0] + radius,centre[1] + radius)
+        if len(candidates) == 0:
+            return candidates
+        dims = min(len(centre),self.positions.shape[1])
+        offsets = self.positions[candidates,:dims] - centre[:dims]
+        return candidates[np.einsum('ij,ij->i',offsets,offsets) < radius * radius]
+
+    # Indices of positions inside the axis aligned x-y rectangle
+    def query_box(self,min_x: float,min_y: float,max_x: float,max_y: float):
+        candidates = self._candidates(min_x,min_y,max_x,max_y)
+        if len(candidates) == 0:
+            return candidates
+        points = self.positions[candidates]
+        return candidates[(points[:,0] >= min_x) & (points[:,0] <= max_x) & (points[:,1] >= min_y) & (points[:,1] <= max_y)]
+
+    def count_within(self,centre: np.ndarray,radius: float):
+        return len(self.query_radius(centre,radius))
+
+def location_array(location):
+    return np.array([location.x,location.y,location.z])
@@ -1,5 +1,7 @@
-import carla
+from carla_backend import carla
 import time
+import random
+from typing import List
 
 def wrongLane(client: carla.Client,overtake=False):
     world = client.get_world()
@@ -134,6 +136,59 @@ def Roundabout(client: carla.Client):
 def reversed_spawn(spawn_point: carla.Transform):
     return carla.Transform(spawn_point.location, carla.Rotation(spawn_point.rotation.pitch,spawn_point.rotation.yaw + 180,spawn_point.rotation.roll))
 
+# Actors available when building scenarios, in the order they are offered in the setup UI
+ACTOR_BLUEPRINT_IDS = ["vehicle.audi.etron",
+                       "vehicle.chevrolet.impala",
+                       "walker.pedestrian.0001",
+                       "vehicle.harley-davidson.low_rider",
+                       "vehicle.dodge.charger_police",
+                       "vehicle.ford.mustang",
+                       "vehicle.carlamotors.carlacola",
+                       "vehicle.citroen.c3",
+                       "vehicle.diamondback.century"
+                       ]
+CAR_BLUEPRINT_IDS = ["vehicle.audi.etron","vehicle.chevrolet.impala","vehicle.ford.mustang","vehicle.carlamotors.carlacola","vehicle.citroen.c3"]
+BIKE_BLUEPRINT_IDS = ["vehicle.harley-davidson.low_rider","vehicle.diamondback.century"]
+PEDESTRIAN_BLUEPRINT_IDS = ["walker.pedestrian.0001"]
+EMERGENCY_BLUEPRINT_IDS = ["vehicle.dodge.charger_police"]
+
+def spawn_ego(world: carla.World,spawn_point: carla.Transform,blueprint_id: str = "vehicle.tesla.cybertruck"):
+    ego_bp = world.get_blueprint_library().filter(blueprint_id)[0]
+    ego_bp.set_attribute('role_name', 'hero')
+    return world.spawn_actor(ego_bp,spawn_point)
+
+# Spawns blueprint_id facing back along a random one of spawn_points with a path to another of them.
+# Returns (actor, path), or None if the spawn point was blocked.
+def spawn_path_actor(world: carla.World,blueprint_id: str,spawn_points: List[carla.Transform]):
+    actor = world.try_spawn_actor(world.get_blueprint_library().filter(blueprint_id)[0],reversed_spawn(random.choice(spawn_points)))
+    if actor == None:
+        return None
+    return (actor,[random.choice(spawn_points).location])
+
+def spawn_points_near(spawn_points: List[carla.Transform],location: carla.Location,distance: float = 25):
+    return [t for t in spawn_points if (t.location - location).length() < distance]
+
+# Spawn transforms along the driving lanes within distance of location, spacing apart, for when a
+# scenario needs more actors than there are spawn points nearby
+def lane_spawn_points_near(map: carla.Map,location: carla.Location,distance: float = 25,spacing: float = 6):
+    start = map.get_waypoint(location)
+    seen = set()
+    frontier = [start]
+    spawn_points = []
+    while len(frontier) > 0:
+        w = frontier.pop()
+        cell = (w.road_id,w.lane_id,int(w.s // spacing))
+        if cell in seen or (w.transform.location - location).length() >= distance:
+            continue
+        seen.add(cell)
+        spawn_points.append(carla.Transform(w.transform.location + carla.Vector3D(0,0,0.5),w.transform.rotation))
+        neighbours = w.next(spacing) + w.previous(spacing) + [w.get_left_lane(),w.get_right_lane()]
+        frontier.extend(n for n in neighbours if n != None and n.lane_type == carla.LaneType.Driving)
+    return spawn_points
+
+def overhead_spectator(spectator: carla.Actor,location: carla.Location):
+    spectator.set_transform(carla.Transform(location + carla.Vector3D(0,0,30),carla.Rotation(pitch=-90)))
+
 test_scenarios = {
     "StationaryCollision" : stationaryVehicleCollision,
     "TJunctionMinorRoad": TJunctionMinorUnsafe,
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The tests run against the in-process fake simulator in fake_carla.py, so they need no CARLA server
+os.environ["CARLA_BACKEND"] = "fake"
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT","1")
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,156 @@
+import random
+import numpy as np
+import pytest
+from carla_backend import carla
+from checker_utils import actor_geometry_array, within_box_in_front_mask, vehicle_in_overtake_range_mask, get_entry_junction_status, JunctionStatusError
+from spatial_index import SpatialGrid
+
+# Stands in for a simulator actor, the checks only read its transform, velocity and bounding box
+class StubActor:
+    def __init__(self,transform: carla.Transform,velocity: carla.Vector3D,extent: carla.Vector3D):
+        self.bounding_box = carla.BoundingBox(carla.Location(0,0,0),extent)
+        self._transform = transform
+        self._velocity = velocity
+
+    def get_transform(self):
+        return self._transform
+
+    def get_location(self):
+        location = self._transform.location
+        return carla.Location(location.x,location.y,location.z)
+
+    def get_velocity(self):
+        return self._velocity
+
+class StubDebugHelper:
+    def draw_box(self,*args,**kwargs):
+        pass
+
+class StubWorld:
+    def __init__(self):
+        self.debug = StubDebugHelper()
+
+# The per-actor checks the masks replaced, kept as the oracle the masks must agree with
+def within_box_in_front_of_vehicle(from_vehicle,other_vehicle,box_length,world):
+    extents = from_vehicle.bounding_box.extent
+    transform = from_vehicle.get_transform()
+    centre = transform.location
+    direction_vector = transform.get_forward_vector()
+
+    other_loc = other_vehicle.get_location()
+    other_bb = other_vehicle.bounding_box.extent
+    other_forward = other_vehicle.get_transform().get_forward_vector()
+    other_right = other_vehicle.get_transform().get_right_vector()
+    points_to_check = [other_loc + other_bb.x * other_forward + other_bb.y * other_right,
+                       other_loc + -other_bb.x * other_forward + other_bb.y * other_right,
+                       other_loc + -other_bb.x * other_forward + -other_bb.y * other_right,
+                       other_loc + other_bb.x * other_forward + -other_bb.y * other_right]
+
+    box = carla.BoundingBox(carla.Vector3D(0,0,0),
+                            carla.Vector3D((box_length/2),extents.y,2 * extents.z))
+    return any(box.contains(p,carla.Transform(centre + direction_vector * (extents.x + box_length/2),transform.rotation)) for p in points_to_check)
+
+def vehicle_in_overtake_range(ego_vehicle,other_vehicle,world):
+    ego_trans = ego_vehicle.get_transform()
+    overtake_distance = 10
+    extents = ego_vehicle.bounding_box.extent
+    box = carla.BoundingBox(carla.Vector3D(0,0,0),carla.Vector3D(overtake_distance,2.5 * extents.y,extents.z))
+    return (ego_vehicle.get_velocity().length() > other_vehicle.get_velocity().length() and
+            (box.contains(other_vehicle.get_location(),carla.Transform(ego_vehicle.get_location() - ego_trans.get_right_vector() * extents.y * 3.5,ego_trans.rotation))
+            or within_box_in_front_of_vehicle(ego_vehicle,other_vehicle,overtake_distance/2 - extents.x,world))
+    )
+
+# An ego and count vehicles and walkers scattered around it at random headings and speeds. With tilt, actors
+# are pitched and rolled by up to tilt degrees and placed at heights up to a tenth of spread apart, as on ramps.
+def scatter_actors(seed: int,count: int = 150,spread: float = 30,tilt: float = 0):
+    rng = random.Random(seed)
+    actors = []
+    for i in range(count + 1):
+        offset = (0,0) if i == 0 else (rng.uniform(-spread,spread),rng.uniform(-spread,spread))
+        if i == 0 or rng.random() < 0.7:
+            extent = carla.Vector3D(rng.uniform(0.8,2.6),rng.uniform(0.4,1.1),0.8)
+        else:
+            extent = carla.Vector3D(0.3,0.3,0.9)
+        height = 0 if i == 0 or tilt == 0 else rng.uniform(-spread/10,spread/10)
+        rotation = carla.Rotation(pitch=rng.uniform(-tilt,tilt),yaw=rng.uniform(-180,180),roll=rng.uniform(-tilt,tilt))
+        transform = carla.Transform(carla.Location(offset[0],offset[1],height),rotation)
+        # The ego is faster than most others, so some are in overtaking range
+        velocity = carla.Vector3D(12,0,0) if i == 0 else carla.Vector3D(rng.uniform(-15,15),rng.uniform(-15,15),0)
+        actors.append(StubActor(transform,velocity,extent))
+    return StubWorld(), actors[0], actors[1:]
+
+@pytest.mark.parametrize("tilt",[0,20])
+@pytest.mark.parametrize("seed",range(5))
+def test_within_box_in_front_mask_matches_per_actor_check(seed,tilt):
+    world, ego, others = scatter_actors(seed,tilt=tilt)
+    geometry = actor_geometry_array(others)
+    index = SpatialGrid(geometry[:,:3])
+    in_front = 0
+    for box_length in [0.5,5,12.5,30]:
+        expected = np.array([within_box_in_front_of_vehicle(ego,o,box_length,world) for o in others])
+        assert (within_box_in_front_mask(ego,geometry,box_length,world) == expected).all()
+        assert (within_box_in_front_mask(ego,geometry,box_length,world,index) == expected).all()
+        in_front += int(expected.sum())
+    assert in_front > 0
+
+@pytest.mark.parametrize("tilt",[0,20])
+@pytest.mark.parametrize("seed",range(5))
+def test_vehicle_in_overtake_range_mask_matches_per_actor_check(seed,tilt):
+    world, ego, others = scatter_actors(seed,spread=15,tilt=tilt)
+    geometry = actor_geometry_array(others)
+    index = SpatialGrid(geometry[:,:3])
+    expected = np.array([vehicle_in_overtake_range(ego,o,world) for o in others])
+    assert expected.any()
+    assert (vehicle_in_overtake_range_mask(ego,geometry,world) == expected).all()
+    assert (vehicle_in_overtake_range_mask(ego,geometry,world,index) == expected).all()
+
+def test_masks_of_no_actors_are_empty():
+    world, ego, _ = scatter_actors(0,count=0)
+    geometry = actor_geometry_array([])
+    assert len(within_box_in_front_mask(ego,geometry,10,world,SpatialGrid(geometry[:,:3]))) == 0
+    assert len(vehicle_in_overtake_range_mask(ego,geometry,world,SpatialGrid(geometry[:,:3]))) == 0
+
+# Stands in for the waypoints, junction and entry get_entry_junction_status reads
+class StubWaypoint:
+    def __init__(self,location: carla.Location,previous_waypoints=None,next_waypoints=None):
+        self.transform = carla.Transform(location,carla.Rotation())
+        self.lane_width = 3.5
+        self._previous_waypoints = previous_waypoints if previous_waypoints != None else []
+        self._next_waypoints = next_waypoints if next_waypoints != None else []
+
+    def previous(self,distance: float):
+        return self._previous_waypoints
+
+    def next(self,distance: float):
+        return self._next_waypoints
+
+    def get_junction(self):
+        return None
+
+class StubTopology:
+    def __init__(self,entrypoints: list):
+        self.id = 1
+        self.entrypoints = entrypoints
+
+class StubEntry:
+    def __init__(self,entrypoint: StubWaypoint,destinations: list):
+        self.entrypoint = entrypoint
+        self.destinations = destinations
+        self.roundabout = None
+
+def test_junction_entries_the_map_cant_resolve_raise():
+    exit_lane = [StubWaypoint(carla.Location(20,0,0))]
+    turn = StubWaypoint(carla.Location(5,10,0),next_waypoints=exit_lane)
+    # No lane leading into the entry
+    entrypoint = StubWaypoint(carla.Location(0,0,0))
+    with pytest.raises(JunctionStatusError):
+        get_entry_junction_status(StubTopology([entrypoint]),StubEntry(entrypoint,[turn]))
+    # A turn out of a junction with no other entrance to partition it against
+    entrypoint = StubWaypoint(carla.Location(0,0,0),previous_waypoints=[StubWaypoint(carla.Location(-10,0,0))])
+    with pytest.raises(JunctionStatusError):
+        get_entry_junction_status(StubTopology([entrypoint]),StubEntry(entrypoint,[turn]))
+    # A lane straight on and a turn make a T-junction seen from its major road
+    straight = StubWaypoint(carla.Location(10,0,0),next_waypoints=exit_lane)
+    other_entrypoint = StubWaypoint(carla.Location(5,15,0))
+    status, _ = get_entry_junction_status(StubTopology([entrypoint,other_entrypoint]),StubEntry(entrypoint,[straight,turn]))
+    assert status.name == "T_ON_MAJOR"
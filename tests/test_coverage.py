@@ -0,0 +1,166 @@
+import csv
+import itertools
+import os
+import random
+import pytest
+from assertion import Assertion
+from coverage import Coverage, CoverageVariableSet, CoverageStates, BUG, COVERED, UNCOVERED, INVALID, get_journal_path
+from coverage_variables import CoverageVariable, BooleanEnum, Levels, TimesOfDay
+from persistence import AsyncWriter
+
+@pytest.fixture
+def catalogue():
+    return [Assertion(100 + i,0,"",lambda: True,lambda: True) for i in range(4)]
+
+@pytest.fixture
+def coverage_space():
+    return CoverageVariableSet([(CoverageVariable.RAIN,Levels),(CoverageVariable.CARS_PRESENT,BooleanEnum),(CoverageVariable.TIME_OF_DAY,TimesOfDay)])
+
+def coverage_state(rain: Levels,cars: BooleanEnum,time_of_day: TimesOfDay):
+    return [(CoverageVariable.RAIN,rain),(CoverageVariable.CARS_PRESENT,cars),(CoverageVariable.TIME_OF_DAY,time_of_day)]
+
+# Macro-bin key cells to state names, as written in the snapshot at path
+def read_snapshot(path: str):
+    with open(path,'r',newline='') as coveragefile:
+        rows = list(csv.reader(coveragefile))
+    return {tuple(row[:3]): row[3:] for row in rows[1:]}
+
+def test_journal_round_trip(tmp_path,catalogue,coverage_space):
+    path = str(tmp_path / "coverage.csv")
+    coverage = Coverage(path,catalogue,coverage_space,compaction_threshold=10 ** 6)
+    state = coverage_state(Levels.LOW,BooleanEnum.TRUE,TimesOfDay.DAY)
+    coverage.try_cover(state,[],[],catalogue)
+    coverage.try_cover(state,catalogue[2:3],catalogue[:2],catalogue)
+    coverage.try_cover(coverage_state(Levels.HIGH,BooleanEnum.FALSE,TimesOfDay.NIGHT),[],[],catalogue[:1])
+    # Changes so far are only in the journal, the snapshot still has just its header
+    assert os.path.getsize(get_journal_path(path)) > 0
+    assert read_snapshot(path) == {}
+
+    reloaded = Coverage(path,catalogue,coverage_space)
+    assert reloaded.get_num_cases() == coverage.get_num_cases()
+    # Loading folds the journal into the snapshot
+    assert not os.path.isfile(get_journal_path(path))
+    assert read_snapshot(path) == {("LOW","TRUE","DAY"): ["COVERED","COVERED","BUG","UNCOVERED"],
+                                   ("HIGH","FALSE","NIGHT"): ["UNCOVERED","INVALID","INVALID","INVALID"]}
+
+def test_truncated_journal_record_is_ignored(tmp_path,catalogue,coverage_space):
+    path = str(tmp_path / "coverage.csv")
+    coverage = Coverage(path,catalogue,coverage_space,compaction_threshold=10 ** 6)
+    state = coverage_state(Levels.NONE,BooleanEnum.TRUE,TimesOfDay.SUNSET)
+    coverage.try_cover(state,[],[],catalogue[:2])
+    coverage.try_cover(state,[],catalogue[:2],catalogue[:2])
+    with open(get_journal_path(path),'a') as journalfile:
+        journalfile.write("NONE,TRUE,SUNSET,100.")
+    reloaded = Coverage(path,catalogue,coverage_space)
+    assert reloaded.get_num_cases() == coverage.get_num_cases()
+
+def test_journal_is_compacted(tmp_path,catalogue,coverage_space):
+    path = str(tmp_path / "coverage.csv")
+    coverage = Coverage(path,catalogue,coverage_space,compaction_threshold=len(catalogue))
+    for level in [Levels.NONE,Levels.LOW,Levels.MEDIUM]:
+        coverage.try_cover(coverage_state(level,BooleanEnum.TRUE,TimesOfDay.DAY),[],[],catalogue)
+    # Each new macro-bin journals every micro-bin, reaching the threshold, so the snapshot has been rewritten
+    assert not os.path.isfile(get_journal_path(path))
+    assert len(read_snapshot(path)) == 3
+    coverage.try_cover(coverage_state(Levels.NONE,BooleanEnum.TRUE,TimesOfDay.DAY),[],catalogue[:1],catalogue)
+    assert os.path.isfile(get_journal_path(path))
+    assert Coverage(path,catalogue,coverage_space).get_num_cases() == coverage.get_num_cases()
+
+def test_keys_round_trip(coverage_space):
+    keys = set()
+    for values in itertools.product(Levels,BooleanEnum,TimesOfDay):
+        state = coverage_state(*values)
+        key = coverage_space.encode_key(state)
+        # Keys don't depend on the order the variables are given in
+        assert coverage_space.encode_key(list(reversed(state))) == key
+        assert coverage_space.decode_key(key) == values
+        assert 0 <= key < coverage_space.key_count
+        keys.add(key)
+    assert len(keys) == coverage_space.key_count
+
+def test_rows_written_before_assertions_were_added_are_padded(tmp_path,catalogue,coverage_space):
+    path = str(tmp_path / "coverage.csv")
+    state = coverage_state(Levels.MEDIUM,BooleanEnum.FALSE,TimesOfDay.SUNRISE)
+    coverage = Coverage(path,catalogue[:2],coverage_space)
+    coverage.try_cover(state,[],[],catalogue[:2])
+    coverage.try_cover(state,catalogue[1:2],catalogue[:1],catalogue[:2])
+    coverage.write_coverage()
+
+    reloaded = Coverage(path,catalogue,coverage_space)
+    assert reloaded.get_num_cases()[1:] == (1,2)
+    reloaded.write_coverage()
+    assert read_snapshot(path) == {("MEDIUM","FALSE","SUNRISE"): ["COVERED","BUG","INVALID","INVALID"]}
+
+# States of a macro-bin in a Coverage, read back through a snapshot written next to it
+def read_snapshot_row(coverage: Coverage,key: int):
+    coverage.write_coverage()
+    return [CoverageStates[c].value for c in read_snapshot(coverage.coverage_file_path)[tuple(coverage.get_key_cells(key))]]
+
+# Updates a macro-bin's states the way Coverage.try_cover did before states became bitsets
+def try_cover_reference(states: list,valid: set,covered: set,violated: set):
+    for i, state in enumerate(list(states)):
+        if i in valid and state == INVALID:
+            states[i] = UNCOVERED
+        if i in violated and (state == COVERED or state == UNCOVERED):
+            states[i] = BUG
+        elif i in covered and state == UNCOVERED:
+            states[i] = COVERED
+
+def to_bits(indices: set):
+    bits = 0
+    for i in indices:
+        bits |= 1 << i
+    return bits
+
+def test_try_cover_bits_precedence(tmp_path,catalogue,coverage_space):
+    coverage = Coverage(str(tmp_path / "coverage.csv"),catalogue,coverage_space)
+    # Valid makes a micro-bin UNCOVERED, it can only be covered or violated from the next tick on
+    assert coverage.try_cover_bits(1,0b111,0b111,0) == (0,[0,1,2,3])
+    assert coverage.try_cover_bits(1,0b111,0b011,0b001) == (2,[0,1])
+    assert coverage.try_cover_bits(1,0b111,0b111,0b110) == (1,[1,2])
+    # Violated wins over covered in the same tick, and BUG is never downgraded
+    assert read_snapshot_row(coverage,1) == [BUG,BUG,BUG,INVALID]
+    assert coverage.try_cover_bits(1,0b111,0b111,0) == (0,[])
+    assert coverage.get_num_cases()[1:] == (3,3)
+
+@pytest.mark.parametrize("seed",range(3))
+def test_try_cover_bits_matches_reference(tmp_path,catalogue,coverage_space,seed):
+    rng = random.Random(seed)
+    coverage = Coverage(str(tmp_path / "coverage.csv"),catalogue,coverage_space)
+    bins = len(catalogue)
+    expected = {}
+    for _ in range(300):
+        key = rng.randrange(5)
+        valid, covered, violated = [set(i for i in range(bins) if rng.random() < p) for p in (0.5,0.3,0.1)]
+        states = expected.setdefault(key,[INVALID] * bins)
+        try_cover_reference(states,valid,covered,violated)
+        coverage.try_cover_bits(key,to_bits(valid),to_bits(covered),to_bits(violated))
+    for key, states in expected.items():
+        assert read_snapshot_row(coverage,key) == states
+    assert coverage.get_num_cases()[1] == sum(s.count(BUG) for s in expected.values())
+    assert coverage.get_num_cases()[2] == sum(s.count(BUG) + s.count(COVERED) for s in expected.values())
+
+def test_journal_is_kept_when_snapshot_write_fails(tmp_path,catalogue,coverage_space):
+    path = str(tmp_path / "coverage.csv")
+    writer = AsyncWriter(batch_interval=0)
+    try:
+        coverage = Coverage(path,catalogue,coverage_space,compaction_threshold=10 ** 6,writer=writer)
+        coverage.try_cover(coverage_state(Levels.LOW,BooleanEnum.TRUE,TimesOfDay.DAY),[],[],catalogue)
+        writer.flush()
+        # Snapshots are written through a temporary file next to them, a directory in its place makes that fail
+        os.mkdir(path + ".tmp")
+        coverage.write_coverage()
+        coverage.try_cover(coverage_state(Levels.LOW,BooleanEnum.TRUE,TimesOfDay.DAY),[],catalogue[:1],catalogue)
+        writer.flush()
+        assert read_snapshot(path) == {}
+        # Both ticks are still in the journal
+        with open(get_journal_path(path),'r',newline='') as journalfile:
+            assert len(list(csv.reader(journalfile))) == len(catalogue) + 1
+
+        os.rmdir(path + ".tmp")
+        coverage.write_coverage()
+        writer.flush()
+        assert not os.path.isfile(get_journal_path(path))
+        assert read_snapshot(path) == {("LOW","TRUE","DAY"): ["COVERED","UNCOVERED","UNCOVERED","UNCOVERED"]}
+    finally:
+        writer.close()
@@ -0,0 +1,45 @@
+import signal
+import sys
+import pytest
+import farm
+from coverage import Coverage, CoverageStates, read_coverage_file
+from rules import ScenarioContext, build_assertions
+from world_state import build_coverage_space
+
+# Macro-bin key cells to a list of state values of the coverage at path, with its journal folded into the snapshot
+def load_states(path: str):
+    Coverage(path,build_assertions(ScenarioContext()),build_coverage_space())
+    return {tuple(key_cells): [CoverageStates[c].value for c in state_cells] for _, _, key_cells, state_cells in read_coverage_file(path)}
+
+def test_farm_merges_worker_coverage(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys,"argv",["farm.py","fake:1","fake:2","--scenarios","1","--max-ticks","30","--sync","--max-speed","--seed","1"])
+    farm.main()
+
+    worker_states = []
+    for name in ["fake_1","fake_2"]:
+        sessions = list((tmp_path / "out" / "farm" / name).glob("coverage_*.csv"))
+        assert len(sessions) == 1
+        states = load_states(str(sessions[0]))
+        assert len(states) > 0
+        worker_states.append(states)
+
+    # Each micro-bin of the global coverage holds the lowest state any worker reached for it
+    expected = {}
+    for states in worker_states:
+        for key, values in states.items():
+            expected[key] = [min(a,b) for a, b in zip(expected[key],values)] if key in expected else values
+    assert load_states("out/global_coverage.csv") == expected
+
+def test_farm_stops_workers_when_interrupted(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    started = []
+    def interrupt(self,deltas,workers,global_coverage):
+        started.extend(workers)
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(farm.Farm,"merge_deltas",interrupt)
+    monkeypatch.setattr(sys,"argv",["farm.py","fake:1","fake:2","--scenarios","1","--max-seconds","60","--sync","--seed","1"])
+    with pytest.raises(KeyboardInterrupt):
+        farm.main()
+    assert len(started) == 2
+    assert all(w.exitcode == -signal.SIGTERM for w in started)
@@ -0,0 +1,36 @@
+import sys
+import main as scenario_runner
+from coverage import Coverage
+from rules import ScenarioContext, build_assertions
+from world_state import build_coverage_space
+
+def run_main(monkeypatch,*args):
+    monkeypatch.setattr(sys,"argv",["main.py"] + list(args))
+    scenario_runner.main()
+
+# (total, violated, covered) micro-bins of the coverage snapshot and journal at path
+def load_coverage_counts(path: str):
+    return Coverage(path,build_assertions(ScenarioContext()),build_coverage_space()).get_num_cases()
+
+def test_headless_run_covers_cases(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_main(monkeypatch,"--headless","--sync","--max-speed","--scenarios","2","--max-ticks","40","--seed","1","--record")
+    _, violated, covered = load_coverage_counts("out/global_coverage.csv")
+    assert covered > 0
+    assert covered >= violated
+    sessions = list((tmp_path / "out").glob("coverage_*.csv"))
+    assert len(sessions) == 1
+    assert load_coverage_counts(str(sessions[0]))[2] == covered
+    assert len(list((tmp_path / "out").glob("score_*.csv"))) == 1
+    assert len(list((tmp_path / "out" / "traces").iterdir())) == 2
+
+def test_headless_run_with_profile(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_main(monkeypatch,"--headless","--sync","--max-speed","--max-ticks","60","--seed","2","--profile")
+    assert len(list((tmp_path / "out").glob("profile_*.csv"))) == 1
+    assert len(list((tmp_path / "out").glob("profile_*.jsonl"))) == 1
+
+def test_headless_run_with_point_follower(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_main(monkeypatch,"--headless","--sync","--max-speed","--max-ticks","20","--seed","2","--npc-follower","points")
+    assert load_coverage_counts("out/global_coverage.csv")[2] > 0
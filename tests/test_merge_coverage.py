@@ -0,0 +1,57 @@
+import csv
+import os
+import random
+import pytest
+import merge_coverage
+from coverage import STATE_NAMES, INVALID, get_journal_path
+from merge_coverage import merge_coverage_files
+
+KEY_HEADERS = ["RAIN","CARS_PRESENT"]
+KEYS = [(rain,cars) for rain in ["NONE","LOW","MEDIUM","HIGH"] for cars in ["TRUE","FALSE"]]
+
+def write_snapshot(path: str,bin_ids: list,rows: dict):
+    with open(path,'w',newline='') as coveragefile:
+        writer = csv.writer(coveragefile)
+        writer.writerow(KEY_HEADERS + bin_ids)
+        for key, states in rows.items():
+            writer.writerow(list(key) + [STATE_NAMES[s] for s in states])
+
+def read_merged(path: str):
+    with open(path,'r',newline='') as coveragefile:
+        rows = list(csv.reader(coveragefile))
+    return rows[0], [tuple(row[:2]) for row in rows[1:]], {tuple(row[:2]): row[2:] for row in rows[1:]}
+
+# With 3 open runs at a time the runs are first merged in rounds
+@pytest.mark.parametrize("max_open_runs",[merge_coverage.MAX_OPEN_RUNS,3])
+def test_merge_spills_and_merges_in_key_order(tmp_path,monkeypatch,max_open_runs):
+    monkeypatch.setattr(merge_coverage,"MAX_OPEN_RUNS",max_open_runs)
+    rng = random.Random(0)
+    bin_ids = ["100.0","101.0","102.0"]
+    expected = {}
+    paths = []
+    for i in range(4):
+        # Later runs know more micro-bins, shorter rows are padded with INVALID
+        file_bin_ids = bin_ids[:2 + i % 2]
+        rows = {key: [rng.randrange(4) for _ in file_bin_ids] for key in rng.sample(KEYS,5)}
+        path = str(tmp_path / ("coverage_" + str(i) + ".csv"))
+        write_snapshot(path,file_bin_ids,rows)
+        paths.append(path)
+        for key, states in rows.items():
+            merged = expected.setdefault(key,[INVALID] * len(bin_ids))
+            for j, s in enumerate(states):
+                merged[j] = min(merged[j],s)
+
+    # Journal records are in their snapshot's column order and merge like snapshot rows
+    with open(get_journal_path(paths[0]),'w',newline='') as journalfile:
+        csv.writer(journalfile).writerow(["HIGH","FALSE","101.0","BUG"])
+    expected.setdefault(("HIGH","FALSE"),[INVALID] * len(bin_ids))[1] = 0
+
+    output_path = str(tmp_path / "merged.csv")
+    merger = merge_coverage_files(paths,output_path,chunk_rows=2)
+    header, keys, merged = read_merged(output_path)
+    assert header == KEY_HEADERS + bin_ids
+    assert keys == sorted(keys)
+    assert merged == {key: [STATE_NAMES[s] for s in states] for key, states in expected.items()}
+    assert merger.merged_count == len(expected)
+    # The run files are removed
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(p) for p in paths] + [os.path.basename(get_journal_path(paths[0])),"merged.csv"])
@@ -0,0 +1,33 @@
+from carla_backend import carla
+from coverage_variables import CoverageVariable, Levels
+from world_state import WorldState, WalkerRegistry
+
+def test_weather_change_is_recorded_from_the_next_tick():
+    world = carla.World(carla.Map("Weather_2x2",2,2))
+    ego = world.spawn_actor(world.get_blueprint_library().filter("*vehicle*")[0],world.get_map().get_spawn_points()[0])
+    world_state = WorldState(world)
+    def rain():
+        return dict(world_state.get_coverage_state(ego,[],world.get_map()))[CoverageVariable.RAIN]
+
+    world.set_weather(carla.WeatherParameters(precipitation=0))
+    assert rain() == Levels.NONE
+    assert rain() == Levels.NONE
+    world.set_weather(carla.WeatherParameters(precipitation=100))
+    assert rain() == Levels.VERY_HIGH
+
+def test_walker_registry_follows_spawned_and_destroyed_walkers():
+    world = carla.World(carla.Map("Walkers_2x2",2,2))
+    library = world.get_blueprint_library()
+    spawn_points = world.get_map().get_spawn_points()
+    world.spawn_actor(library.filter("*vehicle*")[0],spawn_points[0])
+    registry = WalkerRegistry(world)
+    registry.refresh()
+    assert registry.get_locations().shape == (0,3)
+
+    walker = world.spawn_actor(library.filter("*walker*")[0],spawn_points[1])
+    registry.refresh()
+    location = walker.get_location()
+    assert registry.get_locations().tolist() == [[location.x,location.y,location.z]]
+    walker.destroy()
+    registry.refresh()
+    assert registry.get_locations().shape == (0,3)
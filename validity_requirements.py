@@ -17,5 +17,45 @@ class ValidityRequirement:
                     return False
         return True
 
+# Validity requirements of a list of assertions compiled against a CoverageVariableSet. Every variable some
+# requirement constrains gets a bitmask per enum ordinal with bit j set if assertion j allows that value, so the
+# assertions valid in a coverage state are the AND of one bitmask per constrained variable. The resulting
+# assertion indices are memoised by macro-bin key as the state rarely changes between ticks.
+class CompiledValidityMatcher:
+    def __init__(self,requirements: List[ValidityRequirement],coverage_variable_set: "CoverageVariableSet"):
+        self.coverage_variable_set = coverage_variable_set
+        self.assertion_count = len(requirements)
+        self._all_mask = (1 << len(requirements)) - 1
+        # (variable index, bitmask per ordinal) for each constrained variable
+        self._variable_masks: List[Tuple[int,List[int]]] = []
+        for i, (variable, enum) in enumerate(coverage_variable_set.variables):
+            masks = [self._all_mask for _ in enum]
+            constrained = False
+            for j, r in enumerate(requirements):
+                if r == None or r.required_variables == None or not (variable in r.required_variables):
+                    continue
+                constrained = True
+                for ordinal, member in enumerate(enum):
+                    if not (member in r.required_variables[variable]):
+                        masks[ordinal] &= ~(1 << j)
+            if constrained:
+                self._variable_masks.append((i,masks))
+        self._active_indices: Dict[int,Tuple[int]] = {}
+
+    # Indices of the assertions valid in the macro-bin with the given key
+    def get_active_indices_for_key(self,key: int):
+        active = self._active_indices.get(key)
+        if active == None:
+            ordinals = self.coverage_variable_set.get_key_ordinals(key)
+            mask = self._all_mask
+            for i, masks in self._variable_masks:
+                mask &= masks[ordinals[i]]
+            active = tuple(j for j in range(self.assertion_count) if mask >> j & 1)
+            self._active_indices[key] = active
+        return active
+
+    def get_active_indices(self,variable_value_pairs: List[Tuple[CoverageVariable,Enum]]):
+        return self.get_active_indices_for_key(self.coverage_variable_set.encode_key(variable_value_pairs))
+
 IN_JUNCTION_REQUIREMENTS = ValidityRequirement(
     {CoverageVariable.ROAD_GRAPH: [RoadGraphs.TTTF,RoadGraphs.TTFT,RoadGraphs.TFTT,RoadGraphs.FTTT,RoadGraphs.TTTT]})
\ No newline at end of file
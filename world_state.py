@@ -1,15 +1,167 @@
-import carla
+from carla_backend import carla
 from coverage import CoverageVariableSet, CoverageVariable
 from validity_requirements import *
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Callable
+from enum import Enum
 import numpy as np
 from coverage_variables import *
 from fnmatch import fnmatch
+from actor_snapshot import ActorSnapshotCache
+from spatial_index import SpatialGrid, location_array
+from junction_cache import JunctionTopologyCache
+
+class RefreshPolicy(Enum):
+    EVERY_TICK = 0
+    EVERY_N_TICKS = 1
+    ON_WEATHER_CHANGE = 2
+    ON_ACTORS_CHANGE = 3
+
+# When each coverage variable is recomputed as (policy, ticks between refreshes for EVERY_N_TICKS). Weather rarely
+# changes mid-scenario and bikes/cars present only when the actors passed in change.
+DEFAULT_REFRESH_POLICIES = {
+    CoverageVariable.RAIN: (RefreshPolicy.ON_WEATHER_CHANGE,None),
+    CoverageVariable.GROUND_WATER: (RefreshPolicy.ON_WEATHER_CHANGE,None),
+    CoverageVariable.CLOUD: (RefreshPolicy.ON_WEATHER_CHANGE,None),
+    CoverageVariable.TIME_OF_DAY: (RefreshPolicy.ON_WEATHER_CHANGE,None),
+    CoverageVariable.BIKES_PRESENT: (RefreshPolicy.ON_ACTORS_CHANGE,None),
+    CoverageVariable.CARS_PRESENT: (RefreshPolicy.ON_ACTORS_CHANGE,None),
+    CoverageVariable.SPEED_LIMIT: (RefreshPolicy.EVERY_TICK,None),
+    CoverageVariable.ROAD_GRAPH: (RefreshPolicy.EVERY_TICK,None),
+    CoverageVariable.VEHICLE_DENSITY: (RefreshPolicy.EVERY_TICK,None),
+    CoverageVariable.PEDESTRIAN_DENSITY: (RefreshPolicy.EVERY_TICK,None),
+    CoverageVariable.EMERGENCY_VEHICLE_STATUS: (RefreshPolicy.EVERY_TICK,None)
+}
 
 class WorldState:
-    def __init__(self,world: carla.World):
+    def __init__(self,world: carla.World,snapshots: ActorSnapshotCache = None,junction_cache: JunctionTopologyCache = None,
+                 emergency_registry: "EmergencyVehicleRegistry" = None,refresh_policies: Dict[CoverageVariable,Tuple[RefreshPolicy,int]] = None):
         self.world = world
-        self.coverage_space = CoverageVariableSet([
+        self.snapshots = snapshots
+        self.junction_cache = junction_cache
+        self.emergency_registry = emergency_registry
+        self.coverage_space = build_coverage_space()
+        self._last_road_graph_string = "TTTT"
+
+        self.refresh_policies = dict(DEFAULT_REFRESH_POLICIES)
+        if refresh_policies != None:
+            self.refresh_policies.update(refresh_policies)
+        self.tick = 0
+        # Memoised value of each variable and the tick it was computed in
+        self._values: Dict[CoverageVariable,Enum] = {}
+        self._refreshed_ticks: Dict[CoverageVariable,int] = {}
+        self._weather = None
+        self._weather_tick = -1
+        self._weather_signature = None
+        self._actors_signature = None
+
+    # Call after changing the weather mid-tick so weather variables already read this tick are read again
+    def notify_weather_changed(self):
+        self._weather_tick = -1
+        self._weather_signature = None
+        self._invalidate(RefreshPolicy.ON_WEATHER_CHANGE)
+
+    # Refreshes the weather variables in the first tick the weather differs, however it was changed
+    def _check_weather(self):
+        signature = get_weather_signature(self.get_weather())
+        if signature != self._weather_signature:
+            self._weather_signature = signature
+            self._invalidate(RefreshPolicy.ON_WEATHER_CHANGE)
+
+    def _invalidate(self,policy: RefreshPolicy):
+        for variable, (p, _) in self.refresh_policies.items():
+            if p == policy:
+                self._values.pop(variable,None)
+
+    def _is_stale(self,variable: CoverageVariable):
+        if not (variable in self._values):
+            return True
+        policy, interval = self.refresh_policies.get(variable,(RefreshPolicy.EVERY_TICK,None))
+        if policy == RefreshPolicy.EVERY_TICK:
+            return True
+        if policy == RefreshPolicy.EVERY_N_TICKS:
+            return self.tick - self._refreshed_ticks[variable] >= interval
+        return False
+
+    # Value of variable, only calling compute when the refresh policy of the variable says it is stale
+    def _get_variable(self,variable: CoverageVariable,compute: Callable[[],Enum]):
+        if self._is_stale(variable):
+            self._values[variable] = compute()
+            self._refreshed_ticks[variable] = self.tick
+        return self._values[variable]
+
+    # The weather is read at most once a tick
+    def get_weather(self):
+        if self._weather_tick != self.tick:
+            self._weather = self.world.get_weather()
+            self._weather_tick = self.tick
+        return self._weather
+
+    def _get_speed_limit(self,ego_vehicle):
+        try:
+            return SpeedLimits(int(ego_vehicle.get_speed_limit()))
+        except:
+            print("invalid speed limit: ",ego_vehicle.get_speed_limit())
+            return SpeedLimits.SEVENTY
+
+    def _get_road_graph(self,ego_vehicle,map):
+        self._last_road_graph_string = self.get_road_graph(map.get_waypoint(ego_vehicle.get_location()))
+        return RoadGraphs[self._last_road_graph_string]
+
+    def _get_emergency_vehicle_status(self):
+        if self.emergency_registry != None:
+            emergency_vehicle_status, _ = self.emergency_registry.get_status()
+        else:
+            emergency_vehicle_status, _ = get_emergency_vehicle_status(self.world)
+        return emergency_vehicle_status
+
+    def _get_vehicle_density(self,ego_vehicle,non_ego_vehicles,vehicle_index: SpatialGrid):
+        if vehicle_index != None:
+            return get_density_level(get_indexed_actor_density(vehicle_index,ego_vehicle.get_location(),25))
+        return get_density_level(get_actor_density(non_ego_vehicles,ego_vehicle.get_location(),25))
+
+    def _get_pedestrian_density(self,ego_vehicle,pedestrian_index: SpatialGrid):
+        if pedestrian_index != None:
+            return get_density_level(get_indexed_actor_density(pedestrian_index,ego_vehicle.get_location(),25))
+        walkers = self.world.get_actors().filter("*walker*")
+        if self.snapshots != None:
+            walkers = [self.snapshots.track(w) for w in walkers]
+        return get_density_level(get_actor_density(walkers,ego_vehicle.get_location(),25))
+
+    # vehicle_index and pedestrian_index are optional SpatialGrids over this tick's actor positions. Every variable
+    # is returned each tick, as each is a digit of the recorded macro-bin key even when no assertion's validity
+    # depends on it, but each is only recomputed as often as its refresh policy asks.
+    def get_coverage_state(self,ego_vehicle,non_ego_vehicles,map,vehicle_index: SpatialGrid = None,pedestrian_index: SpatialGrid = None):
+        self.tick += 1
+        actors_signature = (id(non_ego_vehicles),len(non_ego_vehicles))
+        if actors_signature != self._actors_signature:
+            self._actors_signature = actors_signature
+            self._invalidate(RefreshPolicy.ON_ACTORS_CHANGE)
+        self._check_weather()
+
+        enumerated_vars = [
+            (CoverageVariable.RAIN, self._get_variable(CoverageVariable.RAIN,lambda: getWeatherLevel(self.get_weather().precipitation))),
+            (CoverageVariable.GROUND_WATER, self._get_variable(CoverageVariable.GROUND_WATER,lambda: getWeatherLevel(self.get_weather().precipitation_deposits))),
+            (CoverageVariable.BIKES_PRESENT, self._get_variable(CoverageVariable.BIKES_PRESENT,lambda: boolToEnum(any([v.attributes["number_of_wheels"] == 2 for v in non_ego_vehicles])))),
+            (CoverageVariable.CARS_PRESENT, self._get_variable(CoverageVariable.CARS_PRESENT,lambda: boolToEnum(any([v.attributes["number_of_wheels"] == 4 for v in non_ego_vehicles])))),
+            (CoverageVariable.SPEED_LIMIT, self._get_variable(CoverageVariable.SPEED_LIMIT,lambda: self._get_speed_limit(ego_vehicle))),
+            (CoverageVariable.ROAD_GRAPH, self._get_variable(CoverageVariable.ROAD_GRAPH,lambda: self._get_road_graph(ego_vehicle,map))),
+            (CoverageVariable.VEHICLE_DENSITY, self._get_variable(CoverageVariable.VEHICLE_DENSITY,lambda: self._get_vehicle_density(ego_vehicle,non_ego_vehicles,vehicle_index))),
+            (CoverageVariable.PEDESTRIAN_DENSITY, self._get_variable(CoverageVariable.PEDESTRIAN_DENSITY,lambda: self._get_pedestrian_density(ego_vehicle,pedestrian_index))),
+            (CoverageVariable.EMERGENCY_VEHICLE_STATUS, self._get_variable(CoverageVariable.EMERGENCY_VEHICLE_STATUS,self._get_emergency_vehicle_status)),
+            (CoverageVariable.CLOUD, self._get_variable(CoverageVariable.CLOUD,lambda: getWeatherLevel(self.get_weather().cloudiness))),
+            (CoverageVariable.TIME_OF_DAY, self._get_variable(CoverageVariable.TIME_OF_DAY,lambda: get_weather_time_of_day(self.get_weather())))
+        ]
+        return enumerated_vars
+
+    def get_road_graph(self,ego_waypoint: carla.Waypoint):
+        road_graph = classify_road_graph(ego_waypoint,self.junction_cache)
+        if road_graph == None:
+            return self._last_road_graph_string
+        return road_graph
+
+# The coverage variables recorded for every tick, shared by anything reading or writing coverage files
+def build_coverage_space():
+    return CoverageVariableSet([
             (CoverageVariable.RAIN,Levels),
             (CoverageVariable.GROUND_WATER,Levels),
             (CoverageVariable.BIKES_PRESENT,BooleanEnum),
@@ -23,152 +175,144 @@ class WorldState:
             (CoverageVariable.TIME_OF_DAY,TimesOfDay)
         ]
         )
-        self._last_road_graph_string = "TTTT"
 
-    def get_coverage_state(self,ego_vehicle,non_ego_vehicles,map):
-        enumerated_speed_limit = None
-        try:
-            enumerated_speed_limit = SpeedLimits(int(ego_vehicle.get_speed_limit()))
-        except:
-            print("invalid speed limit: ",ego_vehicle.get_speed_limit())
-            enumerated_speed_limit = SpeedLimits.SEVENTY
-        self._last_road_graph_string = self.get_road_graph(map.get_waypoint(ego_vehicle.get_location()))
-        emergency_vehicle_status, _ = get_emergency_vehicle_status(self.world)
+# Returns which of (up, down, left, right) the road at a waypoint connects to as a RoadGraphs name, or None if
+# it can't be told from the waypoint
+def classify_road_graph(ego_waypoint: carla.Waypoint,junction_cache: JunctionTopologyCache = None):
+    junction = ego_waypoint.get_junction()
 
-        enumerated_vars = [
-            (CoverageVariable.RAIN, getWeatherLevel(self.world.get_weather().precipitation)),
-            (CoverageVariable.GROUND_WATER, getWeatherLevel(self.world.get_weather().precipitation_deposits)),
-            (CoverageVariable.BIKES_PRESENT, boolToEnum(any([v.attributes["number_of_wheels"] == 2 for v in non_ego_vehicles]))),
-            (CoverageVariable.CARS_PRESENT, boolToEnum(any([v.attributes["number_of_wheels"] == 4 for v in non_ego_vehicles]))),
-            (CoverageVariable.SPEED_LIMIT, enumerated_speed_limit),
-            (CoverageVariable.ROAD_GRAPH, RoadGraphs[self._last_road_graph_string]),
-            (CoverageVariable.VEHICLE_DENSITY, get_density_level(get_actor_density(non_ego_vehicles,ego_vehicle.get_location(),25))),
-            (CoverageVariable.PEDESTRIAN_DENSITY, get_density_level(get_actor_density(self.world.get_actors().filter("*walker*"),ego_vehicle.get_location(),25))),
-            (CoverageVariable.EMERGENCY_VEHICLE_STATUS,emergency_vehicle_status),
-            (CoverageVariable.CLOUD,getWeatherLevel(self.world.get_weather().cloudiness)),
-            (CoverageVariable.TIME_OF_DAY,get_time_of_day(self.world))
-        ]
-        return enumerated_vars
+    up = False
+    down = False
+    left = False
+    right = False
 
-    def get_road_graph(self,ego_waypoint: carla.Waypoint):
-        junction = ego_waypoint.get_junction()
-
-        up = False
-        down = False
-        left = False
-        right = False
-
-        glob_right = carla.Vector3D(1,0,0)
-        glob_left = carla.Vector3D(-1,0,0)
-        glob_down = carla.Vector3D(0,-1,0)
-        glob_up = carla.Vector3D(0,1,0)
-        threshold = 0.1
-
-        if junction == None:
-            nextlist = ego_waypoint.next(10)
-            prevlist = ego_waypoint.previous(10)
-            has_two_points = False
-            has_one_point = False
-            if len(nextlist) == 0 and len(prevlist) != 0:
-                road_direction = prevlist[0].transform.location - ego_waypoint.transform.location
-                has_one_point = True
-            elif len(nextlist) != 0 and len(prevlist) == 0:
-                road_direction = nextlist[0].transform.location - ego_waypoint.transform.location
-                has_one_point = True
-            elif len(nextlist) != 0 and len(prevlist) != 0:   
-                road_direction = nextlist[0].transform.location - prevlist[0].transform.location
-                has_two_points = True
-            else:
-                return self._last_road_graph_string
-            
-            road_direction = road_direction / road_direction.length()
-            directions = [glob_up,glob_down,glob_left,glob_right]
-            direction_dots = [dot2d(road_direction,d) for d in directions]
-            closest_direction = np.argmax(direction_dots)
-
-            if has_one_point:
-                if closest_direction == 0:
-                    up = True
-                if closest_direction == 1:
-                    down = True
-                if closest_direction == 2:
-                    left = True
-                if closest_direction == 3:
-                    right = True
+    glob_right = carla.Vector3D(1,0,0)
+    glob_left = carla.Vector3D(-1,0,0)
+    glob_down = carla.Vector3D(0,-1,0)
+    glob_up = carla.Vector3D(0,1,0)
+    threshold = 0.1
 
-            if has_two_points:
+    if junction == None:
+        nextlist = ego_waypoint.next(10)
+        prevlist = ego_waypoint.previous(10)
+        has_two_points = False
+        has_one_point = False
+        if len(nextlist) == 0 and len(prevlist) != 0:
+            road_direction = prevlist[0].transform.location - ego_waypoint.transform.location
+            has_one_point = True
+        elif len(nextlist) != 0 and len(prevlist) == 0:
+            road_direction = nextlist[0].transform.location - ego_waypoint.transform.location
+            has_one_point = True
+        elif len(nextlist) != 0 and len(prevlist) != 0:   
+            road_direction = nextlist[0].transform.location - prevlist[0].transform.location
+            has_two_points = True
+        else:
+            return None
+        
+        road_direction = road_direction / road_direction.length()
+        directions = [glob_up,glob_down,glob_left,glob_right]
+        direction_dots = [dot2d(road_direction,d) for d in directions]
+        closest_direction = np.argmax(direction_dots)
 
-                straight = 1 - direction_dots[closest_direction] < threshold
+        if has_one_point:
+            if closest_direction == 0:
+                up = True
+            if closest_direction == 1:
+                down = True
+            if closest_direction == 2:
+                left = True
+            if closest_direction == 3:
+                right = True
 
-                if closest_direction == 0:
-                    down = True
-                    if straight:
-                        up = True
-                    else:
-                        if direction_dots[3] > 0:
-                            right = True
-                        else:
-                            left = True
-                elif closest_direction == 1:
+        if has_two_points:
+
+            straight = 1 - direction_dots[closest_direction] < threshold
+
+            if closest_direction == 0:
+                down = True
+                if straight:
                     up = True
-                    if straight:
-                        down = True
+                else:
+                    if direction_dots[3] > 0:
+                        right = True
                     else:
-                        if direction_dots[3] > 0:
-                            right = True
-                        else:
-                            left = True
-                elif closest_direction == 2:
-                    right = True
-                    if straight:
                         left = True
-                    else:
-                        if direction_dots[0] > 0:
-                            up = True
-                        else:
-                            down = True
-                elif closest_direction == 3:
-                    left = True
-                    if straight:
+            elif closest_direction == 1:
+                up = True
+                if straight:
+                    down = True
+                else:
+                    if direction_dots[3] > 0:
                         right = True
                     else:
-                        if direction_dots[0] > 0:
-                            up = True
-                        else:
-                            down = True
-        else:
-            waypoints = junction.get_waypoints(carla.LaneType.Driving)
-            entry = waypoints[0][0]
-            road_waypoints = [x[1] for x in waypoints if (x[0].transform.location - entry.transform.location).length() < 0.1]
-            road_waypoints.append(entry)
-            
-            relative_positions = [x.transform.location - junction.bounding_box.location for x in road_waypoints]
-            
-            for p in relative_positions:
-                if p.y > p.x:
-                    if p.y > -p.x:
+                        left = True
+            elif closest_direction == 2:
+                right = True
+                if straight:
+                    left = True
+                else:
+                    if direction_dots[0] > 0:
                         up = True
                     else:
-                        left = True
+                        down = True
+            elif closest_direction == 3:
+                left = True
+                if straight:
+                    right = True
                 else:
-                    if p.y > -p.x:
-                        right = True
+                    if direction_dots[0] > 0:
+                        up = True
                     else:
                         down = True
+    else:
+        if junction_cache != None:
+            topology = junction_cache.get(junction)
+            if topology.road_graph == None:
+                topology.road_graph = get_junction_road_graph(topology.bounding_box,topology.waypoints)
+            up, down, left, right = topology.road_graph
+        else:
+            up, down, left, right = get_junction_road_graph(junction.bounding_box,junction.get_waypoints(carla.LaneType.Driving))
 
-        output_string = ""
-        for b in [up,down,left,right]:
-            if b:
-                output_string = output_string + "T"
+    output_string = ""
+    for b in [up,down,left,right]:
+        if b:
+            output_string = output_string + "T"
+        else:
+            output_string = output_string + "F"
+    if output_string == "FFFF":
+        return None
+    return output_string
+
+# Returns which of (up, down, left, right) the roads of the first entrypoint of a junction lead to
+def get_junction_road_graph(bounding_box: carla.BoundingBox,waypoints):
+    up = False
+    down = False
+    left = False
+    right = False
+
+    entry = waypoints[0][0]
+    road_waypoints = [x[1] for x in waypoints if (x[0].transform.location - entry.transform.location).length() < 0.1]
+    road_waypoints.append(entry)
+    
+    relative_positions = [x.transform.location - bounding_box.location for x in road_waypoints]
+    
+    for p in relative_positions:
+        if p.y > p.x:
+            if p.y > -p.x:
+                up = True
             else:
-                output_string = output_string + "F"
-        if output_string == "FFFF":
-            output_string = self._last_road_graph_string
-        return output_string
+                left = True
+        else:
+            if p.y > -p.x:
+                right = True
+            else:
+                down = True
+    return up, down, left, right
 
-# Returns if an emergency vehicle is present and if their siren is on + the vehicles with their sirens on
-def get_emergency_vehicle_status(world):
-    emergency_vehicles = [x for x in world.get_actors() if fnmatch(x.type_id,"*ambulance*") or fnmatch(x.type_id,"*police*") or fnmatch(x.type_id,"*firetruck*")]
+def is_emergency_vehicle(actor):
+    return fnmatch(actor.type_id,"*ambulance*") or fnmatch(actor.type_id,"*police*") or fnmatch(actor.type_id,"*firetruck*")
+
+def get_emergency_status_of_vehicles(emergency_vehicles):
     if len(emergency_vehicles) > 0:
         sirens_on = [v for v in emergency_vehicles if v.get_light_state() == carla.VehicleLightState.Special1 or v.get_light_state() == carla.VehicleLightState.Special2]
         if len(sirens_on) > 0:
@@ -177,8 +321,81 @@ def get_emergency_vehicle_status(world):
     else:
         return EmergencyVehicleStatus.ABSENT, []
 
+# Returns if an emergency vehicle is present and if their siren is on + the vehicles with their sirens on
+def get_emergency_vehicle_status(world):
+    emergency_vehicles = [x for x in world.get_actors() if is_emergency_vehicle(x)]
+    return get_emergency_status_of_vehicles(emergency_vehicles)
+
+# Tracks emergency vehicles as actors appear and disappear from the world snapshot so only new actors are
+# classified, then only the siren light states of the emergency vehicles are read each tick
+class EmergencyVehicleRegistry:
+    def __init__(self,world: carla.World,snapshots: ActorSnapshotCache = None):
+        self.world = world
+        self.snapshots = snapshots
+        self._is_emergency: Dict[int,bool] = {}
+        self._emergency_vehicles = {}
+        self._status = (EmergencyVehicleStatus.ABSENT, [])
+
+    def refresh(self,world_snapshot: carla.WorldSnapshot = None):
+        if world_snapshot == None:
+            world_snapshot = self.world.get_snapshot()
+        current_ids = set(s.id for s in world_snapshot)
+        for destroyed_id in [i for i in self._is_emergency if not (i in current_ids)]:
+            del self._is_emergency[destroyed_id]
+            self._emergency_vehicles.pop(destroyed_id,None)
+            if self.snapshots != None:
+                self.snapshots.forget(destroyed_id)
+        # Ids get_actors doesn't resolve yet are left unclassified and asked for again next refresh
+        new_ids = [i for i in current_ids if not (i in self._is_emergency)]
+        if len(new_ids) > 0:
+            for actor in self.world.get_actors(new_ids):
+                self._is_emergency[actor.id] = is_emergency_vehicle(actor)
+                if self._is_emergency[actor.id]:
+                    self._emergency_vehicles[actor.id] = actor if self.snapshots == None else self.snapshots.track(actor)
+        self._status = get_emergency_status_of_vehicles(list(self._emergency_vehicles.values()))
+
+    # Same result as get_emergency_vehicle_status as of the last refresh
+    def get_status(self):
+        return self._status
+
+# Tracks the walkers in the world as actors appear and disappear from the world snapshot so only new actors are
+# classified, then only the locations of the walkers are read each tick
+class WalkerRegistry:
+    def __init__(self,world: carla.World):
+        self.world = world
+        self._is_walker: Dict[int,bool] = {}
+        self._walker_ids = set()
+        self._locations = np.zeros((0,3))
+
+    def refresh(self,world_snapshot: carla.WorldSnapshot = None):
+        if world_snapshot == None:
+            world_snapshot = self.world.get_snapshot()
+        current_ids = set(s.id for s in world_snapshot)
+        for destroyed_id in [i for i in self._is_walker if not (i in current_ids)]:
+            del self._is_walker[destroyed_id]
+            self._walker_ids.discard(destroyed_id)
+        # Ids get_actors doesn't resolve yet are left unclassified and asked for again next refresh
+        new_ids = [i for i in current_ids if not (i in self._is_walker)]
+        if len(new_ids) > 0:
+            for actor in self.world.get_actors(new_ids):
+                self._is_walker[actor.id] = fnmatch(actor.type_id,"*walker*")
+                if self._is_walker[actor.id]:
+                    self._walker_ids.add(actor.id)
+        self._locations = np.array([location_array(world_snapshot.find(i).get_transform().location) for i in self._walker_ids]).reshape(len(self._walker_ids),3)
+
+    # (N,3) locations of every walker in the world as of the last refresh
+    def get_locations(self):
+        return self._locations
+
+# The weather parameters the weather coverage variables are computed from
+def get_weather_signature(weather: carla.WeatherParameters):
+    return (weather.precipitation,weather.precipitation_deposits,weather.cloudiness,weather.sun_altitude_angle)
+
 def get_time_of_day(world):
-    sun_angle = world.get_weather().sun_altitude_angle
+    return get_weather_time_of_day(world.get_weather())
+
+def get_weather_time_of_day(weather: carla.WeatherParameters):
+    sun_angle = weather.sun_altitude_angle
     if sun_angle > -10 and sun_angle <= 20:
         return TimesOfDay.SUNRISE
     elif sun_angle > 10 and sun_angle < 160:
@@ -191,6 +408,9 @@ def get_time_of_day(world):
 def get_actor_density(full_actor_list,ego_pos,distance):
     return len([e for e in full_actor_list if (e.get_location() - ego_pos).length() < distance])/(3.14 * distance * distance)
 
+def get_indexed_actor_density(index: SpatialGrid,ego_pos,distance):
+    return index.count_within(location_array(ego_pos),distance)/(3.14 * distance * distance)
+
 def get_density_level(density):
     if density <= 0:
         return Levels.NONE